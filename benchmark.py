@@ -0,0 +1,275 @@
+## This file runs reproducible benchmarks for Parinfer.
+##   python benchmark.py run [-o results.json] [--repeat N] [--seed N] [--scale F]
+##   python benchmark.py compare old.json new.json [--threshold F]
+## "run" times both modes, with and without a cursor, on tests/really_long_file
+## and on generated corpora. "compare" fails when the throughput of any case
+## dropped by more than the threshold (10% by default).
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from parinfer import indent_mode, paren_mode
+
+#-------------------------------------------------------------------------------
+# Corpus Generator
+#-------------------------------------------------------------------------------
+
+SYMBOLS = ["foo", "bar", "baz", "qux", "map", "reduce", "let", "fn", "defn",
+           "assoc", "update-in", "->", "when-not", "x", "y", "acc", "coll"]
+WORDS = ["hello", "world", "(not a form)", "semi;colon", "a \\\"quote\\\"", "tab\\there"]
+
+# Options of makeCorpus:
+#   lines       number of lines to generate (at least)
+#   lineLength  width that forms are wrapped at
+#   depth       maximum nesting depth
+#   formSize    maximum number of atoms and forms in a top-level form
+#   strings     share of atoms that are strings
+#   comments    share of lines with a comment, at the end or on a line of its own
+#   tabs        share of indented lines that are indented with tabs
+#   trails      how close-parens end a line: "clean" keeps them together,
+#               "own-line" puts some of them on the next line and "spaced"
+#               puts blank spaces between some of them
+DEFAULT_CORPUS = {
+    'lines': 2000,
+    'lineLength': 80,
+    'depth': 6,
+    'formSize': 40,
+    'strings': 0.1,
+    'comments': 0.05,
+    'tabs': 0.0,
+    'trails': "clean",
+}
+
+def makeAtom(rng, spec):
+    r = rng.random()
+    if r < spec['strings']:
+        return '"%s"' % " ".join(rng.choice(WORDS) for i in range(rng.randint(1, 4)))
+    if r < spec['strings'] + 0.15:
+        return str(rng.randint(0, 1000))
+    if r < spec['strings'] + 0.25:
+        return ":" + rng.choice(SYMBOLS)
+    return rng.choice(SYMBOLS)
+
+def makeExpr(rng, spec, depth, size):
+    """Returns an atom, or an (opener, children) form of at most about size
+    atoms and forms. The size is split unevenly between the children, so
+    some paths go deep while the form stays small."""
+    if depth != 0 and (size <= 1 or depth >= spec['depth'] or rng.random() < 0.2):
+        return makeAtom(rng, spec)
+    opener = rng.choice("((((([{")
+    children = []
+    size = size - 1
+    for i in range(rng.randint(1, 5)):
+        childSize = rng.randint(1, max(1, size))
+        children.append(makeExpr(rng, spec, depth + 1, childSize))
+        size = size - childSize
+    if opener == "(":
+        children.insert(0, rng.choice(SYMBOLS))
+    return (opener, children)
+
+CLOSERS = {"(": ")", "[": "]", "{": "}"}
+
+def flatExpr(expr):
+    if isinstance(expr, str):
+        return expr
+    opener, children = expr
+    return opener + " ".join(flatExpr(child) for child in children) + CLOSERS[opener]
+
+def formatExpr(expr, indent, width, lines):
+    """Appends the lines of expr to lines, the first one without its
+    indentation. Wraps the children of forms that do not fit in width, one
+    per line."""
+    flat = flatExpr(expr)
+    if isinstance(expr, str) or indent + len(flat) <= width:
+        lines[-1] = lines[-1] + flat
+        return
+    opener, children = expr
+    lines[-1] = lines[-1] + opener
+    formatExpr(children[0], indent + 1, width, lines)
+    for child in children[1:]:
+        lines.append(" " * (indent + 1))
+        formatExpr(child, indent + 1, width, lines)
+    lines[-1] = lines[-1] + CLOSERS[opener]
+
+def messUpLine(rng, spec, line, out):
+    """Appends line to out, with the comments, tabs and trails of spec."""
+    indent = len(line) - len(line.lstrip(" "))
+    if indent >= 2 and rng.random() < spec['tabs']:
+        line = "\t" * (indent // 2) + " " * (indent % 2) + line[indent:]
+
+    code = line.rstrip(")]}")
+    trail = line[len(code):]
+    if len(trail) > 1 and spec['trails'] == "own-line" and rng.random() < 0.3:
+        out.append(code + trail[:1])
+        line = " " * indent + trail[1:]
+    elif len(trail) > 1 and spec['trails'] == "spaced" and rng.random() < 0.3:
+        line = code + " ".join(trail)
+
+    if rng.random() < spec['comments']:
+        if rng.random() < 0.5:
+            out.append(" " * indent + ";; " + " ".join(rng.choice(SYMBOLS) for i in range(4)))
+        else:
+            line = line + " ; " + rng.choice(WORDS)
+    out.append(line)
+
+def makeCorpus(seed, **options):
+    """Returns a Lisp text made of random top-level forms. The same seed and
+    options always give the same text."""
+    spec = dict(DEFAULT_CORPUS)
+    spec.update(options)
+    rng = random.Random(seed)
+    out = []
+    while len(out) < spec['lines']:
+        lines = [""]
+        size = rng.randint(1, spec['formSize'])
+        formatExpr(makeExpr(rng, spec, 0, size), 0, spec['lineLength'], lines)
+        for line in lines:
+            messUpLine(rng, spec, line, out)
+        out.append("")
+    return "\n".join(out)
+
+#-------------------------------------------------------------------------------
+# Fixtures
+#-------------------------------------------------------------------------------
+
+# (name, makeCorpus options); the lines are multiplied by --scale
+FIXTURES = [
+    ("forms", {}),
+    ("deep", {'depth': 16, 'formSize': 200, 'lineLength': 120}),
+    ("long-lines", {'lineLength': 400}),
+    ("strings-comments", {'strings': 0.4, 'comments': 0.4}),
+    ("tabs", {'tabs': 0.5}),
+    ("own-line-trails", {'trails': "own-line"}),
+    ("spaced-trails", {'trails': "spaced"}),
+]
+
+def loadFixtures(seed, scale):
+    """Returns a list of (name, text)."""
+    with open("tests/really_long_file") as f:
+        fixtures = [("really_long_file", f.read())]
+    for name, options in FIXTURES:
+        options = dict(options)
+        options['lines'] = int(DEFAULT_CORPUS['lines'] * scale)
+        fixtures.append((name, makeCorpus(seed, **options)))
+    return fixtures
+
+def cursorOptions(text, withDx):
+    """Puts the cursor at the end of the middle line."""
+    lines = text.split("\n")
+    cursorLine = len(lines) // 2
+    options = {'cursorLine': cursorLine, 'cursorX': len(lines[cursorLine])}
+    if withDx:
+        options['cursorDx'] = 2
+    return options
+
+def cases(text):
+    """Returns a list of (name, fn, options)."""
+    return [
+        ("indent", indent_mode, None),
+        ("paren", paren_mode, None),
+        ("indent+cursor", indent_mode, cursorOptions(text, False)),
+        ("paren+cursor", paren_mode, cursorOptions(text, True)),
+    ]
+
+#-------------------------------------------------------------------------------
+# Commands
+#-------------------------------------------------------------------------------
+
+def bestTime(fn, text, options, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        fn(text, options)
+        dt = time.perf_counter() - t
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def run(args):
+    results = {}
+    print("%-34s %12s %12s" % ("case", "Mchars/s", "Klines/s"))
+    for fixture, text in loadFixtures(args.seed, args.scale):
+        numchars = len(text)
+        numlines = text.count("\n") + 1
+        for name, fn, options in cases(text):
+            dt = bestTime(fn, text, options, args.repeat)
+            key = fixture + "/" + name
+            results[key] = {
+                'chars': numchars,
+                'lines': numlines,
+                'seconds': dt,
+                'charsPerSec': numchars / dt,
+                'linesPerSec': numlines / dt,
+            }
+            print("%-34s %12.3f %12.1f" % (key, numchars / dt / 1e6, numlines / dt / 1e3))
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Wrote", args.output)
+    return 0
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    if (old['seed'], old['scale']) != (new['seed'], new['scale']):
+        print("warning: the corpora differ (seed and scale)")
+
+    status = 0
+    print("%-34s %10s %10s" % ("case", "chars/s", "lines/s"))
+    for key in sorted(set(old['results']) & set(new['results'])):
+        changes = []
+        for metric in ('charsPerSec', 'linesPerSec'):
+            changes.append(new['results'][key][metric] / old['results'][key][metric] - 1)
+        regressed = min(changes) < -args.threshold
+        if regressed:
+            status = 1
+        print("%-34s %+9.1f%% %+9.1f%%%s" % (key, changes[0] * 100, changes[1] * 100,
+                                           "  REGRESSION" if regressed else ""))
+    for key in sorted(set(old['results']) ^ set(new['results'])):
+        print("%-34s only in %s" % (key, args.old if key in old['results'] else args.new))
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python benchmark.py")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    runParser = commands.add_parser("run", help="time all the cases and save the results")
+    runParser.add_argument("-o", "--output", default="benchmark.json",
+                           help="results file (default: benchmark.json)")
+    runParser.add_argument("--repeat", type=int, default=5,
+                           help="runs per case, the best one counts (default: 5)")
+    runParser.add_argument("--seed", type=int, default=0,
+                           help="seed of the generated corpora (default: 0)")
+    runParser.add_argument("--scale", type=float, default=1.0,
+                           help="multiplies the size of the generated corpora")
+
+    compareParser = commands.add_parser("compare", help="compare two results files")
+    compareParser.add_argument("old")
+    compareParser.add_argument("new")
+    compareParser.add_argument("--threshold", type=float, default=0.1,
+                               help="largest allowed drop of throughput (default: 0.1)")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    return compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
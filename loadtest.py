@@ -0,0 +1,198 @@
+## This file load-tests the Parinfer server (python -m parinfer --serve).
+##   python loadtest.py [--buffers N] [--edits N] [--connections N] [--socket PATH]
+## Many buffers are typed into at once, over a few connections, and the
+## response latency of the edits is reported (p50, p90, p99). A server is
+## started on a temporary socket unless --socket is given.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from benchmark import makeCorpus
+from parinfer import indent_mode, paren_mode
+from parinfer_server import MAX_MESSAGE_SIZE
+
+# keystrokes, mostly symbols and blank spaces
+KEYS = "abcdefghijklmnopqrstuvwxyz      ()()[]"
+
+class Client(object):
+    """A connection to the server, with the requests waiting for an answer."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.nextId = 1
+        self.waiting = {}
+
+    def request(self, method, params):
+        """Sends a request. Returns a future of (arrival time, answer)."""
+        id = self.nextId
+        self.nextId = self.nextId + 1
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[id] = future
+        message = {'jsonrpc': "2.0", 'id': id, 'method': method, 'params': params}
+        self.writer.write((json.dumps(message) + "\n").encode('utf-8'))
+        return future
+
+    async def readAnswers(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            now = time.perf_counter()
+            answer = json.loads(line)
+            self.waiting.pop(answer['id']).set_result((now, answer))
+
+def applyAnswer(lines, answer):
+    for line in answer['result']['changedLines']:
+        lines[line['lineNo']] = line['line']
+
+def typeKey(rng, lines):
+    """Makes a random edit to lines, in place. Returns (startLine, endLine,
+    newLines, options) for it."""
+    lineNo = rng.randrange(len(lines))
+    line = lines[lineNo]
+    x = rng.randint(0, len(line))
+    r = rng.random()
+    if r < 0.05:
+        newLines = [line[:x], line[x:]]
+        options = {'cursorLine': lineNo + 1, 'cursorX': 0}
+    elif r < 0.2 and x > 0:
+        newLines = [line[:x - 1] + line[x:]]
+        options = {'cursorLine': lineNo, 'cursorX': x - 1}
+    else:
+        newLines = [line[:x] + rng.choice(KEYS) + line[x:]]
+        options = {'cursorLine': lineNo, 'cursorX': x + 1}
+    lines[lineNo:lineNo + 1] = newLines
+    return lineNo, lineNo + 1, newLines, options
+
+async def typeIntoBuffer(client, name, args, stats):
+    rng = random.Random(args.seed + len(stats['buffers']))
+    stats['buffers'].append(name)
+    text = makeCorpus(rng.randrange(1 << 30), lines=args.lines)
+    lines = text.split("\n")
+    mode = indent_mode if args.mode == "indent" else paren_mode
+
+    arrival, answer = await client.request('open', {'buffer': name, 'mode': args.mode, 'text': text})
+    applyAnswer(lines, answer)
+    applied = answer['id']
+
+    edits = 0
+    while edits < args.edits:
+        burst = rng.randint(2, 4) if rng.random() < args.burst else 1
+        sent = []
+        for i in range(burst):
+            startLine, endLine, newLines, options = typeKey(rng, lines)
+            params = {'buffer': name, 'startLine': startLine, 'endLine': endLine,
+                      'lines': newLines, 'options': options}
+            if applied is not None:
+                params['applied'] = applied
+                applied = None
+            sent.append((time.perf_counter(), client.request('edit', params), options))
+        edits = edits + burst
+
+        for start, future, options in sent:
+            arrival, answer = await future
+            if 'error' in answer:
+                stats['cancelled'] = stats['cancelled'] + 1
+                continue
+            stats['latencies'].append(arrival - start)
+            if not answer['result']['success']:
+                stats['failed'] = stats['failed'] + 1
+
+        # only the answer to the last keystroke can be applied
+        if 'result' in answer and answer['result']['success']:
+            expected = mode("\n".join(lines), options)
+            applyAnswer(lines, answer)
+            applied = answer['id']
+            if edits >= args.edits and "\n".join(lines) != expected['text']:
+                stats['mismatches'].append(name)
+
+        await asyncio.sleep(rng.expovariate(1000.0 / args.think))
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def loadTest(args, socketPath):
+    clients = []
+    for i in range(args.connections):
+        reader, writer = await asyncio.open_unix_connection(socketPath, limit=MAX_MESSAGE_SIZE)
+        clients.append(Client(reader, writer))
+    readers = [asyncio.ensure_future(client.readAnswers()) for client in clients]
+
+    stats = {'buffers': [], 'latencies': [], 'cancelled': 0, 'failed': 0, 'mismatches': []}
+    start = time.perf_counter()
+    await asyncio.gather(*[typeIntoBuffer(clients[i % len(clients)], "buffer-%d" % i, args, stats)
+                           for i in range(args.buffers)])
+    elapsed = time.perf_counter() - start
+
+    if args.socket is None:
+        await clients[0].request('shutdown', {})
+    for client in clients:
+        client.writer.close()
+    await asyncio.wait(readers)
+
+    latencies = sorted(stats['latencies'])
+    print("%d buffers of %d lines, %d edits each, over %d connections, %s mode" % (
+        args.buffers, args.lines, args.edits, args.connections, args.mode))
+    print("answered %d, cancelled %d, failed (parinfer errors) %d, %.0f edits/s" % (
+        len(latencies), stats['cancelled'], stats['failed'],
+        (len(latencies) + stats['cancelled']) / elapsed))
+    if latencies:
+        print("latency: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" % tuple(
+            1000 * value for value in (percentile(latencies, 0.5), percentile(latencies, 0.9),
+                                       percentile(latencies, 0.99), latencies[-1])))
+    if stats['mismatches']:
+        print("MISMATCH with a full run in:", ", ".join(stats['mismatches']))
+        return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python loadtest.py")
+    parser.add_argument("--buffers", type=int, default=50, help="number of buffers (default: 50)")
+    parser.add_argument("--edits", type=int, default=100, help="edits per buffer (default: 100)")
+    parser.add_argument("--connections", type=int, default=4, help="number of connections (default: 4)")
+    parser.add_argument("--lines", type=int, default=500, help="lines per buffer (default: 500)")
+    parser.add_argument("--mode", choices=["indent", "paren"], default="indent")
+    parser.add_argument("--think", type=float, default=20, metavar="MS",
+                        help="mean time between keystrokes (default: 20)")
+    parser.add_argument("--burst", type=float, default=0.1,
+                        help="share of keystrokes sent in a quick burst (default: 0.1)")
+    parser.add_argument("--coalesce", type=float, default=0, metavar="MS",
+                        help="--coalesce of the server that is started")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--socket", metavar="PATH", help="use the server listening on PATH")
+    args = parser.parse_args(argv)
+
+    if args.socket is not None:
+        return asyncio.run(loadTest(args, args.socket))
+
+    tmp = tempfile.mkdtemp()
+    socketPath = os.path.join(tmp, "parinfer.sock")
+    server = subprocess.Popen([sys.executable, "-m", "parinfer", "--serve", "--socket", socketPath,
+                               "--coalesce", str(args.coalesce)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        deadline = time.time() + 10
+        while not os.path.exists(socketPath):
+            if time.time() > deadline or server.poll() is not None:
+                sys.stderr.write("the server did not start\n")
+                return 1
+            time.sleep(0.01)
+        return asyncio.run(loadTest(args, socketPath))
+    finally:
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+        os.rmdir(tmp)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,15 @@
 ## https://github.com/oakmac/parinfer.py/blob/master/LICENSE.md
 
 import re
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from itertools import accumulate, repeat
+from types import FunctionType, MappingProxyType
+
+__version__ = "0.7.0"
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -28,6 +37,14 @@ TAB = '\t'
 
 LINE_ENDING_REGEX = re.compile(r"\r?\n")
 
+# chars with an entry in CHAR_DISPATCH, except NEWLINE which ends every line
+DISPATCH_CHARS = "()[]{}\";\\\t"
+DISPATCH_CHARS_REGEX = re.compile(r"[()\[\]{}\";\\\t]")
+
+# the same for NON_CODE_DISPATCH, in strings and comments
+NON_CODE_CHARS_REGEX = re.compile(r"[\"\\]")
+
+OPEN_PARENS = frozenset(['{', '(', '['])
 CLOSE_PARENS = frozenset(['}', ')', ']'])
 
 PARENS = {
@@ -43,53 +60,96 @@ PARENS = {
 # Result Structure
 #-------------------------------------------------------------------------------
 
-def initialResult(text, options, mode):
-    """Returns a dictionary of the initial state."""
-    result = {
-        'mode': mode,
-        'origText': text,
-        'origLines': text.split(NEWLINE),
-        'lines': [],
-        'lineNo': -1,
-        'ch': '',
-        'x': 0,
-        'parenStack': [],
-        'parenTrail': {
-            'lineNo': None,
-            'startX': None,
-            'endX': None,
-            'openers': [],
-        },
-        'cursorX': None,
-        'cursorLine': None,
-        'cursorDx': None,
-        'isInCode': True,
-        'isEscaping': False,
-        'isInStr': False,
-        'isInComment': False,
-        'commentX': None,
-        'quoteDanger': False,
-        'trackingIndent': False,
-        'skipChar': False,
-        'success': False,
-        'maxIndent': None,
-        'indentDelta': 0,
-        'error': {
-            'name': None,
-            'message': None,
-            'lineNo': None,
-            'x': None,
-        },
-        'errorPosCache': {},
+# NOTE: An open-paren on the paren stack is a (lineNo, x, ch, indentDelta)
+#       tuple, so that pushing one allocates nothing more than the tuple.
+#       The openers of the close-parens in the paren trail are kept in a
+#       deque, in the order they were closed: the cursor can remove them from
+#       the front, and the trail can put them back on the stack from the end.
+
+OPENER_LINE_NO = 0
+OPENER_X = 1
+OPENER_CH = 2
+OPENER_INDENT_DELTA = 3
+
+class ParenTrail(object):
+    """The close-parens at the end of the last line of code."""
+    __slots__ = ('lineNo', 'startX', 'endX', 'openers')
+
+    def __init__(self):
+        self.lineNo = None
+        self.startX = None
+        self.endX = None
+        self.openers = deque()
+
+class Result(object):
+    """The state of a run. publicResult() turns it into the dictionary
+    returned by the public API."""
+    __slots__ = (
+        'mode', 'origText', 'origLines', 'lines', 'lineNo', 'ch', 'x',
+        'parenStack', 'parenTrail', 'cursorX', 'cursorLine', 'cursorDx',
+        'isInCode', 'isEscaping', 'isInStr', 'isInComment', 'commentX',
+        'quoteDanger', 'trackingIndent', 'skipChar', 'success', 'maxIndent',
+        'indentDelta', 'error', 'errorPosCache', 'lineBuffer', 'stats',
+        'lineEnding', 'dirtyLines', 'scan', 'incomplete', 'trailAppend',
+        'outline',
+    )
+
+def initialResult(text, options, mode, origLines=None):
+    """Returns the initial state. When origLines is given, text is only
+    used by publicResult, and can be None if the result is not made public."""
+    lineEnding = None
+    if origLines is None:
+        origLines, lineEnding = splitLines(text)
+
+    result = Result()
+    result.mode = mode
+    result.origText = text
+    result.origLines = origLines
+    result.lines = []
+    result.lineNo = -1
+    result.ch = ''
+    result.x = 0
+    result.parenStack = []
+    result.parenTrail = ParenTrail()
+    result.cursorX = None
+    result.cursorLine = None
+    result.cursorDx = None
+    result.isInCode = True
+    result.isEscaping = False
+    result.isInStr = False
+    result.isInComment = False
+    result.commentX = None
+    result.quoteDanger = False
+    result.trackingIndent = False
+    result.skipChar = False
+    result.success = False
+    result.maxIndent = None
+    result.indentDelta = 0
+    result.error = {
+        'name': None,
+        'message': None,
+        'lineNo': None,
+        'x': None,
     }
+    result.errorPosCache = {}
+    result.lineBuffer = []
+    result.stats = None
+    result.lineEnding = lineEnding
+    result.dirtyLines = set()
+    result.scan = None
+    result.incomplete = False
+    result.trailAppend = None
+    result.outline = None
 
     if isinstance(options, dict):
+        if options.get('outline'):
+            result.outline = []
         if 'cursorDx' in options:
-            result['cursorDx'] = options['cursorDx']
+            result.cursorDx = options['cursorDx']
         if 'cursorLine' in options:
-            result['cursorLine'] = options['cursorLine']
+            result.cursorLine = options['cursorLine']
         if 'cursorX' in options:
-            result['cursorX'] = options['cursorX']
+            result.cursorX = options['cursorX']
 
     return result
 
@@ -110,16 +170,16 @@ errorMessages[ERROR_UNCLOSED_QUOTE] = "String is missing a closing quote."
 errorMessages[ERROR_UNCLOSED_PAREN] = "Unmatched open-paren."
 
 def cacheErrorPos(result, name, lineNo, x):
-    result['errorPosCache'][name] = {'lineNo': lineNo, 'x': x}
+    result.errorPosCache[name] = {'lineNo': lineNo, 'x': x}
 
 class ParinferError(Exception):
     pass
 
 def error(result, name, lineNo, x):
     if lineNo is None:
-        lineNo = result['errorPosCache'][name]['lineNo']
+        lineNo = result.errorPosCache[name]['lineNo']
     if x is None:
-        x = result['errorPosCache'][name]['x']
+        x = result.errorPosCache[name]['x']
 
     return {
         'parinferError': True,
@@ -143,10 +203,7 @@ def removeWithinString(orig, start, end):
     return orig[:start] + orig[end:]
 
 def repeatString(text, n):
-    result = ""
-    for i in range(n):
-        result = result + text
-    return result
+    return text * n
 
 # NOTE: We assume that if the CR char "\r" is used anywhere, we should use CRLF
 #       line-endings after every line.
@@ -156,41 +213,143 @@ def getLineEnding(text):
         return "\r\n"
     return "\n"
 
+def splitLines(text):
+    """Returns the lines of text, without their line endings, and the line
+    ending of getLineEnding(text). Without a CR char, str.split does the
+    same as LINE_ENDING_REGEX, several times faster."""
+    if "\r" in text:
+        return LINE_ENDING_REGEX.split(text), "\r\n"
+    return text.split(NEWLINE), NEWLINE
+
 #-------------------------------------------------------------------------------
 # Line Operations
 #-------------------------------------------------------------------------------
 
+# NOTE: result.dirtyLines holds the numbers of the lines that were written,
+#       so that the changed lines are found without comparing every line.
+#       An incremental run also adds the changed lines of the output that it
+#       reuses from the last run. It is None when the lines are not kept;
+#       then every line is compared.
+
+def markDirty(result, lineNo):
+    if result.dirtyLines is not None:
+        result.dirtyLines.add(lineNo)
+
 def insertWithinLine(result, lineNo, idx, insert):
-    line = result['lines'][lineNo]
-    result['lines'][lineNo] = insertWithinString(line, idx, insert)
+    line = result.lines[lineNo]
+    result.lines[lineNo] = insertWithinString(line, idx, insert)
+    markDirty(result, lineNo)
 
 def replaceWithinLine(result, lineNo, start, end, replace):
-    line = result['lines'][lineNo]
-    result['lines'][lineNo] = replaceWithinString(line, start, end, replace)
+    line = result.lines[lineNo]
+    result.lines[lineNo] = replaceWithinString(line, start, end, replace)
+    markDirty(result, lineNo)
 
 def removeWithinLine(result, lineNo, start, end):
-    line = result['lines'][lineNo]
-    result['lines'][lineNo] = removeWithinString(line, start, end)
+    line = result.lines[lineNo]
+    result.lines[lineNo] = removeWithinString(line, start, end)
+    markDirty(result, lineNo)
+
+# NOTE: result.lines holds the original line while it is processed, and
+#       lines are copied on write. As long as the output is the same as the
+#       input, x is also the position in the original line and nothing is
+#       buffered. Before the output first differs, copyLine starts
+#       result.lineBuffer with the original line up to x. From then on the
+#       output up to x is kept there as a list of non-empty strings, which
+#       finishLine joins. So an unchanged line is never sliced or joined.
 
 def initLine(result, line):
-    result['x'] = 0
-    result['lineNo'] = result['lineNo'] + 1
-    result['lines'].append(line)
+    result.x = 0
+    result.lineNo = result.lineNo + 1
+    result.lines.append(line)
+    result.lineBuffer = None
+    if result.outline is not None:
+        result.outline.append(None)
 
     # reset line-specific state
-    result['commentX'] = None
-    result['indentDelta'] = 0
-
-def commitChar(result, origCh):
-    ch = result['ch']
-    if origCh != ch:
-        replaceWithinLine(result, result['lineNo'], result['x'], result['x'] + len(origCh), ch)
-    result['x'] = result['x'] + len(ch)
+    result.commentX = None
+    result.indentDelta = 0
+
+def copyLine(result):
+    """Call before the output of the line first differs from its input."""
+    if result.lineBuffer is None:
+        x = result.x
+        result.lineBuffer = [result.lines[result.lineNo][:x]] if x != 0 else []
+
+def writeLineBuffer(result):
+    result.lines[result.lineNo] = "".join(result.lineBuffer)
+    markDirty(result, result.lineNo)
+
+def finishLine(result):
+    if result.lineBuffer is not None:
+        writeLineBuffer(result)
+    if result.trailAppend is not None:
+        lineNo, x, closers = result.trailAppend
+        insertWithinLine(result, lineNo, x, "".join(closers))
+        result.trailAppend = None
+
+def commitChar(result):
+    ch = result.ch
+    if ch != "" and result.lineBuffer is not None:
+        result.lineBuffer.append(ch)
+    result.x = result.x + len(ch)
+
+def commitRun(result, line, start, end):
+    if result.lineBuffer is not None:
+        result.lineBuffer.append(line[start:end])
+    result.x = result.x + end - start
+
+def prevChar(result):
+    """Returns the last output char before x on the current line."""
+    if result.x == 0:
+        return None
+    if result.lineBuffer is None:
+        return result.lines[result.lineNo][result.x - 1]
+    return result.lineBuffer[-1][-1]
 
 #-------------------------------------------------------------------------------
 # Misc Utils
 #-------------------------------------------------------------------------------
 
+# NOTE: With the {'outline': True} option, result.outline gets an entry for
+#       each line: None, or the list of the pairs of parens that were closed
+#       while the line was processed, as (openLineOffset, openX,
+#       closeLineOffset, closeX). The offsets count back from that line, so
+#       the entries of a line stay valid where the line is reused, like its
+#       output. The close-parens of the paren trail are the last pairs of
+#       the entry of their line, and are moved or dropped with the trail
+#       until that line ends. The pairs closed at the end of the text get
+#       one more entry, as if on the line past the last one.
+#       IncrementalProcessor and FormProcessor keep the entries of the lines
+#       that they reuse, so the outline stays current after an edit. The
+#       result holds them as an Outline.
+
+def addFormPair(result, opener, lineNo, x):
+    entryLineNo = len(result.outline) - 1
+    pairs = result.outline[-1]
+    if pairs is None:
+        pairs = result.outline[-1] = []
+    pairs.append((entryLineNo - opener[OPENER_LINE_NO], opener[OPENER_X],
+                  entryLineNo - lineNo, x))
+
+def addTrailPair(result, opener, x, i):
+    """Adds the pair of the i-th close-paren inserted at x in the paren trail
+    line, which is done by the time it is inserted. The cursor can push x
+    past the end of that line, where the insert ends up."""
+    lineNo = result.parenTrail.lineNo
+    x = min(x, len(result.lines[lineNo]))
+    addFormPair(result, opener, lineNo, x + i)
+
+def moveTrailPairs(result):
+    """Puts the close-parens of the paren trail one after the other from
+    its start, after the blank spaces between them were removed."""
+    pairs = result.outline[-1]
+    count = len(result.parenTrail.openers)
+    startX = result.parenTrail.startX
+    for i in range(count):
+        openOffset, openX, closeOffset, closeX = pairs[len(pairs) - count + i]
+        pairs[len(pairs) - count + i] = (openOffset, openX, closeOffset, startX + i)
+
 def clamp(valN, minN, maxN):
     if minN is not None:
         valN = max(minN, valN)
@@ -211,67 +370,69 @@ def peek(arr):
 def isValidCloseParen(parenStack, ch):
     if len(parenStack) == 0:
         return False
-    return peek(parenStack)['ch'] == PARENS[ch]
+    return parenStack[-1][OPENER_CH] == PARENS[ch]
+
+# NOTE: The handlers in CHAR_DISPATCH are only called in code, and the ones
+#       that enter or leave a string or a comment update isInCode, so that
+#       it is not recomputed after every char.
 
 def onOpenParen(result):
-    if result['isInCode']:
-        result['parenStack'].append({
-            'lineNo': result['lineNo'],
-            'x': result['x'],
-            'ch': result['ch'],
-            'indentDelta': result['indentDelta'],
-        })
+    result.parenStack.append((result.lineNo, result.x, result.ch, result.indentDelta))
 
 def onMatchedCloseParen(result):
-    opener = peek(result['parenStack'])
-    result['parenTrail']['endX'] = result['x'] + 1
-    result['parenTrail']['openers'].append(opener)
-    result['maxIndent'] = opener['x']
-    result['parenStack'].pop()
+    opener = result.parenStack.pop()
+    result.parenTrail.endX = result.x + 1
+    result.parenTrail.openers.append(opener)
+    result.maxIndent = opener[OPENER_X]
+    if result.outline is not None:
+        addFormPair(result, opener, result.lineNo, result.x)
 
 def onUnmatchedCloseParen(result):
-    result['ch'] = ''
+    copyLine(result)
+    result.ch = ''
 
 def onCloseParen(result):
-    if result['isInCode']:
-        if isValidCloseParen(result['parenStack'], result['ch']):
-            onMatchedCloseParen(result)
-        else:
-            onUnmatchedCloseParen(result)
+    if isValidCloseParen(result.parenStack, result.ch):
+        onMatchedCloseParen(result)
+    else:
+        onUnmatchedCloseParen(result)
 
 def onTab(result):
-    if result['isInCode']:
-        result['ch'] = DOUBLE_SPACE
+    copyLine(result)
+    result.ch = DOUBLE_SPACE
 
 def onSemicolon(result):
-    if result['isInCode']:
-        result['isInComment'] = True
-        result['commentX'] = result['x']
+    result.isInComment = True
+    result.isInCode = False
+    result.commentX = result.x
 
 def onNewLine(result):
-    result['isInComment'] = False
-    result['ch'] = ''
+    result.isInComment = False
+    result.isInCode = not result.isInStr
+    result.ch = ''
 
 def onQuote(result):
-    if result['isInStr']:
-        result['isInStr'] = False
-    elif result['isInComment']:
-        result['quoteDanger'] = not result['quoteDanger']
-        if result['quoteDanger']:
-            cacheErrorPos(result, ERROR_QUOTE_DANGER, result['lineNo'], result['x'])
+    if result.isInStr:
+        result.isInStr = False
+        result.isInCode = True
+    elif result.isInComment:
+        result.quoteDanger = not result.quoteDanger
+        if result.quoteDanger:
+            cacheErrorPos(result, ERROR_QUOTE_DANGER, result.lineNo, result.x)
     else:
-        result['isInStr'] = True
-        cacheErrorPos(result, ERROR_UNCLOSED_QUOTE, result['lineNo'], result['x'])
+        result.isInStr = True
+        result.isInCode = False
+        cacheErrorPos(result, ERROR_UNCLOSED_QUOTE, result.lineNo, result.x)
 
 def onBackslash(result):
-    result['isEscaping'] = True
+    result.isEscaping = True
 
 def afterBackslash(result):
-    result['isEscaping'] = False
+    result.isEscaping = False
 
-    if result['ch'] == NEWLINE:
-        if result['isInCode']:
-            err = error(result, ERROR_EOL_BACKSLASH, result['lineNo'], result['x'] - 1)
+    if result.ch == NEWLINE:
+        if result.isInCode:
+            err = error(result, ERROR_EOL_BACKSLASH, result.lineNo, result.x - 1)
             raise ParinferError(err)
         onNewLine(result)
 
@@ -291,282 +452,639 @@ CHAR_DISPATCH = {
     NEWLINE: onNewLine,
 }
 
-def onChar(result):
-    ch = result['ch']
+# the handlers in strings and comments
+NON_CODE_DISPATCH = {
+    DOUBLE_QUOTE: onQuote,
+    BACKSLASH: onBackslash,
+    NEWLINE: onNewLine,
+}
 
-    if result['isEscaping']:
+def onChar(result):
+    if result.isEscaping:
         afterBackslash(result)
     else:
-        charFn = CHAR_DISPATCH.get(ch, None)
+        if result.isInCode:
+            charFn = CHAR_DISPATCH.get(result.ch)
+        else:
+            charFn = NON_CODE_DISPATCH.get(result.ch)
         if charFn is not None:
             charFn(result)
 
-    result['isInCode'] = (not result['isInComment'] and not result['isInStr'])
-
 #-------------------------------------------------------------------------------
 # Cursor Functions
 #-------------------------------------------------------------------------------
 
 def isCursorOnLeft(result):
-    return (result['lineNo'] == result['cursorLine'] and
-            result['cursorX'] is not None and
-            result['cursorX'] <= result['x'])
+    return (result.lineNo == result.cursorLine and
+            result.cursorX is not None and
+            result.cursorX <= result.x)
 
 def isCursorOnRight(result, x):
-    return (result['lineNo'] == result['cursorLine'] and
-            result['cursorX'] is not None and
+    return (result.lineNo == result.cursorLine and
+            result.cursorX is not None and
             x is not None and
-            result['cursorX'] > x)
+            result.cursorX > x)
 
 def isCursorInComment(result):
-    return isCursorOnRight(result, result['commentX'])
+    return isCursorOnRight(result, result.commentX)
 
 def handleCursorDelta(result):
-    hasCursorDelta = (result['cursorDx'] is not None and
-                      result['cursorLine'] == result['lineNo'] and
-                      result['cursorX'] == result['x'])
+    hasCursorDelta = (result.cursorDx is not None and
+                      result.cursorLine == result.lineNo and
+                      result.cursorX == result.x)
 
     if hasCursorDelta:
-        result['indentDelta'] = result['indentDelta'] + result['cursorDx']
+        result.indentDelta = result.indentDelta + result.cursorDx
 
 #-------------------------------------------------------------------------------
 # Paren Trail Functions
 #-------------------------------------------------------------------------------
 
 def updateParenTrailBounds(result):
-    line = result['lines'][result['lineNo']]
-    prevCh = None
-    if result['x'] > 0:
-        prevCh = line[result['x'] - 1]
-    ch = result['ch']
+    ch = result.ch
 
-    shouldReset = (result['isInCode'] and
+    shouldReset = (result.isInCode and
                    ch != "" and
                    ch not in CLOSE_PARENS and
-                   (ch != BLANK_SPACE or prevCh == BACKSLASH) and
+                   (ch != BLANK_SPACE or prevChar(result) == BACKSLASH) and
                    ch != DOUBLE_SPACE)
 
     if shouldReset:
-        result['parenTrail']['lineNo'] = result['lineNo']
-        result['parenTrail']['startX'] = result['x'] + 1
-        result['parenTrail']['endX'] = result['x'] + 1
-        result['parenTrail']['openers'] = []
-        result['maxIndent'] = None
+        resetParenTrail(result, result.lineNo, result.x + 1)
+
+def resetParenTrail(result, lineNo, x):
+    result.parenTrail.lineNo = lineNo
+    result.parenTrail.startX = x
+    result.parenTrail.endX = x
+    result.parenTrail.openers.clear()
+    result.maxIndent = None
 
 def clampParenTrailToCursor(result):
-    startX = result['parenTrail']['startX']
-    endX = result['parenTrail']['endX']
+    startX = result.parenTrail.startX
+    endX = result.parenTrail.endX
 
     isCursorClamping = (isCursorOnRight(result, startX) and
                         not isCursorInComment(result))
 
     if isCursorClamping:
-        newStartX = max(startX, result['cursorX'])
-        newEndX = max(endX, result['cursorX'])
+        newStartX = max(startX, result.cursorX)
+        newEndX = max(endX, result.cursorX)
 
-        line = result['lines'][result['lineNo']]
+        # earlier corrections on this line may have shortened it
+        line = result.lines[result.lineNo]
         removeCount = 0
-        for i in range(startX, newStartX):
+        for i in range(startX, min(newStartX, len(line))):
             if line[i] in CLOSE_PARENS:
                 removeCount = removeCount + 1
 
-        for i in range(removeCount):
-            result['parenTrail']['openers'].pop(0)
-        result['parenTrail']['startX'] = newStartX
-        result['parenTrail']['endX'] = newEndX
+        openers = result.parenTrail.openers
+        for i in range(min(removeCount, len(openers))):
+            openers.popleft()
+        result.parenTrail.startX = newStartX
+        result.parenTrail.endX = newEndX
 
 def removeParenTrail(result):
-    startX = result['parenTrail']['startX']
-    endX = result['parenTrail']['endX']
+    startX = result.parenTrail.startX
+    endX = result.parenTrail.endX
 
     if startX == endX:
         return
 
-    openers = result['parenTrail']['openers']
-    while len(openers) != 0:
-        result['parenStack'].append(openers.pop())
+    openers = result.parenTrail.openers
+    if result.outline is not None and len(openers) != 0:
+        del result.outline[-1][-len(openers):]
+    result.parenStack.extend(reversed(openers))
+    openers.clear()
 
-    removeWithinLine(result, result['lineNo'], startX, endX)
+    removeWithinLine(result, result.lineNo, startX, endX)
 
 def correctParenTrail(result, indentX):
-    parens = ""
+    parens = []
 
-    while len(result['parenStack']) > 0:
-        opener = peek(result['parenStack'])
-        if opener['x'] >= indentX:
-            result['parenStack'].pop()
-            parens = parens + PARENS[opener['ch']]
-        else:
-            break
+    parenStack = result.parenStack
+    while len(parenStack) > 0 and parenStack[-1][OPENER_X] >= indentX:
+        opener = parenStack.pop()
+        if result.outline is not None:
+            addTrailPair(result, opener, result.parenTrail.startX, len(parens))
+        parens.append(PARENS[opener[OPENER_CH]])
 
-    insertWithinLine(result, result['parenTrail']['lineNo'], result['parenTrail']['startX'], parens)
+    insertWithinLine(result, result.parenTrail.lineNo, result.parenTrail.startX, "".join(parens))
 
 def cleanParenTrail(result):
-    startX = result['parenTrail']['startX']
-    endX = result['parenTrail']['endX']
+    startX = result.parenTrail.startX
+    endX = result.parenTrail.endX
 
-    if (startX == endX or result['lineNo'] != result['parenTrail']['lineNo']):
+    if (startX == endX or result.lineNo != result.parenTrail.lineNo):
         return
 
-    line = result['lines'][result['lineNo']]
-    newTrail = ""
-    spaceCount = 0
-    for i in range(startX, endX):
-        if line[i] in CLOSE_PARENS:
-            newTrail = newTrail + line[i]
-        else:
-            spaceCount = spaceCount + 1
+    line = result.lines[result.lineNo]
+    newTrail = "".join([c for c in line[startX:endX] if c in CLOSE_PARENS])
+    spaceCount = endX - startX - len(newTrail)
 
     if spaceCount > 0:
-        replaceWithinLine(result, result['lineNo'], startX, endX, newTrail)
-        result['parenTrail']['endX'] = result['parenTrail']['endX'] - spaceCount
-
-def appendParenTrail(result):
-    opener = result['parenStack'].pop()
-    closeCh = PARENS[opener['ch']]
+        replaceWithinLine(result, result.lineNo, startX, endX, newTrail)
+        result.parenTrail.endX = result.parenTrail.endX - spaceCount
+        if result.outline is not None:
+            moveTrailPairs(result)
 
-    result['maxIndent'] = opener['x']
-    insertWithinLine(result, result['parenTrail']['lineNo'], result['parenTrail']['endX'], closeCh)
-    result['parenTrail']['endX'] = result['parenTrail']['endX'] + 1
+# NOTE: The leading close-parens of a line are appended to the paren trail of
+#       an earlier line, one at a time. They are collected in
+#       result.trailAppend, as (lineNo, x, closers), and finishLine inserts
+#       them at once, so that a long run of them does not copy the trail line
+#       for each one. Nothing reads that line before the current one ends.
 
-def finishNewParenTrail(result):
-    if result['mode'] == INDENT_MODE:
-        clampParenTrailToCursor(result)
-        removeParenTrail(result)
-    elif result['mode'] == PAREN_MODE:
-        if result['lineNo'] != result['cursorLine']:
-            cleanParenTrail(result)
+def appendParenTrail(result):
+    opener = result.parenStack.pop()
+    closeCh = PARENS[opener[OPENER_CH]]
+
+    result.maxIndent = opener[OPENER_X]
+    if result.trailAppend is None:
+        result.trailAppend = (result.parenTrail.lineNo, result.parenTrail.endX, [])
+    closers = result.trailAppend[2]
+    if result.outline is not None:
+        addTrailPair(result, opener, result.trailAppend[1], len(closers))
+    closers.append(closeCh)
+    result.parenTrail.endX = result.parenTrail.endX + 1
 
 #-------------------------------------------------------------------------------
 # Indentation functions
 #-------------------------------------------------------------------------------
 
 def correctIndent(result):
-    origIndent = result['x']
+    origIndent = result.x
     newIndent = origIndent
     minIndent = 0
-    maxIndent = result['maxIndent']
+    maxIndent = result.maxIndent
 
-    opener = peek(result['parenStack'])
+    opener = peek(result.parenStack)
     if opener is not None:
-        minIndent = opener['x'] + 1
-        newIndent = newIndent + opener['indentDelta']
+        minIndent = opener[OPENER_X] + 1
+        newIndent = newIndent + opener[OPENER_INDENT_DELTA]
 
     newIndent = clamp(newIndent, minIndent, maxIndent)
 
     if newIndent != origIndent:
+        # the output so far is only the indentation
         indentStr = repeatString(BLANK_SPACE, newIndent)
-        replaceWithinLine(result, result['lineNo'], 0, origIndent, indentStr)
-        result['x'] = newIndent
-        result['indentDelta'] = result['indentDelta'] + newIndent - origIndent
+        result.lineBuffer = [indentStr] if newIndent != 0 else []
+        result.x = newIndent
+        result.indentDelta = result.indentDelta + newIndent - origIndent
+
+# NOTE: The mode only decides what happens at the indentation point, so each
+#       mode has its own onIndent, which its line processor passes down to
+#       processIndentation and processChar: no handler checks the mode.
 
 def onProperIndent(result):
-    result['trackingIndent'] = False
+    result.trackingIndent = False
 
-    if result['quoteDanger']:
+    if result.quoteDanger:
         err = error(result, ERROR_QUOTE_DANGER, None, None)
         raise ParinferError(err)
 
-    if result['mode'] == INDENT_MODE:
-        correctParenTrail(result, result['x'])
-    elif result['mode'] == PAREN_MODE:
-        correctIndent(result)
+def onIndentModeProperIndent(result):
+    onProperIndent(result)
+    correctParenTrail(result, result.x)
+
+def onParenModeProperIndent(result):
+    onProperIndent(result)
+    correctIndent(result)
 
 def onLeadingCloseParen(result):
-    result['skipChar'] = True
-    result['trackingIndent'] = True
-
-    if result['mode'] == PAREN_MODE:
-        if isValidCloseParen(result['parenStack'], result['ch']):
-            if isCursorOnLeft(result):
-                result['skipChar'] = False
-                onProperIndent(result)
-            else:
-                appendParenTrail(result)
+    result.skipChar = True
+    result.trackingIndent = True
+
+def onParenModeLeadingCloseParen(result):
+    onLeadingCloseParen(result)
+    if isValidCloseParen(result.parenStack, result.ch):
+        if isCursorOnLeft(result):
+            result.skipChar = False
+            onParenModeProperIndent(result)
+        else:
+            appendParenTrail(result)
 
-def onIndent(result):
-    if result['ch'] in CLOSE_PARENS:
+def onIndentModeIndent(result):
+    if result.ch in CLOSE_PARENS:
         onLeadingCloseParen(result)
-    elif result['ch'] == SEMICOLON:
+    elif result.ch == SEMICOLON:
         # comments don't count as indentation points
-        result['trackingIndent'] = False
-    elif result['ch'] != NEWLINE:
-        onProperIndent(result)
+        result.trackingIndent = False
+    elif result.ch != NEWLINE:
+        onIndentModeProperIndent(result)
+
+def onParenModeIndent(result):
+    if result.ch in CLOSE_PARENS:
+        onParenModeLeadingCloseParen(result)
+    elif result.ch == SEMICOLON:
+        result.trackingIndent = False
+    elif result.ch != NEWLINE:
+        onParenModeProperIndent(result)
 
 #-------------------------------------------------------------------------------
-# High-level processing functions
+# Pre-scan
 #-------------------------------------------------------------------------------
 
-def processChar(result, ch):
-    origCh = ch
+# NOTE: With the prescan option, the positions of the chars that have an entry
+#       in CHAR_DISPATCH are found for all the lines at once, with NumPy when
+#       it is installed, and the line processors go from one to the next
+#       instead of searching each line for them.
+#
+#       NumPy takes about 250 ms to import, four times as long as the rest of
+#       this module, so it is only imported by the first pre-scan.
+
+numpy = None
+DISPATCH_CODES = None
+numpyImported = False
+
+def importNumpy():
+    """Returns the numpy module, or None when NumPy is not installed. It is
+    imported on the first call."""
+    global numpy, DISPATCH_CODES, numpyImported
+    if not numpyImported:
+        numpyImported = True
+        try:
+            import numpy as module
+        except ImportError:
+            return None
+        DISPATCH_CODES = module.array([ord(ch) for ch in DISPATCH_CHARS], dtype=module.uint32)
+        numpy = module
+    return numpy
+
+def scanLinesRegex(lines):
+    xs = []
+    bounds = [0]
+    for line in lines:
+        xs.extend([match.start() for match in DISPATCH_CHARS_REGEX.finditer(line)])
+        bounds.append(len(xs))
+    return xs, bounds
+
+def scanLinesNumpy(lines):
+    if not lines:
+        return [], [0]
+    return scanTextNumpy(NEWLINE.join(lines))[:2]
+
+def scanTextNumpy(text):
+    """Returns (xs, bounds, hasCR) for the lines of text split at NEWLINE,
+    (xs, bounds) being scanLines of them, and hasCR whether text has a CR
+    char."""
+    numpy = importNumpy()
+    if text.isascii():
+        codes = numpy.frombuffer(text.encode('ascii'), dtype=numpy.uint8)
+    else:
+        # one code point per char, so that positions are str indexes, and
+        # lone surrogates (from surrogateescape) are code points like others
+        codes = numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=numpy.uint32)
+    positions = numpy.flatnonzero(numpy.isin(codes, DISPATCH_CODES))
+    newlines = numpy.flatnonzero(codes == ord(NEWLINE))
+    lineStarts = numpy.concatenate(([0], newlines + 1))
+    xs = positions - lineStarts[numpy.searchsorted(newlines, positions)]
+    bounds = numpy.searchsorted(positions, lineStarts)
+    hasCR = bool((codes == ord("\r")).any())
+    return xs.tolist(), bounds.tolist() + [len(positions)], hasCR
+
+def scanLines(lines):
+    """Returns (xs, bounds), where xs[bounds[i]:bounds[i + 1]] are the
+    positions of the chars of lines[i] that are in DISPATCH_CHARS."""
+    if importNumpy() is not None:
+        return scanLinesNumpy(lines)
+    return scanLinesRegex(lines)
+
+def rescanLines(lines, scan, lineNos):
+    """Returns scanLines(lines), where scan is scanLines of the same lines
+    but for the line numbers in lineNos. Only those lines are searched."""
+    xs, bounds = scan
+    newXs = []
+    newBounds = [0]
+    start = 0
+    for lineNo in sorted(lineNos) + [len(lines)]:
+        # the lines in [start, lineNo) are the same
+        offset = len(newXs) - bounds[start]
+        newXs.extend(xs[bounds[start]:bounds[lineNo]])
+        newBounds.extend([bound + offset for bound in bounds[start + 1:lineNo + 1]])
+        if lineNo == len(lines):
+            break
+        newXs.extend([match.start() for match in DISPATCH_CHARS_REGEX.finditer(lines[lineNo])])
+        newBounds.append(len(newXs))
+        start = lineNo + 1
+    return newXs, newBounds
+
+def lexText(text):
+    """Returns (lines, lineEnding, scan), as splitLines(text) and scanLines
+    of its lines would, in one pass over the chars: the CR chars, which set
+    the line ending (see getLineEnding), are looked for along with the
+    chars to dispatch. The text is split at NEWLINE, and the CR chars before
+    a NEWLINE are then cut off their lines, which moves none of the
+    positions."""
+    lines = text.split(NEWLINE)
+    if importNumpy() is not None:
+        xs, bounds, hasCR = scanTextNumpy(text)
+    else:
+        xs = []
+        bounds = [0]
+        hasCR = False
+        for line in lines:
+            xs.extend([match.start() for match in DISPATCH_CHARS_REGEX.finditer(line)])
+            bounds.append(len(xs))
+            if not hasCR and "\r" in line:
+                hasCR = True
+    if not hasCR:
+        return lines, NEWLINE, (xs, bounds)
+    for i in range(len(lines) - 1):
+        if lines[i].endswith("\r"):
+            lines[i] = lines[i][:-1]
+    return lines, "\r\n", (xs, bounds)
+
+class LexedText(object):
+    """A text split into lines, with the positions of the chars of each line
+    that are in DISPATCH_CHARS. indent_mode() and paren_mode() take it in
+    place of the text, and process it without splitting the text or
+    searching its lines again, so one LexedText serves both modes."""
+    __slots__ = ('text', 'lines', 'lineEnding', 'scan')
+
+    def __init__(self, text):
+        self.text = text
+        self.lines, self.lineEnding, self.scan = lexText(text)
 
-    result['ch'] = ch
-    result['skipChar'] = False
+#-------------------------------------------------------------------------------
+# High-level processing functions
+#-------------------------------------------------------------------------------
 
-    if result['mode'] == PAREN_MODE:
-        handleCursorDelta(result)
+# NOTE: A line is processed in two phases. While the indentation is tracked,
+#       each char goes through processChar, which finds the indentation
+#       point. The rest of the line is then cut into runs of chars that have
+#       no handler in the current state (code, or string and comment), which
+#       are committed in one step, and the chars between them, which go
+#       through processBodyChar. The mode only picks the line processor, which
+#       passes its onIndent down.
+
+def processChar(result, ch, onIndent):
+    result.ch = ch
+    result.skipChar = False
 
-    if result['trackingIndent'] and ch != BLANK_SPACE and ch != TAB:
+    if result.trackingIndent and ch != BLANK_SPACE and ch != TAB:
         onIndent(result)
 
-    if result['skipChar']:
-        result['ch'] = ""
+    if result.skipChar:
+        copyLine(result)
+        result.ch = ""
     else:
         onChar(result)
         updateParenTrailBounds(result)
 
-    commitChar(result, origCh)
+    commitChar(result)
+
+def processBodyChar(result, ch):
+    """Does what processChar does, for a char past the indentation point."""
+    result.ch = ch
+    onChar(result)
+    updateParenTrailBounds(result)
+    commitChar(result)
+
+def processRun(result, line, start, end):
+    """Processes line[start:end], a run of chars past the indentation point
+    that have no handler in the current state. Gives the same result as
+    calling processBodyChar on each of them: only the last char that is not
+    a blank space can reset the paren trail, or a leading blank space right
+    after an escaped backslash."""
+    if result.isInCode:
+        lastX = len(line[start:end].rstrip(BLANK_SPACE)) - 1
+        if lastX != -1:
+            resetParenTrail(result, result.lineNo, result.x + lastX + 1)
+        elif prevChar(result) == BACKSLASH:
+            resetParenTrail(result, result.lineNo, result.x + 1)
+
+    commitRun(result, line, start, end)
+
+def processIndentation(result, line, onIndent):
+    """Processes the start of line while the indentation is tracked: blank
+    spaces, tabs, leading close-parens and the char at the indentation point,
+    which go to onIndent. Returns the index of the first char left."""
+    x = 0
+    end = len(line)
+    while x < end and result.trackingIndent:
+        if line[x] == BLANK_SPACE:
+            spacesEnd = x + 1
+            while spacesEnd < end and line[spacesEnd] == BLANK_SPACE:
+                spacesEnd = spacesEnd + 1
+            commitRun(result, line, x, spacesEnd)
+            x = spacesEnd
+        else:
+            processChar(result, line[x], onIndent)
+            x = x + 1
+    return x
+
+def processScannedLineBody(result, line, start, xs):
+    """Does what processLineBody does, with the positions xs of the chars of
+    line that are in DISPATCH_CHARS, from scanLines."""
+    end = len(line)
+    for x in xs:
+        if result.isEscaping and start < end:
+            processBodyChar(result, line[start])
+            start = start + 1
+        if x < start:
+            continue
+        ch = line[x]
+        if not result.isInCode and ch not in NON_CODE_DISPATCH:
+            continue
+        if start != x:
+            processRun(result, line, start, x)
+        processBodyChar(result, ch)
+        start = x + 1
+
+    if result.isEscaping and start < end:
+        processBodyChar(result, line[start])
+        start = start + 1
+    if start < end:
+        processRun(result, line, start, end)
+
+def processLineBody(result, line, start, xs=None):
+    if xs is not None:
+        processScannedLineBody(result, line, start, xs)
+        return
+
+    end = len(line)
+    while start < end:
+        if result.isEscaping:
+            processBodyChar(result, line[start])
+            start = start + 1
+            continue
 
-def processLine(result, line):
+        if result.isInCode:
+            match = DISPATCH_CHARS_REGEX.search(line, start)
+        else:
+            match = NON_CODE_CHARS_REGEX.search(line, start)
+        if match is None:
+            processRun(result, line, start, end)
+            return
+        x = match.start()
+        if start != x:
+            processRun(result, line, start, x)
+        processBodyChar(result, line[x])
+        start = x + 1
+
+def processIndentModeLine(result, line, xs=None):
     initLine(result, line)
 
-    if result['mode'] == INDENT_MODE:
-        result['trackingIndent'] = (len(result['parenStack']) != 0 and
-                                    not result['isInStr'])
-    elif result['mode'] == PAREN_MODE:
-        result['trackingIndent'] = not result['isInStr']
+    start = 0
+    result.trackingIndent = len(result.parenStack) != 0 and not result.isInStr
+    if result.trackingIndent:
+        start = processIndentation(result, line, onIndentModeIndent)
+    processLineBody(result, line, start, xs)
+    processBodyChar(result, NEWLINE)
+    finishLine(result)
 
-    chars = line + NEWLINE
-    for c in chars:
-        processChar(result, c)
+    if result.lineNo == result.parenTrail.lineNo:
+        clampParenTrailToCursor(result)
+        removeParenTrail(result)
 
-    if result['lineNo'] == result['parenTrail']['lineNo']:
-        finishNewParenTrail(result)
+def processParenModeLine(result, line, xs=None):
+    initLine(result, line)
 
-def finalizeResult(result):
-    if result['quoteDanger']:
+    result.trackingIndent = not result.isInStr
+    if result.cursorDx is not None and result.lineNo == result.cursorLine:
+        # the cursor delta applies at an exact x position
+        for c in line:
+            handleCursorDelta(result)
+            processChar(result, c, onParenModeIndent)
+        handleCursorDelta(result)
+    else:
+        start = 0
+        if result.trackingIndent:
+            start = processIndentation(result, line, onParenModeIndent)
+        processLineBody(result, line, start, xs)
+    processBodyChar(result, NEWLINE)
+    finishLine(result)
+
+    if result.lineNo == result.parenTrail.lineNo and result.lineNo != result.cursorLine:
+        cleanParenTrail(result)
+
+LINE_PROCESSORS = {
+    INDENT_MODE: processIndentModeLine,
+    PAREN_MODE: processParenModeLine,
+}
+
+def processLine(result, line, xs=None):
+    LINE_PROCESSORS[result.mode](result, line, xs)
+
+def finalizeStrings(result):
+    if result.quoteDanger:
         err = error(result, ERROR_QUOTE_DANGER, None, None)
         raise ParinferError(err)
 
-    if result['isInStr']:
+    if result.isInStr:
         err = error(result, ERROR_UNCLOSED_QUOTE, None, None)
         raise ParinferError(err)
 
-    if len(result['parenStack']) != 0:
-        if result['mode'] == PAREN_MODE:
-            opener = peek(result['parenStack'])
-            err = error(result, ERROR_UNCLOSED_PAREN, opener['lineNo'], opener['x'])
-            raise ParinferError(err)
-        elif result['mode'] == INDENT_MODE:
-            correctParenTrail(result, 0)
+    if result.outline is not None:
+        result.outline.append(None)
 
-    result['success'] = True
+def finalizeIndentModeResult(result):
+    finalizeStrings(result)
+    if len(result.parenStack) != 0:
+        correctParenTrail(result, 0)
+    result.success = True
+
+def finalizeParenModeResult(result):
+    finalizeStrings(result)
+    if len(result.parenStack) != 0:
+        opener = peek(result.parenStack)
+        err = error(result, ERROR_UNCLOSED_PAREN, opener[OPENER_LINE_NO], opener[OPENER_X])
+        raise ParinferError(err)
+    result.success = True
+
+FINALIZERS = {
+    INDENT_MODE: finalizeIndentModeResult,
+    PAREN_MODE: finalizeParenModeResult,
+}
+
+def finalizeResult(result):
+    FINALIZERS[result.mode](result)
 
 def processError(result, e):
-    result['success'] = False
+    result.success = False
     if e['parinferError']:
         del e['parinferError']
-        result['error'] = e
+        result.error = e
     else:
-        result['error']['name'] = ERROR_UNHANDLED
-        result['error']['message'] = e['stack']
+        result.error['name'] = ERROR_UNHANDLED
+        result.error['message'] = e['stack']
+
+# NOTE: With a 'timeBudget' (in seconds) or a 'lineBudget' (in lines) option,
+#       the budget is checked between lines, and a run that uses it up stops
+#       at the next line boundary. The result is left as it is there, marked
+#       incomplete, and the public functions return it in a PartialRun that
+#       resume() continues. At least one line is processed per call, so that
+#       resuming always gets to the end. Only indent_mode(), paren_mode(),
+#       process_lines() and process_bytes() take a budget: the caches, the
+#       incremental processors, the batch functions and stats runs always
+#       process the whole text.
+
+def getBudget(options):
+    """Returns (deadline, maxLines) for the budget options, or None."""
+    if not isinstance(options, dict):
+        return None
+    timeBudget = options.get('timeBudget')
+    lineBudget = options.get('lineBudget')
+    if timeBudget is None and lineBudget is None:
+        return None
+    deadline = None
+    if timeBudget is not None:
+        deadline = time.perf_counter() + timeBudget
+    return deadline, lineBudget
+
+def processTextWithin(result, budget):
+    """Processes the lines of result from the next one and finalizes it, or
+    leaves it incomplete at a line boundary when budget runs out first."""
+    deadline, maxLines = budget
+    processModeLine = LINE_PROCESSORS[result.mode]
+    lines = result.origLines
+    scan = result.scan
+    lineNo = result.lineNo + 1
+    end = len(lines)
+    if maxLines is not None:
+        end = min(end, lineNo + max(1, maxLines))
+
+    result.incomplete = False
+    try:
+        while lineNo < end:
+            if scan is not None:
+                xs, bounds = scan
+                processModeLine(result, lines[lineNo], xs[bounds[lineNo]:bounds[lineNo + 1]])
+            else:
+                processModeLine(result, lines[lineNo])
+            lineNo = lineNo + 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        if lineNo < len(lines):
+            result.incomplete = True
+            return
+        finalizeResult(result)
+    except ParinferError as e:
+        errorDetails = e.args[0]
+        processError(result, errorDetails)
+
+def processText(text, options, mode, origLines=None, scan=None, budget=None):
+    """Processes text, or origLines when given. scan can be scanLines of the
+    lines, from a LexedText for example. budget is getBudget of the options
+    when the run may stop early; the budget options are ignored otherwise."""
+    result = initialResult(text, options, mode, origLines)
+    processModeLine = LINE_PROCESSORS[mode]
 
-def processText(text, options, mode):
-    result = initialResult(text, options, mode)
+    if scan is None and isinstance(options, dict) and options.get('prescan'):
+        scan = scanLines(result.origLines)
+
+    if budget is not None:
+        result.scan = scan
+        processTextWithin(result, budget)
+        return result
 
     try:
-        for line in result['origLines']:
-            processLine(result, line)
+        if scan is not None:
+            xs, bounds = scan
+            for i, line in enumerate(result.origLines):
+                processModeLine(result, line, xs[bounds[i]:bounds[i + 1]])
+        else:
+            for line in result.origLines:
+                processModeLine(result, line)
         finalizeResult(result)
     except ParinferError as e:
         errorDetails = e.args[0]
@@ -574,43 +1092,1880 @@ def processText(text, options, mode):
 
     return result
 
+#-------------------------------------------------------------------------------
+# Outline
+#-------------------------------------------------------------------------------
+
+class Outline(object):
+    """The forms of a processed text, made of its matched pairs of parens,
+    in arrays. Form i is the one with the i-th open-paren of the text.
+    Positions are (lineNo, x) in the output, and the queries take O(log n)
+    for n forms."""
+    __slots__ = ('openLines', 'openXs', 'closeLines', 'closeXs', 'parents',
+                 'parenLines', 'parenXs', 'parenForms')
+
+    def __init__(self, entries):
+        """entries is result.outline, with an entry for each line and one
+        past the last line."""
+        pairs = []
+        for lineNo, entry in enumerate(entries):
+            if entry is not None:
+                for openOffset, openX, closeOffset, closeX in entry:
+                    pairs.append((lineNo - openOffset, openX, lineNo - closeOffset, closeX))
+        pairs.sort()
+
+        # every paren in text order, with its form (~i for a close-paren)
+        parens = []
+        for i, (openLine, openX, closeLine, closeX) in enumerate(pairs):
+            parens.append((openLine, openX, i))
+            parens.append((closeLine, closeX, ~i))
+        parens.sort()
+
+        self.openLines = array('l', [pair[0] for pair in pairs])
+        self.openXs = array('l', [pair[1] for pair in pairs])
+        self.closeLines = array('l', [pair[2] for pair in pairs])
+        self.closeXs = array('l', [pair[3] for pair in pairs])
+        self.parenLines = array('l', [paren[0] for paren in parens])
+        self.parenXs = array('l', [paren[1] for paren in parens])
+        self.parenForms = array('l', [paren[2] for paren in parens])
+
+        self.parents = array('l', [-1]) * len(pairs)
+        stack = [-1]
+        for form in self.parenForms:
+            if form >= 0:
+                self.parents[form] = stack[-1]
+                stack.append(form)
+            else:
+                stack.pop()
+
+    def __len__(self):
+        return len(self.openLines)
+
+    def form(self, i):
+        """Returns the positions of the open- and close-paren of form i."""
+        return (self.openLines[i], self.openXs[i]), (self.closeLines[i], self.closeXs[i])
+
+    def parent(self, i):
+        """Returns the form that holds form i, or None at the top level."""
+        parent = self.parents[i]
+        return None if parent == -1 else parent
+
+    def lastParen(self, lineNo, x):
+        """Returns the index of the last paren at or before (lineNo, x), or
+        -1."""
+        start = bisect_left(self.parenLines, lineNo)
+        end = bisect_right(self.parenLines, lineNo, start)
+        return bisect_right(self.parenXs, x, start, end) - 1
+
+    def innermost(self, lineNo, x):
+        """Returns the innermost form that holds (lineNo, x), its parens
+        included, or None."""
+        k = self.lastParen(lineNo, x)
+        if k == -1:
+            return None
+        form = self.parenForms[k]
+        if form >= 0:
+            return form
+        if self.parenLines[k] == lineNo and self.parenXs[k] == x:
+            return ~form
+        return self.parent(~form)
+
+    def matching(self, lineNo, x):
+        """Returns the position of the paren that matches the one at
+        (lineNo, x), or None when there is no matched paren there."""
+        k = self.lastParen(lineNo, x)
+        if k == -1 or self.parenLines[k] != lineNo or self.parenXs[k] != x:
+            return None
+        form = self.parenForms[k]
+        if form >= 0:
+            return self.closeLines[form], self.closeXs[form]
+        return self.openLines[~form], self.openXs[~form]
+
 #-------------------------------------------------------------------------------
 # Public API Helpers
 #-------------------------------------------------------------------------------
 
+def changedLineNos(result):
+    """Returns the numbers of the lines that changed, in order."""
+    if result.dirtyLines is None:
+        lineNos = range(len(result.lines))
+    else:
+        # a line can be written back to what it was
+        lineNos = sorted(result.dirtyLines)
+    return [i for i in lineNos if result.lines[i] != result.origLines[i]]
+
 def getChangedLines(result):
     changedLines = []
-    for i in range(len(result['lines'])):
-        if result['lines'][i] != result['origLines'][i]:
-            changedLines.append({
-                'lineNo': i,
-                'line': result['lines'][i],
-            })
+    for i in changedLineNos(result):
+        changedLines.append({
+            'lineNo': i,
+            'line': result.lines[i],
+        })
     return changedLines
 
+class PartialRun(object):
+    """A run that stopped when its budget ran out, as returned in 'resume'.
+    See resume()."""
+    __slots__ = ('result', 'publish')
+
+    def __init__(self, result, publish):
+        self.result = result
+        self.publish = publish
+
+def incompleteResult(result, out, publish):
+    out['success'] = False
+    out['incomplete'] = True
+    out['lineNo'] = result.lineNo + 1
+    out['resume'] = PartialRun(result, publish)
+    return out
+
+def isOutlined(options):
+    return isinstance(options, dict) and bool(options.get('outline'))
+
+def joinOutline(entries, formEntries):
+    """Appends the outline entries of a form to the entries of the forms
+    before it. The entry past the end of those is the first line of the
+    form, so the two are merged."""
+    if len(entries) == 0:
+        entries.extend(formEntries)
+        return
+    last = entries.pop()
+    first = formEntries[0]
+    if last is None:
+        entries.append(first)
+    elif first is None:
+        entries.append(last)
+    else:
+        entries.append(last + first)
+    entries.extend(formEntries[1:])
+
+def addOutline(result, out):
+    if result.outline is not None:
+        out['outline'] = Outline(result.outline)
+    return out
+
 def publicResult(result):
-    if not result['success']:
+    if result.incomplete:
+        return incompleteResult(result, {'text': result.origText}, publicResult)
+    if not result.success:
         return {
-            'text': result['origText'],
+            'text': result.origText,
             'success': False,
-            'error': result['error'],
+            'error': result.error,
         }
 
-    lineEnding = getLineEnding(result['origText'])
-    return {
-        'text': lineEnding.join(result['lines']),
+    lineEnding = result.lineEnding
+    if lineEnding is None:
+        lineEnding = getLineEnding(result.origText)
+    return addOutline(result, {
+        'text': lineEnding.join(result.lines),
         'success': True,
         'changedLines': getChangedLines(result),
+    })
+
+def publicChangesResult(result):
+    """Returns the result without the text, for the callers of the
+    processors that only take the changed lines."""
+    if not result.success:
+        return {
+            'success': False,
+            'error': result.error,
+        }
+
+    return addOutline(result, {
+        'success': True,
+        'changedLines': getChangedLines(result),
+    })
+
+def publicLinesResult(result):
+    if result.incomplete:
+        return incompleteResult(result, {'lines': result.origLines}, publicLinesResult)
+    if not result.success:
+        return {
+            'lines': result.origLines,
+            'success': False,
+            'error': result.error,
+        }
+
+    return addOutline(result, {
+        'lines': result.lines,
+        'success': True,
+        'changedLines': getChangedLines(result),
+    })
+
+def publicBytesResult(result):
+    if result.incomplete:
+        return incompleteResult(result, {'text': result.origText.encode('utf-8')}, publicBytesResult)
+    out = publicResult(result)
+    if not result.success:
+        error = dict(out['error'])
+        error['byteX'] = None
+        if error['lineNo'] is not None and error['x'] is not None:
+            error['byteX'] = byteColumn(result.origLines[error['lineNo']], error['x'])
+        return {'text': result.origText.encode('utf-8'), 'success': False, 'error': error}
+
+    out['text'] = out['text'].encode('utf-8')
+    for changedLine in out['changedLines']:
+        changedLine['line'] = changedLine['line'].encode('utf-8')
+    return out
+
+def publicLinesEditsResult(result):
+    """publicLinesResult, with the edits of publicEditsResult in place of
+    the lines when the run succeeds."""
+    if result.incomplete:
+        return incompleteResult(result, {'lines': result.origLines}, publicLinesEditsResult)
+    if not result.success:
+        return publicLinesResult(result)
+    return publicEditsResult(result)
+
+def publicBytesEditsResult(result):
+    """publicBytesResult, with the edits of publicEditsResult in place of
+    the text when the run succeeds. The replacements are UTF-8 bytes, and
+    the edits also get their columns in bytes, as 'byteStart' and
+    'byteEnd'."""
+    if result.incomplete:
+        return incompleteResult(result, {'text': result.origText.encode('utf-8')},
+                                publicBytesEditsResult)
+    if not result.success:
+        return publicBytesResult(result)
+    out = publicEditsResult(result)
+    for edit in out['edits']:
+        line = result.origLines[edit['lineNo']]
+        edit['byteStart'] = byteColumn(line, edit['start'])
+        edit['byteEnd'] = byteColumn(line, edit['end'])
+        edit['replacement'] = edit['replacement'].encode('utf-8')
+    for changedLine in out['changedLines']:
+        changedLine['line'] = changedLine['line'].encode('utf-8')
+    return out
+
+# NOTE: With the {'edits': True} option, the result holds the changes as
+#       edits of the original lines, {'lineNo', 'start', 'end', 'replacement'},
+#       instead of the text. They are found in the changed lines only: Parinfer
+#       only inserts, removes and replaces blank spaces, tabs and close-parens,
+#       so the other chars of a line are the same, in the same order, before
+#       and after. They anchor the edits, which are the differences between
+#       them. process_lines, process_bytes, IncrementalProcessor,
+#       FormProcessor, the caches, process_many and process_parallel take the
+#       option too.
+
+# the chars that an edit can insert or remove
+EDITED_CHARS = frozenset([BLANK_SPACE, TAB, ')', ']', '}'])
+
+def lineEdits(lineNo, old, new, edits):
+    """Appends the edits that turn the line old into new to edits."""
+    i = 0
+    j = 0
+    while True:
+        while i < len(old) and j < len(new) and old[i] == new[j]:
+            i = i + 1
+            j = j + 1
+        if i == len(old) and j == len(new):
+            return
+
+        # the differing chars, up to the next anchor of each line
+        oldEnd = i
+        while oldEnd < len(old) and old[oldEnd] in EDITED_CHARS:
+            oldEnd = oldEnd + 1
+        newEnd = j
+        while newEnd < len(new) and new[newEnd] in EDITED_CHARS:
+            newEnd = newEnd + 1
+        if old[oldEnd:oldEnd + 1] != new[newEnd:newEnd + 1]:
+            # not an edit that Parinfer makes: replace the rest of the line
+            oldEnd = len(old)
+            newEnd = len(new)
+        start = oldEnd
+        while start > i and newEnd > j and old[start - 1] == new[newEnd - 1]:
+            start = start - 1
+            newEnd = newEnd - 1
+
+        edits.append({
+            'lineNo': lineNo,
+            'start': i,
+            'end': start,
+            'replacement': new[j:newEnd],
+        })
+        i = oldEnd
+        j = newEnd + (oldEnd - start)
+
+def publicEditsResult(result):
+    if result.incomplete:
+        return incompleteResult(result, {'text': result.origText}, publicEditsResult)
+    if not result.success:
+        return publicResult(result)
+
+    edits = []
+    changedLines = []
+    for i in changedLineNos(result):
+        lineEdits(i, result.origLines[i], result.lines[i], edits)
+        changedLines.append({
+            'lineNo': i,
+            'line': result.lines[i],
+        })
+    return addOutline(result, {
+        'success': True,
+        'edits': edits,
+        'changedLines': changedLines,
+    })
+
+def toEditsResult(out, origLines):
+    """Turns the successful result of origLines that a processor or a cache
+    put together into the one of publicEditsResult."""
+    edits = []
+    for line in out['changedLines']:
+        lineEdits(line['lineNo'], origLines[line['lineNo']], line['line'], edits)
+    out.pop('text', None)
+    out['edits'] = edits
+    return out
+
+def wantsEdits(options):
+    return isinstance(options, dict) and bool(options.get('edits'))
+
+def getPublisher(options):
+    if wantsEdits(options):
+        return publicEditsResult
+    return publicResult
+
+def byteColumn(line, x):
+    return len(line[:x].encode('utf-8'))
+
+def charColumn(line, byteX):
+    # a column inside a multi-byte char counts as the start of that char
+    return len(line.encode('utf-8')[:byteX].decode('utf-8', 'ignore'))
+
+#-------------------------------------------------------------------------------
+# Instrumentation
+#-------------------------------------------------------------------------------
+
+# NOTE: The {'stats': True} option runs a second copy of the engine, made of
+#       the same functions bound to globals where the functions below are
+#       wrapped to count their calls. The normal path is left as is, so it
+#       pays nothing for the counters.
+
+# counted functions, and the stats key they count into
+COUNTED_FUNCTIONS = {
+    'resetParenTrail': 'parenTrailResets',
+    'correctParenTrail': 'correctParenTrail',
+    'appendParenTrail': 'appendParenTrail',
+    'removeParenTrail': 'removeParenTrail',
+    'insertWithinLine': 'lineRewrites',
+    'replaceWithinLine': 'lineRewrites',
+    'removeWithinLine': 'lineRewrites',
+    'writeLineBuffer': 'lineRewrites',
+}
+
+instrumentedEngine = None
+
+def countCalls(fn, key):
+    def counted(result, *args):
+        result.stats[key] = result.stats[key] + 1
+        return fn(result, *args)
+    return counted
+
+def countDispatch(fn, name):
+    def counted(result):
+        stats = result.stats
+        stats['dispatch'][name] = stats['dispatch'].get(name, 0) + 1
+        fn(result)
+        if len(result.parenStack) > stats['maxParenDepth']:
+            stats['maxParenDepth'] = len(result.parenStack)
+    return counted
+
+# the module-level dicts of engine functions
+FUNCTION_TABLES = ('CHAR_DISPATCH', 'NON_CODE_DISPATCH', 'LINE_PROCESSORS', 'FINALIZERS')
+
+def countChars(fn):
+    def counted(result, line, xs=None):
+        result.stats['chars'] = result.stats['chars'] + len(line) + 1
+        fn(result, line, xs)
+        # removeParenTrail puts openers back on the stack at the end of a line
+        if len(result.parenStack) > result.stats['maxParenDepth']:
+            result.stats['maxParenDepth'] = len(result.parenStack)
+    return counted
+
+def getInstrumentedEngine():
+    """Returns the globals of the instrumented copy of the engine."""
+    global instrumentedEngine
+    if instrumentedEngine is not None:
+        return instrumentedEngine
+
+    engine = dict(globals())
+    for name, value in globals().items():
+        if isinstance(value, FunctionType) and value.__module__ == __name__:
+            engine[name] = FunctionType(value.__code__, engine, name,
+                                        value.__defaults__, value.__closure__)
+    for name, key in COUNTED_FUNCTIONS.items():
+        engine[name] = countCalls(engine[name], key)
+    engine['processLine'] = countChars(engine['processLine'])
+
+    # the tables of functions, like LINE_PROCESSORS, must call the copies
+    for name in FUNCTION_TABLES:
+        engine[name] = dict((key, engine[fn.__name__]) for key, fn in globals()[name].items())
+
+    counted = {}
+    for name in ('CHAR_DISPATCH', 'NON_CODE_DISPATCH'):
+        dispatch = {}
+        for ch, fn in engine[name].items():
+            if fn not in counted:
+                counted[fn] = countDispatch(fn, fn.__name__)
+            dispatch[ch] = counted[fn]
+        engine[name] = dispatch
+
+    instrumentedEngine = engine
+    return engine
+
+def newStats():
+    stats = {
+        'chars': 0,
+        'dispatch': {},
+        'maxParenDepth': 0,
+        'scanTime': 0.0,
+        'finalizeTime': 0.0,
+        'resultTime': 0.0,
     }
+    for key in COUNTED_FUNCTIONS.values():
+        stats[key] = 0
+    return stats
+
+def processTextWithStats(text, options, mode):
+    """Does what processText and the publisher of the options do, through
+    the instrumented engine, and adds the counters and phase timings to the
+    public result as 'stats'. text can be a LexedText, whose scan is used as
+    is. options['profiler'], if given, is enabled for the same time; it can
+    be anything with enable() and disable(), like cProfile.Profile.
+
+    A budgeted run would be resumed outside of the counters, so the budget
+    options raise a ValueError."""
+    if getBudget(options) is not None:
+        raise ValueError("the stats option does not support timeBudget or lineBudget")
+    engine = getInstrumentedEngine()
+    profiler = options.get('profiler')
+    scan = None
+    if isinstance(text, LexedText):
+        result = initialResult(text.text, options, mode, text.lines)
+        result.lineEnding = text.lineEnding
+        scan = text.scan
+    else:
+        result = initialResult(text, options, mode)
+    result.stats = stats = newStats()
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        start = time.perf_counter()
+        try:
+            if scan is None and options.get('prescan'):
+                scan = scanLines(result.origLines)
+            if scan is not None:
+                xs, bounds = scan
+                for i, line in enumerate(result.origLines):
+                    engine['processLine'](result, line, xs[bounds[i]:bounds[i + 1]])
+            else:
+                for line in result.origLines:
+                    engine['processLine'](result, line)
+            scanned = time.perf_counter()
+            engine['finalizeResult'](result)
+        except ParinferError as e:
+            scanned = time.perf_counter()
+            errorDetails = e.args[0]
+            processError(result, errorDetails)
+        finalized = time.perf_counter()
+        out = engine[getPublisher(options).__name__](result)
+        done = time.perf_counter()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+    stats['scanTime'] = scanned - start
+    stats['finalizeTime'] = finalized - scanned
+    stats['resultTime'] = done - finalized
+    out['stats'] = stats
+    return out
+
+def wantsStats(options):
+    return isinstance(options, dict) and (options.get('stats') or
+                                          options.get('profiler') is not None)
 
 #-------------------------------------------------------------------------------
 # Public API
 #-------------------------------------------------------------------------------
 
+def processLexed(lexed, options, mode):
+    result = processText(lexed.text, options, mode, lexed.lines, lexed.scan, getBudget(options))
+    result.lineEnding = lexed.lineEnding
+    return result
+
 def indent_mode(text, options):
-    result = processText(text, options, INDENT_MODE)
-    return publicResult(result)
+    if wantsStats(options):
+        return processTextWithStats(text, options, INDENT_MODE)
+    if isinstance(text, LexedText):
+        return getPublisher(options)(processLexed(text, options, INDENT_MODE))
+    result = processText(text, options, INDENT_MODE, budget=getBudget(options))
+    return getPublisher(options)(result)
 
 def paren_mode(text, options):
-    result = processText(text, options, PAREN_MODE)
-    return publicResult(result)
+    if wantsStats(options):
+        return processTextWithStats(text, options, PAREN_MODE)
+    if isinstance(text, LexedText):
+        return getPublisher(options)(processLexed(text, options, PAREN_MODE))
+    result = processText(text, options, PAREN_MODE, budget=getBudget(options))
+    return getPublisher(options)(result)
+
+def map_position(edits, lineNo, x):
+    """Returns where the position (lineNo, x) of the original text is after
+    edits, the 'edits' of a result, as (lineNo, x). Parinfer never adds or
+    removes lines, so only x can move. A position at the start of an edit
+    stays in front of it, and one inside an edit moves to the same offset
+    into its replacement, or to its end."""
+    newX = x
+    for edit in edits:
+        if edit['lineNo'] != lineNo or edit['start'] >= x:
+            continue
+        replaced = edit['end'] - edit['start']
+        inserted = len(edit['replacement'])
+        if x >= edit['end']:
+            newX = newX + inserted - replaced
+        else:
+            newX = newX - (x - edit['start']) + min(x - edit['start'], inserted)
+    return lineNo, newX
+
+def normalize(text):
+    """Runs paren mode on text, a string or a LexedText, then indent mode on
+    its output, and returns the result of indent_mode() for the final text,
+    with changedLines relative to text. The text is lexed once: the second
+    run only searches the lines that paren mode changed. 'stable' is True
+    when indent mode left the output of paren mode as it was."""
+    lexed = text if isinstance(text, LexedText) else LexedText(text)
+    paren = processLexed(lexed, None, PAREN_MODE)
+    if not paren.success:
+        return publicResult(paren)
+
+    scan = rescanLines(paren.lines, lexed.scan, paren.dirtyLines)
+    result = processText(lexed.text, None, INDENT_MODE, paren.lines, scan)
+    stable = result.success and len(changedLineNos(result)) == 0
+
+    # report against the original lines
+    result.origLines = lexed.lines
+    result.lineEnding = lexed.lineEnding
+    if result.dirtyLines is not None:
+        result.dirtyLines.update(paren.dirtyLines)
+    out = publicResult(result)
+    if result.success:
+        out['stable'] = stable
+    return out
+
+def process_lines(lines, mode, options=None):
+    """Processes a text given as a sequence of lines, without their line
+    endings, in INDENT_MODE or PAREN_MODE. Returns the result of
+    indent_mode() and paren_mode() with 'lines', the list of output lines
+    (or the lines given, on failure), instead of 'text'. Nothing is split or
+    joined. With the edits option, it has the 'edits' instead."""
+    result = processText(None, options, mode, lines, budget=getBudget(options))
+    if wantsEdits(options):
+        return publicLinesEditsResult(result)
+    return publicLinesResult(result)
+
+def process_bytes(data, mode, options=None):
+    """Processes UTF-8 encoded bytes in INDENT_MODE or PAREN_MODE. Returns
+    the result of indent_mode() and paren_mode() with the text and the
+    changed lines as UTF-8 bytes.
+
+    cursorX and the x of an error count chars, as in the rest of the API.
+    The cursor column can be given in bytes instead, as 'cursorByteX', and
+    an error also gets its column in bytes, as 'byteX'. With the edits
+    option, the result has the 'edits' instead of the text (see
+    publicBytesEditsResult).
+    """
+    text = data.decode('utf-8')
+    lines, lineEnding = splitLines(text)
+    if isinstance(options, dict) and 'cursorByteX' in options:
+        options = dict(options)
+        byteX = options.pop('cursorByteX')
+        cursorLine = options.get('cursorLine')
+        if cursorLine is not None and 0 <= cursorLine < len(lines):
+            options['cursorX'] = charColumn(lines[cursorLine], byteX)
+
+    result = processText(text, options, mode, lines, budget=getBudget(options))
+    result.lineEnding = lineEnding
+    if wantsEdits(options):
+        return publicBytesEditsResult(result)
+    return publicBytesResult(result)
+
+def resume(partial, options=None):
+    """Continues an incomplete run, given the result of indent_mode(),
+    paren_mode(), process_lines() or process_bytes() that has 'incomplete'
+    set, or its 'resume'. Returns what the first call would have returned,
+    had it gone further: the final result, or another incomplete one.
+
+    options can give a new 'timeBudget' or 'lineBudget'; without one, the
+    run goes to the end. The run continues on the text it was given, so it
+    is only worth resuming while the text did not change.
+    """
+    if isinstance(partial, dict):
+        partial = partial['resume']
+    result = partial.result
+    if not result.incomplete:
+        raise ValueError("the run is already complete")
+    budget = getBudget(options)
+    if budget is None:
+        budget = (None, None)
+    processTextWithin(result, budget)
+    return partial.publish(result)
+
+#-------------------------------------------------------------------------------
+# Check Only
+#-------------------------------------------------------------------------------
+
+# NOTE: Until the first correction, the output of a run is the same as its
+#       input, so x in the output is x in the input and nothing needs to be
+#       built. checkLines follows processText over the input lines with the
+#       same state, and stops at the first correction it finds. Openers are
+#       (lineNo, x, ch) tuples, since indentDelta stays 0 without a cursor.
+#
+#       Indent Mode removes the paren trail of every line and inserts the
+#       close-parens again at the next indentation point. The line is only
+#       unchanged if exactly the removed text comes back, so the removed text
+#       is kept in removedTrail until then. A correction inside the paren
+#       trail of the current line can be undone that way too, so it is only
+#       certain once the trail is reset after it. If the line ends first, the
+#       first changed line is left to a full run.
+
+# chars with an entry in CHAR_DISPATCH, plus the end of the line
+CHECK_STOPS_REGEX = re.compile(r"[()\[\]{}\";\\\t]|$")
+
+class CorrectionFound(Exception):
+    """Raised with the line that would change, or None if it takes a full
+    run to tell."""
+
+def checkLines(lines, mode):
+    """Returns the first line that processing would change, or None when it
+    would change nothing. Raises ParinferError like processText."""
+    isIndentMode = mode == INDENT_MODE
+    stack = []
+    isInStr = False
+    quoteDanger = False
+    strPos = None
+    dangerPos = None
+    maxIndent = None
+    trailLineNo = None
+    trailStartX = None
+    trailEndX = None
+    trailOpeners = []
+    removedTrail = ""
+    hasTrailFix = False
+
+    def resetTrail(lineNo, x):
+        nonlocal trailLineNo, trailStartX, trailEndX, trailOpeners, maxIndent
+        if removedTrail:
+            # the trail moves to another line before its parens came back
+            raise CorrectionFound(trailLineNo)
+        if hasTrailFix:
+            raise CorrectionFound(lineNo)
+        trailLineNo = lineNo
+        trailStartX = trailEndX = x
+        trailOpeners = []
+        maxIndent = None
+
+    def onProperIndent(lineNo, x):
+        nonlocal removedTrail
+        if quoteDanger:
+            raise ParinferError(error(None, ERROR_QUOTE_DANGER, *dangerPos))
+        if isIndentMode:
+            parens = []
+            while stack and stack[-1][1] >= x:
+                parens.append(PARENS[stack.pop()[2]])
+            if "".join(parens) != removedTrail:
+                raise CorrectionFound(trailLineNo)
+            removedTrail = ""
+        else:
+            minIndent = stack[-1][1] + 1 if stack else 0
+            if clamp(x, minIndent, maxIndent) != x:
+                raise CorrectionFound(lineNo)
+
+    def onCorrection(lineNo):
+        nonlocal hasTrailFix
+        if isIndentMode and lineNo == trailLineNo:
+            hasTrailFix = True
+        else:
+            raise CorrectionFound(lineNo)
+
+    for lineNo, line in enumerate(lines):
+        isInComment = False
+        isEscaping = False
+        trackingIndent = not isInStr and (not isIndentMode or len(stack) != 0)
+
+        start = 0
+        for match in CHECK_STOPS_REGEX.finditer(line):
+            x = match.start()
+
+            # the run of ordinary chars before x, as in processRun
+            if start != x:
+                if isEscaping:
+                    isEscaping = False
+                    if not isInStr and not isInComment:
+                        resetTrail(lineNo, start + 1)
+                    start = start + 1
+                if trackingIndent and start != x:
+                    run = line[start:x]
+                    indentX = start + len(run) - len(run.lstrip(BLANK_SPACE))
+                    if indentX != x:
+                        trackingIndent = False
+                        onProperIndent(lineNo, indentX)
+                    start = indentX
+                if start != x and not isInStr and not isInComment:
+                    lastX = len(line[start:x].rstrip(BLANK_SPACE)) - 1
+                    if lastX != -1:
+                        resetTrail(lineNo, start + lastX + 1)
+                    elif start > 0 and line[start - 1] == BACKSLASH:
+                        resetTrail(lineNo, start + 1)
+            start = x + 1
+
+            ch = line[x] if x != len(line) else NEWLINE
+
+            if trackingIndent and ch != TAB:
+                if ch in CLOSE_PARENS:
+                    # removed from this line, or moved to the paren trail
+                    isValid = len(stack) != 0 and stack[-1][2] == PARENS[ch]
+                    if not isIndentMode and isValid:
+                        raise CorrectionFound(trailLineNo)
+                    raise CorrectionFound(lineNo)
+                elif ch == SEMICOLON:
+                    trackingIndent = False
+                elif ch != NEWLINE:
+                    trackingIndent = False
+                    onProperIndent(lineNo, x)
+
+            if isEscaping:
+                isEscaping = False
+                if isInStr or isInComment or ch in CLOSE_PARENS:
+                    pass
+                elif ch == NEWLINE:
+                    raise ParinferError(error(None, ERROR_EOL_BACKSLASH, lineNo, x - 1))
+                else:
+                    resetTrail(lineNo, x + 1)
+            elif isInStr:
+                if ch == DOUBLE_QUOTE:
+                    isInStr = False
+                    resetTrail(lineNo, x + 1)
+                elif ch == BACKSLASH:
+                    isEscaping = True
+            elif isInComment:
+                if ch == DOUBLE_QUOTE:
+                    quoteDanger = not quoteDanger
+                    if quoteDanger:
+                        dangerPos = (lineNo, x)
+                elif ch == BACKSLASH:
+                    isEscaping = True
+            elif ch in OPEN_PARENS:
+                stack.append((lineNo, x, ch))
+                resetTrail(lineNo, x + 1)
+            elif ch in CLOSE_PARENS:
+                if len(stack) == 0 or stack[-1][2] != PARENS[ch]:
+                    onCorrection(lineNo)
+                else:
+                    opener = stack.pop()
+                    trailEndX = x + 1
+                    if isIndentMode:
+                        trailOpeners.append(opener)
+                    maxIndent = opener[1]
+            elif ch == DOUBLE_QUOTE:
+                isInStr = True
+                strPos = (lineNo, x)
+            elif ch == SEMICOLON:
+                isInComment = True
+            elif ch == BACKSLASH:
+                isEscaping = True
+                resetTrail(lineNo, x + 1)
+            elif ch == TAB:
+                onCorrection(lineNo)
+
+        if hasTrailFix:
+            raise CorrectionFound(None)
+
+        if lineNo == trailLineNo and trailStartX != trailEndX:
+            if isIndentMode:
+                removedTrail = line[trailStartX:trailEndX]
+                while trailOpeners:
+                    stack.append(trailOpeners.pop())
+            elif BLANK_SPACE in line[trailStartX:trailEndX]:
+                raise CorrectionFound(lineNo)
+
+    if quoteDanger:
+        raise ParinferError(error(None, ERROR_QUOTE_DANGER, *dangerPos))
+    if isInStr:
+        raise ParinferError(error(None, ERROR_UNCLOSED_QUOTE, *strPos))
+    if len(stack) != 0 and not isIndentMode:
+        opener = stack[-1]
+        raise ParinferError(error(None, ERROR_UNCLOSED_PAREN, opener[0], opener[1]))
+    if "".join(PARENS[opener[2]] for opener in reversed(stack)) != removedTrail:
+        raise CorrectionFound(trailLineNo)
+    return None
+
+def check(text, mode):
+    """Tells whether indent_mode or paren_mode would change the text, without
+    building the output. mode is INDENT_MODE or PAREN_MODE.
+
+    Returns {'success': True, 'changedLineNo': None} if the text would come
+    back unchanged, {'success': True, 'changedLineNo': lineNo} with the first
+    line found that would change, or {'success': False, 'error': error} like
+    the public API. The scan stops at the first correction or error, so only
+    one of them is reported."""
+    try:
+        lineNo = checkLines(splitLines(text)[0], mode)
+    except CorrectionFound as e:
+        lineNo = e.args[0]
+        if lineNo is None:
+            result = processText(text, None, mode)
+            if not result.success:
+                return {'success': False, 'error': result.error}
+            changedLines = getChangedLines(result)
+            if changedLines:
+                lineNo = changedLines[0]['lineNo']
+    except ParinferError as e:
+        err = e.args[0]
+        del err['parinferError']
+        return {'success': False, 'error': err}
+    return {'success': True, 'changedLineNo': lineNo}
+
+#-------------------------------------------------------------------------------
+# Result Cache
+#-------------------------------------------------------------------------------
+
+# first chars of a line that are not an indentation point at column 0
+NOT_FORM_START_CHARS = frozenset([BLANK_SPACE, TAB, SEMICOLON, ')', ']', '}'])
+
+# what decides whether a quote opens or closes a string
+STRING_TOKENS_REGEX = re.compile(r'\\.?|"|;')
+
+def topLevelFormStarts(lines):
+    """Returns the numbers of the lines that start a top-level form: lines
+    whose first char is an indentation point at column 0 and is not inside a
+    string. The first line is always one of them.
+
+    This is a quick lexical guess. A form only processes the same on its own
+    as within the whole text if it succeeds on its own, which the callers
+    check."""
+    starts = [0]
+    isInStr = False
+    for lineNo, line in enumerate(lines):
+        if lineNo != 0 and line and not isInStr and line[0] not in NOT_FORM_START_CHARS:
+            starts.append(lineNo)
+        if DOUBLE_QUOTE in line:
+            isInStr = isInStrAfterLine(line, isInStr)
+    return starts
+
+def isInStrAfterLine(line, isInStr):
+    """Returns whether a string is open at the end of line, given whether one
+    was open at its start."""
+    for match in STRING_TOKENS_REGEX.finditer(line):
+        token = match.group()
+        if token == DOUBLE_QUOTE:
+            isInStr = not isInStr
+        elif token == SEMICOLON and not isInStr:
+            break
+    return isInStr
+
+def cursorKey(options):
+    if not isinstance(options, dict):
+        return (None, None, None)
+    return (options.get('cursorX'), options.get('cursorLine'), options.get('cursorDx'))
+
+def freezeResult(out):
+    """Makes a public result read-only, so that it can be shared."""
+    out = dict(out)
+    if out['success']:
+        out['changedLines'] = tuple(MappingProxyType(line) for line in out['changedLines'])
+        if 'edits' in out:
+            out['edits'] = tuple(MappingProxyType(edit) for edit in out['edits'])
+    else:
+        out['error'] = MappingProxyType(out['error'])
+    return MappingProxyType(out)
+
+class ResultCache(object):
+    """Remembers the results of indent_mode and paren_mode, keyed by the text,
+    the mode, the cursor options and the outline and edits options. The text
+    is a key as is, so its hash is computed once per string and a match
+    compares the whole content.
+
+    Holds at most maxEntries results and about maxBytes of text, evicting the
+    least recently used results first. The text is measured in the bytes its
+    strings take in memory (sys.getsizeof), from one to four per char
+    depending on the widest char of a string. The results are read-only
+    mappings shared between the calls that hit them, with tuples for
+    changedLines.
+    """
+
+    def __init__(self, maxEntries=256, maxBytes=32 << 20):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def indent_mode(self, text, options=None):
+        return self.process(text, options, INDENT_MODE)
+
+    def paren_mode(self, text, options=None):
+        return self.process(text, options, PAREN_MODE)
+
+    def process(self, text, options, mode):
+        key = (mode, text, isOutlined(options), wantsEdits(options)) + cursorKey(options)
+        out = self.lookup(key)
+        if out is None:
+            out = getPublisher(options)(processText(text, options, mode))
+            outText = out.get('text')
+            if outText == text:
+                out['text'] = outText = text
+            out = freezeResult(out)
+            size = sys.getsizeof(text)
+            if outText is not None and outText is not text:
+                size = size + sys.getsizeof(outText)
+            self.store(key, out, size)
+        return out
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def store(self, key, value, size):
+        if size > self.maxBytes:
+            return
+        self.entries[key] = (value, size)
+        self.size = self.size + size
+        while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+            value, size = self.entries.popitem(last=False)[1]
+            self.size = self.size - size
+            self.evictions = self.evictions + 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+    def clear(self):
+        """Drops the entries and resets the counters of stats()."""
+        self.entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+def formOptionsFor(options, cursorLine, start, end):
+    """The options of the form, or of the piece of forms, with the lines in
+    [start, end). The cursor options only go to the one with the cursor
+    line."""
+    if cursorLine is not None and start <= cursorLine < end:
+        options = dict(options)
+        options['cursorLine'] = cursorLine - start
+        return options
+    if isOutlined(options):
+        return {'outline': True}
+    return None
+
+class FormCache(ResultCache):
+    """A ResultCache that remembers each top-level form on its own, so that
+    after an edit only the edited form is processed again. The cursor
+    options only go to the form with the cursor line.
+
+    When a form fails on its own (an unclosed paren in Paren Mode, or a
+    string that spans forms) the whole text is processed instead, and that
+    result is not cached. Hits and misses are counted per form.
+    """
+
+    def process(self, text, options, mode):
+        origLines, lineEnding = splitLines(text)
+        starts = topLevelFormStarts(origLines)
+        starts.append(len(origLines))
+
+        cursorLine = None
+        if isinstance(options, dict):
+            cursorLine = options.get('cursorLine')
+
+        lines = []
+        changedLines = []
+        entries = []
+        for i in range(len(starts) - 1):
+            start = starts[i]
+            end = starts[i + 1]
+            formLines = origLines[start:end]
+            formOptions = formOptionsFor(options, cursorLine, start, end)
+
+            formText = NEWLINE.join(formLines)
+            key = (mode, formText, isOutlined(formOptions)) + cursorKey(formOptions)
+            entry = self.lookup(key)
+            if entry is None:
+                result = processText(formText, formOptions, mode, formLines)
+                if result.success:
+                    changed = tuple(changedLineNos(result))
+                    entry = (tuple(result.lines), changed, result.outline)
+                else:
+                    entry = False
+                self.store(key, entry, 2 * sys.getsizeof(formText))
+            if entry is False:
+                return freezeResult(getPublisher(options)(processText(text, options, mode, origLines)))
+
+            formOutLines, changed, formOutline = entry
+            for j in changed:
+                changedLines.append({'lineNo': start + j, 'line': formOutLines[j]})
+            lines.extend(formOutLines)
+            if formOutline is not None:
+                joinOutline(entries, formOutline)
+
+        out = {
+            'text': lineEnding.join(lines),
+            'success': True,
+            'changedLines': changedLines,
+        }
+        if isOutlined(options):
+            out['outline'] = Outline(entries)
+        if wantsEdits(options):
+            toEditsResult(out, origLines)
+        return freezeResult(out)
+
+#-------------------------------------------------------------------------------
+# Incremental Processing
+#-------------------------------------------------------------------------------
+
+# NOTE: A checkpoint is a compact snapshot of the state at a line boundary,
+#       taken just before the line is processed. Line numbers inside it are
+#       stored relative to the checkpoint's own line, so checkpoints below an
+#       edit stay valid after lines are inserted or removed above them.
+#       isInComment, isEscaping and the line-specific fields are always reset
+#       at a line boundary, so they are not recorded.
+
+def snapshotOpener(opener, lineNo):
+    return (lineNo - opener[OPENER_LINE_NO],) + opener[OPENER_X:]
+
+def restoreOpener(snapshot, lineNo):
+    return (lineNo - snapshot[0],) + snapshot[1:]
+
+def snapshotErrorPos(result, name, lineNo):
+    pos = result.errorPosCache[name]
+    return (lineNo - pos['lineNo'], pos['x'])
+
+def checkpoint(result):
+    """Returns a snapshot of the state before the next line is processed."""
+    lineNo = result.lineNo + 1
+    trail = result.parenTrail
+
+    # the paren trail line can still be rewritten by the lines that follow,
+    # so its current (pending) content is part of the state
+    trailOffset = None
+    trailLine = None
+    if trail.lineNo is not None:
+        trailOffset = lineNo - trail.lineNo
+        trailLine = result.lines[trail.lineNo]
+
+    # only the error positions that can still be reported matter
+    strPos = None
+    if result.isInStr:
+        strPos = snapshotErrorPos(result, ERROR_UNCLOSED_QUOTE, lineNo)
+    dangerPos = None
+    if result.quoteDanger:
+        dangerPos = snapshotErrorPos(result, ERROR_QUOTE_DANGER, lineNo)
+
+    return (
+        tuple(snapshotOpener(o, lineNo) for o in result.parenStack),
+        result.isInStr,
+        result.quoteDanger,
+        result.maxIndent,
+        trailOffset,
+        trail.startX,
+        trail.endX,
+        tuple(snapshotOpener(o, lineNo) for o in trail.openers),
+        trailLine,
+        strPos,
+        dangerPos,
+    )
+
+def restoreCheckpoint(result, lineNo, snapshot, lines):
+    """Sets up the result to continue processing at lineNo.
+    lines must hold the final output of the lines before lineNo."""
+    (stack, isInStr, quoteDanger, maxIndent, trailOffset, startX, endX,
+     openers, trailLine, strPos, dangerPos) = snapshot
+
+    result.lineNo = lineNo - 1
+    result.lines = lines
+    result.parenStack = [restoreOpener(o, lineNo) for o in stack]
+    result.isInStr = isInStr
+    result.isInCode = not isInStr
+    result.quoteDanger = quoteDanger
+    result.maxIndent = maxIndent
+
+    trail = result.parenTrail
+    trail.startX = startX
+    trail.endX = endX
+    trail.openers = deque(restoreOpener(o, lineNo) for o in openers)
+    if trailOffset is not None:
+        trail.lineNo = lineNo - trailOffset
+        lines[trail.lineNo] = trailLine
+        markDirty(result, trail.lineNo)
+
+    if strPos is not None:
+        cacheErrorPos(result, ERROR_UNCLOSED_QUOTE, lineNo - strPos[0], strPos[1])
+    if dangerPos is not None:
+        cacheErrorPos(result, ERROR_QUOTE_DANGER, lineNo - dangerPos[0], dangerPos[1])
+
+def commonLines(oldLines, newLines):
+    """Returns (start, end): how many lines the two lists have in common at
+    their start, and then at their end."""
+    maxCommon = min(len(oldLines), len(newLines))
+    start = 0
+    while start < maxCommon and oldLines[start] == newLines[start]:
+        start = start + 1
+    end = 0
+    while (end < maxCommon - start and
+           oldLines[len(oldLines) - end - 1] == newLines[len(newLines) - end - 1]):
+        end = end + 1
+    return start, end
+
+class TextProcessor(object):
+    """The update() and edit() of the processors, which hand an edit of the
+    original lines to processEdit(). Subclasses keep the last original lines
+    in origLines and their line ending in lineEnding."""
+
+    def update(self, text, options=None):
+        """Processes a new version of the whole text."""
+        oldLines = self.origLines
+        newLines, self.lineEnding = splitLines(text)
+        start, end = commonLines(oldLines, newLines)
+        newLines = newLines[start:len(newLines) - end]
+        return self.processEdit(start, len(oldLines) - end, newLines, options, text, True)
+
+    def edit(self, startLine, endLine, newLines, options=None, withText=True):
+        """Replaces the original lines in [startLine, endLine) with newLines
+        and processes the resulting text. The lines have no line endings.
+        Unless withText is true, the result has no 'text'."""
+        return self.processEdit(startLine, endLine, newLines, options, None, withText)
+
+class LineSplice(object):
+    """Stands in for result.lines in the runs of an IncrementalProcessor.
+    Holds the output lines of the last run, moved to their new line numbers,
+    which the lines processed again overwrite from end on. The old lines that
+    are overwritten, and those the edit replaced, are kept for oldLine()."""
+    __slots__ = ('lines', 'end', 'startLine', 'endLine', 'delta', 'replaced', 'saved')
+
+    def __init__(self, lines, end, startLine, endLine, delta):
+        self.lines = lines
+        self.end = end
+        self.startLine = startLine
+        self.endLine = endLine
+        self.delta = delta
+        self.replaced = []
+        self.saved = {}
+
+    def __getitem__(self, lineNo):
+        return self.lines[lineNo]
+
+    def __setitem__(self, lineNo, line):
+        if lineNo not in self.saved:
+            self.saved[lineNo] = self.lines[lineNo]
+        self.lines[lineNo] = line
+
+    def append(self, line):
+        lineNo = self.end
+        self.end = lineNo + 1
+        if lineNo < len(self.lines):
+            self[lineNo] = line
+        else:
+            self.lines.append(line)
+
+    def oldLine(self, oldLineNo):
+        """Returns the output of the line oldLineNo of the last run."""
+        if self.startLine <= oldLineNo < self.endLine:
+            return self.replaced[oldLineNo - self.startLine]
+        lineNo = oldLineNo if oldLineNo < self.startLine else oldLineNo + self.delta
+        if lineNo in self.saved:
+            return self.saved[lineNo]
+        return self.lines[lineNo]
+
+class IncrementalProcessor(TextProcessor):
+    """Processes successive versions of a text in one mode.
+
+    A checkpoint is kept for every line boundary of the last run. On an edit,
+    processing resumes from the checkpoint just before the first dirty line
+    (edited lines and the old and new cursor lines), and stops as soon as the
+    state past the dirty lines converges with the old checkpoints. The rest
+    of the previous output is then reused as is.
+
+    Both update() and edit() return the same dictionary as indent_mode() and
+    paren_mode(). edit() can leave out the 'text', so that an editor that
+    only takes the changedLines does not pay for joining the whole text on
+    every edit.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.origLines = []
+        self.lines = []
+        self.changed = []
+        self.outline = None
+        self.checkpoints = []
+        self.success = False
+        self.cursorLine = None
+        self.lineEnding = NEWLINE
+
+    def processEdit(self, startLine, endLine, newLines, options, text, withText):
+        origLines = self.origLines
+        lines = self.lines
+        checkpoints = self.checkpoints
+        delta = len(newLines) - (endLine - startLine)
+
+        origLines[startLine:endLine] = newLines
+        if text is None and withText:
+            text = self.lineEnding.join(origLines)
+        result = initialResult(text, options, self.mode, origLines)
+
+        # lines whose processing may differ from the last run, as sorted
+        # [start, end) regions: the edited lines and the old and new cursor lines
+        regions = [(startLine, startLine + len(newLines))]
+        cursorLine = result.cursorLine
+        if cursorLine is not None:
+            regions.append((cursorLine, cursorLine + 1))
+        if self.cursorLine is not None:
+            if self.cursorLine < startLine:
+                regions.append((self.cursorLine, self.cursorLine + 1))
+            elif self.cursorLine >= endLine:
+                regions.append((self.cursorLine + delta, self.cursorLine + delta + 1))
+        regions.sort()
+
+        # a failed run has no checkpoints past the line where it stopped
+        start = max(0, min(regions[0][0], len(checkpoints) - 1))
+        startCheckpoint = checkpoints[start] if start > 0 else None
+
+        # the outline of the old lines can only be reused if it was recorded
+        canReuse = self.success
+        if result.outline is not None and self.outline is None:
+            start = 0
+            canReuse = False
+
+        # the old output lines and checkpoints are moved to their new line
+        # numbers in place, and overwritten from start on as lines are
+        # processed again
+        splice = LineSplice(lines, start, startLine, endLine, delta)
+        if canReuse:
+            splice.replaced = lines[startLine:endLine]
+            lines[startLine:endLine] = newLines
+            # the old checkpoint of startLine moves away when lines are removed
+            editCheckpoint = checkpoints[startLine]
+            checkpoints[startLine:endLine] = [None] * len(newLines)
+        else:
+            del lines[start:]
+            del checkpoints[start:]
+        result.lines = splice
+
+        if start > 0:
+            result.dirtyLines.update(self.changed[:bisect_left(self.changed, start)])
+            restoreCheckpoint(result, start, startCheckpoint, splice)
+            if result.outline is not None:
+                result.outline = self.outline[:start]
+
+        lineNo = start
+        try:
+            regionIdx = 0
+            while lineNo < len(origLines):
+                while regionIdx < len(regions) and regions[regionIdx][1] <= lineNo:
+                    regionIdx = regionIdx + 1
+                snapshot = checkpoint(result)
+
+                # outside of the dirty regions, the old checkpoints are still
+                # good once the state has converged with them
+                isClean = (regionIdx == len(regions) or
+                           lineNo < regions[regionIdx][0])
+                if canReuse and isClean and checkpoints[lineNo] == snapshot:
+                    oldLineNo = lineNo if lineNo < startLine else lineNo - delta
+                    if regionIdx == len(regions):
+                        self.reuseOldLines(result, lineNo, oldLineNo, len(origLines) - delta)
+                        if result.outline is not None:
+                            result.outline.append(self.outline[-1])
+                        result.success = True
+                        break
+
+                    # skip ahead to the next dirty region
+                    nextLineNo = regions[regionIdx][0]
+                    oldNextLineNo = nextLineNo if nextLineNo <= startLine else nextLineNo - delta
+                    self.reuseOldLines(result, lineNo, oldLineNo, oldNextLineNo)
+                    nextCheckpoint = editCheckpoint if nextLineNo == startLine else checkpoints[nextLineNo]
+                    restoreCheckpoint(result, nextLineNo, nextCheckpoint, splice)
+                    lineNo = nextLineNo
+                    continue
+
+                if lineNo < len(checkpoints):
+                    checkpoints[lineNo] = snapshot
+                else:
+                    checkpoints.append(snapshot)
+                processLine(result, origLines[lineNo])
+                lineNo = lineNo + 1
+            else:
+                if lineNo < len(checkpoints):
+                    checkpoints[lineNo] = checkpoint(result)
+                else:
+                    checkpoints.append(checkpoint(result))
+                finalizeResult(result)
+        except ParinferError as e:
+            errorDetails = e.args[0]
+            processError(result, errorDetails)
+            # a failed run keeps the lines and checkpoints up to where it stopped
+            del lines[splice.end:]
+            del checkpoints[lineNo + 1:]
+        result.lines = lines
+
+        self.changed = changedLineNos(result)
+        self.outline = result.outline
+        self.success = result.success
+        self.cursorLine = cursorLine
+
+        if not withText and not (result.success and wantsEdits(options)):
+            return publicChangesResult(result)
+        return getPublisher(options)(result)
+
+    def reuseOldLines(self, result, lineNo, oldLineNo, oldEndLineNo):
+        """Keeps the previous output of the old lines in [oldLineNo,
+        oldEndLineNo), once the state at lineNo is the same as it was at
+        oldLineNo in the last run, with the lines that changed among them."""
+        lines = result.lines
+        trailLineNo = result.parenTrail.lineNo
+        if trailLineNo is not None:
+            lines[trailLineNo] = lines.oldLine(oldLineNo - (lineNo - trailLineNo))
+            markDirty(result, trailLineNo)
+        lines.end = lineNo + oldEndLineNo - oldLineNo
+        changed = self.changed
+        shift = lineNo - oldLineNo
+        result.dirtyLines.update(changed[i] + shift for i in range(bisect_left(changed, oldLineNo),
+                                                                   bisect_left(changed, oldEndLineNo)))
+        if result.outline is not None:
+            result.outline.extend(self.outline[oldLineNo:oldEndLineNo])
+
+#-------------------------------------------------------------------------------
+# Form Index
+#-------------------------------------------------------------------------------
+
+# NOTE: A top-level form that succeeds on its own processes the same within
+#       the whole text (see FormCache). So when every form of a text succeeds
+#       on its own, the result of the text is made of the results of its
+#       forms, and an edit only has to process the forms it touches, plus the
+#       forms that hold the old and the new cursor line.
+
+class FormIndex(object):
+    """The top-level form starts of a list of lines (see topLevelFormStarts),
+    kept up to date as lines are replaced.
+
+    An edit moves the starts of all the forms past it, so the move is only
+    recorded: the starts from shiftFrom on are stored without the shift. It
+    is applied to the starts one by one when a later edit is elsewhere, so an
+    edit costs as much as the distance from the last one in forms, rather
+    than the number of forms."""
+
+    def __init__(self, lines):
+        self.starts = topLevelFormStarts(lines)
+        self.shiftFrom = len(self.starts)
+        self.shift = 0
+        self.numLines = len(lines)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def start(self, i):
+        """Returns the first line of the form i."""
+        if i >= self.shiftFrom:
+            return self.starts[i] + self.shift
+        return self.starts[i]
+
+    def formStarts(self):
+        """Returns the list of the form starts."""
+        return [self.start(i) for i in range(len(self.starts))]
+
+    def formAt(self, lineNo):
+        """Returns the index of the form that holds lineNo."""
+        starts = self.starts
+        shiftFrom = self.shiftFrom
+        if shiftFrom < len(starts) and lineNo >= starts[shiftFrom] + self.shift:
+            return bisect_right(starts, lineNo - self.shift, shiftFrom) - 1
+        return bisect_right(starts, lineNo, 0, shiftFrom) - 1
+
+    def formLines(self, i):
+        """Returns the [start, end) line range of the form i."""
+        if i + 1 < len(self.starts):
+            return self.start(i), self.start(i + 1)
+        return self.start(i), self.numLines
+
+    def moveShift(self, i):
+        """Makes the shift apply to the starts from the form i on."""
+        starts = self.starts
+        shift = self.shift
+        if shift != 0:
+            for f in range(i, self.shiftFrom):
+                starts[f] = starts[f] - shift
+            for f in range(self.shiftFrom, i):
+                starts[f] = starts[f] + shift
+        self.shiftFrom = i
+
+    def replace(self, lines, startLine, endLine, count):
+        """Updates the index after the lines in [startLine, endLine) were
+        replaced with count lines, lines being the new list. Returns (i, j,
+        k): the forms in [i, j) of the old index are now the forms in [i, k),
+        and the forms past them only moved.
+
+        The lines are lexed again from the form before the edit, until the
+        string state is back in sync at one of the old form starts. An
+        unbalanced quote can push that to the end of the text."""
+        delta = count - (endLine - startLine)
+        i = self.formAt(max(0, startLine - 1))
+        j = max(i + 1, self.formAt(endLine - 1) + 1)
+        editEnd = startLine + count
+
+        first = self.start(i)
+        newStarts = [first]
+        isInStr = False
+        lineNo = first
+        while lineNo < len(lines):
+            if lineNo >= editEnd and lineNo != first:
+                while j < len(self.starts) and self.start(j) + delta < lineNo:
+                    j = j + 1
+                if not isInStr and j < len(self.starts) and self.start(j) + delta == lineNo:
+                    break
+            line = lines[lineNo]
+            if lineNo != first and line and not isInStr and line[0] not in NOT_FORM_START_CHARS:
+                newStarts.append(lineNo)
+            if DOUBLE_QUOTE in line:
+                isInStr = isInStrAfterLine(line, isInStr)
+            lineNo = lineNo + 1
+        else:
+            j = len(self.starts)
+
+        # the forms past the edit move with the shift
+        self.moveShift(j)
+        self.starts[i:j] = newStarts
+        self.shiftFrom = i + len(newStarts)
+        self.shift = self.shift + delta
+        self.numLines = len(lines)
+        return i, j, i + len(newStarts)
+
+class FormProcessor(TextProcessor):
+    """Processes successive versions of a text in one mode, one top-level
+    form at a time. The result of each form is kept, and an edit only
+    processes the forms it touches and the forms that hold the old and the
+    new cursor line, so its cost follows the size of the edited form rather
+    than the size of the text.
+
+    The changed lines of each form are kept relative to its start, with the
+    sorted indexes of the forms that have some in changedForms, so the
+    changedLines of a result come from those forms only.
+
+    When a form fails on its own (an unclosed paren in Paren Mode, or a
+    string that spans forms) the whole text is processed instead, until the
+    form succeeds again.
+
+    update() and edit() work as in IncrementalProcessor.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.origLines = []
+        self.lines = None
+        self.index = FormIndex([])
+        self.forms = [None]
+        self.changedForms = []
+        self.numFailed = 0
+        self.outlined = False
+        self.cursorLine = None
+        self.lineEnding = NEWLINE
+
+    def processForm(self, i, origLines, options, cursorLine):
+        """Returns (lines, changed, outline) for the form i, changed being the
+        indexes of its lines that changed, or False if it fails on its own."""
+        start, end = self.index.formLines(i)
+        formLines = origLines[start:end]
+        formOptions = formOptionsFor(options, cursorLine, start, end)
+
+        result = processText(NEWLINE.join(formLines), formOptions, self.mode, formLines)
+        if not result.success:
+            return False
+        changed = changedLineNos(result)
+        return (result.lines, changed, result.outline)
+
+    def setForm(self, f, form):
+        """Sets the result of the form f, and keeps changedForms and
+        numFailed up to date."""
+        old = self.forms[f]
+        if old is False:
+            self.numFailed = self.numFailed - 1
+        elif old is not None and old[1]:
+            del self.changedForms[bisect_left(self.changedForms, f)]
+        if form is False:
+            self.numFailed = self.numFailed + 1
+        elif form[1]:
+            insort(self.changedForms, f)
+        self.forms[f] = form
+
+    def spliceForms(self, i, j, k):
+        """Replaces the results of the forms in [i, j) with k - i forms to
+        process."""
+        forms = self.forms
+        changedForms = self.changedForms
+        self.numFailed = self.numFailed - forms[i:j].count(False)
+        forms[i:j] = [None] * (k - i)
+        a = bisect_left(changedForms, i)
+        b = bisect_left(changedForms, j)
+        changedForms[a:] = [f + k - j for f in changedForms[b:]]
+
+    def processEdit(self, startLine, endLine, newLines, options, text, withText):
+        origLines = self.origLines
+        index = self.index
+        delta = len(newLines) - (endLine - startLine)
+
+        origLines[startLine:endLine] = newLines
+        if text is None and withText:
+            text = self.lineEnding.join(origLines)
+
+        i, j, k = index.replace(origLines, startLine, endLine, len(newLines))
+        self.spliceForms(i, j, k)
+        forms = self.forms
+
+        cursorLine = None
+        if isinstance(options, dict):
+            cursorLine = options.get('cursorLine')
+        oldCursorLine = self.cursorLine
+        if oldCursorLine is not None and oldCursorLine >= endLine:
+            oldCursorLine = oldCursorLine + delta
+
+        dirty = list(range(i, k))
+        for lineNo in (oldCursorLine, cursorLine):
+            if lineNo is not None and 0 <= lineNo < len(origLines):
+                f = index.formAt(lineNo)
+                if not i <= f < k and f not in dirty:
+                    dirty.append(f)
+
+        # the forms of the last run have no outline to reuse
+        outlined = isOutlined(options)
+        lines = self.lines
+        if outlined and not self.outlined:
+            dirty = range(len(forms))
+            lines = None
+        for f in dirty:
+            self.setForm(f, self.processForm(f, origLines, options, cursorLine))
+
+        self.cursorLine = cursorLine
+        self.outlined = outlined
+        self.lines = None
+
+        if self.numFailed != 0:
+            result = processText(text, options, self.mode, origLines)
+            if not withText and not (result.success and wantsEdits(options)):
+                return publicChangesResult(result)
+            return getPublisher(options)(result)
+
+        if lines is None:
+            lines = []
+            for form in forms:
+                lines.extend(form[0])
+        else:
+            regionStart, regionEnd = index.start(i), index.formLines(k - 1)[1]
+            region = []
+            for f in range(i, k):
+                region.extend(forms[f][0])
+            lines[regionStart:regionEnd - delta] = region
+            for f in dirty[k - i:]:
+                start, end = index.formLines(f)
+                lines[start:end] = forms[f][0]
+        self.lines = lines
+
+        changedLines = []
+        for f in self.changedForms:
+            start = index.start(f)
+            formLines, changed = forms[f][:2]
+            for x in changed:
+                changedLines.append({'lineNo': start + x, 'line': formLines[x]})
+        out = {}
+        if withText:
+            out['text'] = self.lineEnding.join(lines)
+        out['success'] = True
+        out['changedLines'] = changedLines
+        if outlined:
+            # the entries are relative to their line, so the ones of the
+            # forms add up to the entries of the text
+            entries = []
+            for form in forms:
+                joinOutline(entries, form[2])
+            out['outline'] = Outline(entries)
+        if wantsEdits(options):
+            toEditsResult(out, origLines)
+        return out
+
+#-------------------------------------------------------------------------------
+# Batch Processing
+#-------------------------------------------------------------------------------
+
+def processChunk(texts, options, mode):
+    return [getPublisher(options)(processText(text, options, mode)) for text in texts]
+
+def iterChunkResults(chunks, options, mode, workers):
+    if workers == 1:
+        for start, texts in chunks:
+            for i, text in enumerate(texts):
+                yield start + i, getPublisher(options)(processText(text, options, mode))
+        return
+
+    # concurrent.futures and multiprocessing take about 25 ms each to import,
+    # so they are only imported when a pool is needed
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {}
+        for start, texts in chunks:
+            futures[executor.submit(processChunk, texts, options, mode)] = start
+        for future in as_completed(futures):
+            start = futures[future]
+            for i, result in enumerate(future.result()):
+                yield start + i, result
+
+def process_many(texts, mode, options=None, workers=None, chunksize=None, stream=False):
+    """Processes many texts in INDENT_MODE or PAREN_MODE across a pool of
+    worker processes.
+
+    The texts are sent to the workers in chunks of chunksize texts, to
+    amortize the cost of passing them between processes. workers defaults to
+    the number of CPUs; with workers=1 everything runs in this process.
+
+    Returns the list of results, in the same order as texts. With
+    stream=True, returns an iterator of (index, result) pairs instead, which
+    yields the results of each chunk as soon as it is done.
+    """
+    texts = list(texts)
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(texts) // (workers * 4))
+
+    chunks = []
+    for start in range(0, len(texts), chunksize):
+        chunks.append((start, texts[start:start + chunksize]))
+
+    results = iterChunkResults(chunks, options, mode, workers)
+    if stream:
+        return results
+
+    ordered = [None] * len(texts)
+    for i, result in results:
+        ordered[i] = result
+    return ordered
+
+# NOTE: process_parallel cuts one big text into pieces at top-level form
+#       starts (see topLevelFormStarts) and processes them in parallel. The
+#       pieces that succeed on their own process the same within the whole
+#       text, so their changed lines are stitched together. After them, the
+#       state at the start of the first piece that fails is the state at the
+#       start of a text, so the rest of the text is processed from there, in
+#       this process, which reports the same error as a serial run.
+
+# pieces are at least this many chars unless asked otherwise, as smaller
+# ones are not worth sending to another process
+MIN_PIECE_SIZE = 1 << 16
+
+def processPiece(lines, options, mode):
+    """Returns the (lineNo, line) pairs of the changed lines of a piece, with
+    its outline entries (or None), or None if it fails on its own. The lines
+    are passed rather than their text, as joining them could turn a stray CR
+    at the end of a line into a CRLF."""
+    result = processText(NEWLINE.join(lines), options, mode, lines)
+    if not result.success:
+        return None
+    changed = [(change['lineNo'], change['line']) for change in getChangedLines(result)]
+    return changed, result.outline
+
+def splitPieces(lines, numPieces):
+    """Returns the line numbers where to cut lines into at most numPieces
+    pieces of about the same number of chars, all at top-level form starts.
+    The first one is 0."""
+    ends = list(accumulate(len(line) + 1 for line in lines))
+    pieceSize = ends[-1] / numPieces
+    cuts = [0]
+    for start in topLevelFormStarts(lines)[1:]:
+        if len(cuts) == numPieces:
+            break
+        if ends[start - 1] >= len(cuts) * pieceSize:
+            cuts.append(start)
+    return cuts
+
+def process_parallel(text, mode, options=None, workers=None, pieces=None):
+    """Processes one big text in INDENT_MODE or PAREN_MODE across a pool of
+    worker processes, and returns the same result as indent_mode() and
+    paren_mode().
+
+    The text is cut into pieces of about the same size at top-level form
+    starts: one per worker, and none smaller than MIN_PIECE_SIZE chars,
+    unless pieces is given. workers defaults to the number of CPUs; with
+    workers=1 the pieces are processed in this process.
+
+    The counters of the stats option and the budget options are those of
+    one run, so they raise a ValueError.
+    """
+    if wantsStats(options) or getBudget(options) is not None:
+        raise ValueError("process_parallel does not support the stats and budget options")
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if pieces is None:
+        pieces = max(1, min(workers, len(text) // MIN_PIECE_SIZE))
+
+    lines, lineEnding = splitLines(text)
+    cuts = splitPieces(lines, pieces)
+    if len(cuts) == 1:
+        return getPublisher(options)(processText(text, options, mode, lines))
+    cuts.append(len(lines))
+
+    cursorLine = None
+    if isinstance(options, dict):
+        cursorLine = options.get('cursorLine')
+    pieceLines = []
+    optionsList = []
+    for i in range(len(cuts) - 1):
+        pieceLines.append(lines[cuts[i]:cuts[i + 1]])
+        optionsList.append(formOptionsFor(options, cursorLine, cuts[i], cuts[i + 1]))
+
+    if workers == 1:
+        outs = map(processPiece, pieceLines, optionsList, repeat(mode))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(workers, len(pieceLines))) as executor:
+            outs = list(executor.map(processPiece, pieceLines, optionsList, repeat(mode)))
+
+    changedLines = []
+    edits = [] if wantsEdits(options) else None
+    entries = [] if isOutlined(options) else None
+    for start, out in zip(cuts, outs):
+        isRest = out is None
+        if isRest:
+            restLines = lines[start:]
+            rest = processText(NEWLINE.join(restLines),
+                               formOptionsFor(options, cursorLine, start, len(lines)),
+                               mode, restLines)
+            if not rest.success:
+                error = rest.error
+                if error['lineNo'] is not None:
+                    error['lineNo'] = error['lineNo'] + start
+                return {'text': text, 'success': False, 'error': error}
+            out = ([(change['lineNo'], change['line']) for change in getChangedLines(rest)],
+                   rest.outline)
+
+        changed, pieceEntries = out
+        if entries is not None:
+            # the entries are relative to their line, as in FormProcessor
+            joinOutline(entries, pieceEntries)
+        for lineNo, line in changed:
+            if edits is not None:
+                lineEdits(start + lineNo, lines[start + lineNo], line, edits)
+            lines[start + lineNo] = line
+            changedLines.append({'lineNo': start + lineNo, 'line': line})
+        if isRest:
+            break
+
+    if edits is not None:
+        out = {'success': True, 'edits': edits, 'changedLines': changedLines}
+    else:
+        out = {
+            'text': lineEnding.join(lines),
+            'success': True,
+            'changedLines': changedLines,
+        }
+    if entries is not None:
+        out['outline'] = Outline(entries)
+    return out
+
+#-------------------------------------------------------------------------------
+# Streaming
+#-------------------------------------------------------------------------------
+
+class LineWindow(object):
+    """Stands in for result.lines when streaming. Holds only the lines from
+    offset on, still indexed by their line number."""
+    __slots__ = ('offset', 'lines')
+
+    def __init__(self):
+        self.offset = 0
+        self.lines = []
+
+    def __getitem__(self, lineNo):
+        return self.lines[lineNo - self.offset]
+
+    def __setitem__(self, lineNo, line):
+        self.lines[lineNo - self.offset] = line
+
+    def append(self, line):
+        self.lines.append(line)
+
+def splitLineEnding(line):
+    if line.endswith("\r\n"):
+        return line[:-2], "\r\n"
+    if line.endswith(NEWLINE):
+        return line[:-1], NEWLINE
+    return line, ""
+
+def stream_lines(lines, mode, options=None):
+    """Processes an iterable of lines (a file object, for example) in
+    INDENT_MODE or PAREN_MODE, and yields the corrected lines as soon as they
+    are final. Each output line keeps the line ending of its input line.
+
+    Only the lines from the current paren trail line on are kept in memory,
+    since the lines before it can no longer change.
+
+    Lines are yielded before the whole input is checked, so an error is
+    reported by raising ParinferError with the same error dictionary the
+    public API returns; the lines yielded so far should then be discarded.
+
+    The outline of a text holds an entry for each of its lines, which would
+    grow with the whole stream, so the outline option raises a ValueError.
+    """
+    if isOutlined(options):
+        raise ValueError("stream_lines does not support the outline option")
+    return streamLines(lines, mode, options)
+
+def streamLines(lines, mode, options):
+    result = initialResult("", options, mode, [])
+    window = LineWindow()
+    endings = []
+    result.lines = window
+    # the lines are yielded as they are, so there is no need to keep track
+    result.dirtyLines = None
+
+    try:
+        for line in lines:
+            line, ending = splitLineEnding(line)
+            endings.append(ending)
+            processLine(result, line)
+
+            finalLineNo = result.parenTrail.lineNo
+            if finalLineNo is None:
+                finalLineNo = result.lineNo + 1
+            count = finalLineNo - window.offset
+            for i in range(count):
+                yield window.lines[i] + endings[i]
+            del window.lines[:count]
+            del endings[:count]
+            window.offset = window.offset + count
+
+        finalizeResult(result)
+    except ParinferError as e:
+        errorDetails = e.args[0]
+        processError(result, errorDetails)
+        raise ParinferError(result.error)
+
+    for i in range(len(window.lines)):
+        yield window.lines[i] + endings[i]
+
+if __name__ == "__main__":
+    # the modules next to this one import it as parinfer, which has to be
+    # this module rather than a second copy of it
+    sys.modules['parinfer'] = sys.modules[__name__]
+    from parinfer_cli import main
+    sys.exit(main())
@@ -0,0 +1,384 @@
+## The command line of Parinfer.py (python -m parinfer), with its cache of
+## results across runs. python -m parinfer --serve runs parinfer_server.py.
+
+import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+from itertools import repeat
+import parinfer
+from parinfer import (INDENT_MODE, PAREN_MODE, check, process_parallel, processText,
+                      publicResult)
+
+# files this large are read through mmap
+MMAP_THRESHOLD = 1 << 20
+
+def readFile(path, encoding):
+    """Reads and decodes a whole file in one go."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            return f.read().decode(encoding)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return str(m, encoding)
+        finally:
+            m.close()
+
+def writeFileAtomic(path, text, encoding):
+    """Replaces the content of a file, or creates it, through a temporary
+    file in the same directory, so the file is never left half written."""
+    dirName, baseName = os.path.split(os.path.abspath(path))
+    fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.' + baseName + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(text.encode(encoding))
+        if os.path.exists(path):
+            shutil.copymode(path, tmpPath)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.unlink(tmpPath)
+        raise
+
+def errorMessage(path, err):
+    return "%s:%d:%d: %s" % (path, err['lineNo'] + 1, err['x'] + 1, err['message'])
+
+def processFileText(text, mode, build, workers=1):
+    """Returns (changed, error, outText) for the text of a file, error being
+    the error dictionary of the public API. Unless build is true, the text
+    is only checked and outText is None. With workers other than 1, the text
+    is cut into pieces processed in parallel."""
+    if not build:
+        checked = check(text, mode)
+        if not checked['success']:
+            return False, checked['error'], None
+        return checked['changedLineNo'] is not None, None, None
+
+    if workers == 1:
+        out = publicResult(processText(text, None, mode))
+    else:
+        out = process_parallel(text, mode, None, workers)
+    if not out['success']:
+        return False, out['error'], None
+    return len(out['changedLines']) != 0, None, out['text']
+
+def processFile(path, mode, inPlace, keepText, encoding, workers=1):
+    """Processes one file for the command line. Returns (path, changed,
+    errorMessage, text); text is only kept when keepText is true, so it is
+    not passed back from worker processes for nothing."""
+    try:
+        text = readFile(path, encoding)
+    except (IOError, OSError, UnicodeError) as e:
+        return path, False, "%s: %s" % (path, e), None
+
+    changed, error, outText = processFileText(text, mode, inPlace or keepText, workers)
+    if error is not None:
+        return path, False, errorMessage(path, error), text if keepText else None
+
+    if changed and inPlace:
+        try:
+            writeFileAtomic(path, outText, encoding)
+        except (IOError, OSError) as e:
+            return path, changed, "%s: %s" % (path, e), None
+    return path, changed, None, outText if keepText else None
+
+# NOTE: With --cache FILE, the command line keeps an index of the files it
+#       has seen, by absolute path: their size, mtime and content hash, and
+#       the outcome of each mode, ['clean'], ['changed'] or ['error', lineNo,
+#       x, message]. A file whose size and mtime are the same is not read,
+#       and a file whose content hash is the same is not processed, except
+#       to rewrite it in place. A file can change again within the same
+#       mtime tick, and the tick of some filesystems is a whole second or
+#       more, so the size and mtime are only trusted for files last modified
+#       RACY_MARGIN_NS before the run that wrote the index started, and
+#       before the mtime of the index itself, which comes from the same
+#       clock as theirs. The other files are hashed. The index is dropped
+#       when parinfer.py changes, and written through a temporary file.
+
+RACY_MARGIN_NS = 2 * 10 ** 9
+
+def cacheVersion():
+    """Returns the version of the library, with a hash of parinfer.py, so
+    that a development copy invalidates the index too."""
+    with open(parinfer.__file__, 'rb') as f:
+        return parinfer.__version__ + "/" + hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+def hashContent(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def isValidOutcome(outcome):
+    if outcome in (['clean'], ['changed']):
+        return True
+    return (isinstance(outcome, list) and len(outcome) == 4 and outcome[0] == 'error' and
+            isinstance(outcome[1], int) and isinstance(outcome[2], int) and
+            isinstance(outcome[3], str))
+
+def isValidEntry(entry):
+    """Whether an entry of the index has the fields of the right types, so
+    that a damaged or hand-edited entry is dropped rather than used."""
+    return (isinstance(entry, dict) and isinstance(entry.get('size'), int) and
+            isinstance(entry.get('mtime'), int) and isinstance(entry.get('hash'), str) and
+            isinstance(entry.get('results'), dict) and
+            all(isValidOutcome(outcome) for outcome in entry['results'].values()))
+
+def loadCacheIndex(path, encoding):
+    """Returns the files of the index at path, or {} when the index is
+    missing, unreadable or from another version or encoding. The entries
+    that are not valid are left out, so their files are processed again."""
+    try:
+        with open(path, 'rb') as f:
+            indexMtime = os.fstat(f.fileno()).st_mtime_ns
+            index = json.loads(f.read().decode('utf-8'))
+        if index['version'] == cacheVersion() and index['encoding'] == encoding:
+            files = {key: entry for key, entry in index['files'].items() if isValidEntry(entry)}
+            # see the NOTE above
+            trustedBefore = min(index['time'], indexMtime) - RACY_MARGIN_NS
+            for entry in files.values():
+                entry['trusted'] = entry['mtime'] < trustedBefore
+            return files
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return {}
+
+def saveCacheIndex(path, encoding, files, startTime):
+    for entry in files.values():
+        entry.pop('trusted', None)
+    index = {
+        'version': cacheVersion(),
+        'encoding': encoding,
+        'time': startTime,
+        'files': files,
+    }
+    writeFileAtomic(path, json.dumps(index, separators=(',', ':'), sort_keys=True), 'utf-8')
+
+def cachedOutcome(path, mode, inPlace, entry):
+    """Returns what processCachedFile returns, from the index entry of path
+    alone, or None when the file has to be read."""
+    if entry is None or not entry['trusted'] or mode not in entry['results']:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    outcome = entry['results'][mode]
+    if ((stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime']) or
+            (inPlace and outcome[0] == 'changed')):
+        return None
+    return reportOutcome(path, outcome) + (entry,)
+
+def reportOutcome(path, outcome):
+    """Returns (path, changed, errorMessage) for an outcome of the index."""
+    if outcome[0] == 'error':
+        error = {'lineNo': outcome[1], 'x': outcome[2], 'message': outcome[3]}
+        return path, False, errorMessage(path, error)
+    return path, outcome[0] == 'changed', None
+
+def processCachedFile(path, mode, inPlace, encoding, entry, workers=1):
+    """Does what processFile does with --check or --in-place, and uses the
+    outcome of entry, the index entry of path (or None), when the content
+    hash of the file is still the same. Returns (path, changed, errorMessage,
+    newEntry), newEntry being None when the file could not be read or
+    written."""
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+    except (IOError, OSError) as e:
+        return path, False, "%s: %s" % (path, e), None
+
+    digest = hashContent(data)
+    results = {}
+    if entry is not None and entry['hash'] == digest:
+        results = dict(entry['results'])
+    outcome = results.get(mode)
+
+    if outcome is None or (inPlace and outcome[0] == 'changed'):
+        try:
+            text = data.decode(encoding)
+        except UnicodeError as e:
+            return path, False, "%s: %s" % (path, e), None
+        changed, error, outText = processFileText(text, mode, inPlace, workers)
+        if error is not None:
+            outcome = ['error', error['lineNo'], error['x'], error['message']]
+        elif changed and inPlace:
+            try:
+                writeFileAtomic(path, outText, encoding)
+                stat = os.stat(path)
+            except (IOError, OSError) as e:
+                return path, True, "%s: %s" % (path, e), None
+            # the new content has no outcome yet
+            newEntry = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': hashContent(outText.encode(encoding)),
+                'results': {},
+            }
+            return path, True, None, newEntry
+        else:
+            outcome = ['changed' if changed else 'clean']
+        results[mode] = outcome
+
+    newEntry = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': digest,
+        'results': results,
+    }
+    return reportOutcome(path, outcome) + (newEntry,)
+
+def processCachedFiles(paths, mode, inPlace, encoding, jobs, cachePath):
+    """Processes the files for --cache. Returns a list of (path, changed,
+    errorMessage, None), in the order of paths, and updates the index."""
+    startTime = time.time_ns()
+    files = loadCacheIndex(cachePath, encoding)
+    keys = [os.path.abspath(path) for path in paths]
+
+    outcomes = [cachedOutcome(path, mode, inPlace, files.get(key)) for path, key in zip(paths, keys)]
+    todo = [i for i in range(len(paths)) if outcomes[i] is None]
+    todoArgs = ([paths[i] for i in todo], repeat(mode), repeat(inPlace), repeat(encoding),
+                [files.get(keys[i]) for i in todo])
+    if jobs == 1 or len(todo) <= 1:
+        workers = jobs if len(paths) == 1 else 1
+        done = list(map(processCachedFile, *todoArgs, repeat(workers)))
+    else:
+        # imported here, like in parinfer.py, as it is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            done = list(executor.map(processCachedFile, *todoArgs,
+                                     chunksize=max(1, len(todo) // (jobs * 4))))
+    for i, outcome in zip(todo, done):
+        outcomes[i] = outcome
+
+    for key, outcome in zip(keys, outcomes):
+        if outcome[3] is not None:
+            files[key] = outcome[3]
+        else:
+            files.pop(key, None)
+    try:
+        saveCacheIndex(cachePath, encoding, files, startTime)
+    except (IOError, OSError) as e:
+        sys.stderr.write("%s: %s\n" % (cachePath, e))
+    return [outcome[:3] + (None,) for outcome in outcomes]
+
+def expandPaths(patterns):
+    """Expands glob patterns. Anything that matches no file is kept as is,
+    so that reading it reports the error."""
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+def reportResults(results, isCheck):
+    """Writes the (path, changed, errorMessage, text) results of the files
+    as they come. Returns the exit status."""
+    status = 0
+    for path, changed, message, text in results:
+        if message is not None:
+            sys.stderr.write(message + "\n")
+            status = 1
+        if text is not None:
+            sys.stdout.write(text)
+        elif changed:
+            sys.stdout.write(path + "\n")
+            if isCheck:
+                status = 1
+    return status
+
+def main(argv=None):
+    """Entry point of python -m parinfer. Returns the exit status: 0 when
+    all went well, 1 on errors or, with --check, when a file would change."""
+    parser = argparse.ArgumentParser(
+        prog='python -m parinfer',
+        description='Corrects the parens (indent mode) or the indentation '
+                    '(paren mode) of Lisp files.')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='files or glob patterns (** is recursive), '
+                             'reads stdin and writes stdout when none is given')
+    parser.add_argument('-m', '--mode', choices=['indent', 'paren'], default='paren',
+                        help='indent mode infers the parens from the '
+                             'indentation, paren mode (the default) corrects '
+                             'the indentation from the parens')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--check', action='store_true',
+                        help='only list the files that would change')
+    action.add_argument('-i', '--in-place', action='store_true',
+                        help='rewrite the files that change')
+    action.add_argument('--serve', action='store_true',
+                        help='run a JSON-RPC server for editors on stdio')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='with --serve, listen on a Unix socket instead')
+    parser.add_argument('--coalesce', type=float, default=0, metavar='MS',
+                        help='with --serve, wait MS milliseconds for more '
+                             'keystrokes before processing an edit')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='number of worker processes, 0 for one per CPU')
+    parser.add_argument('--encoding', default='utf-8',
+                        help='encoding of the files (default: utf-8)')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='with --check or --in-place, keep the results in '
+                             'the index FILE and skip the files that did not '
+                             'change since')
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        if args.paths:
+            parser.error('--serve takes no PATH')
+        # asyncio alone takes about 60 ms to import, so only the server loads it
+        from parinfer_server import serve
+        return serve(args.socket, args.coalesce / 1000.0)
+
+    mode = INDENT_MODE if args.mode == 'indent' else PAREN_MODE
+    keepText = not (args.check or args.in_place)
+    if args.cache is not None and keepText:
+        parser.error('--cache needs --check or --in-place')
+
+    if not args.paths:
+        if args.in_place:
+            parser.error('--in-place needs at least one PATH')
+        text = sys.stdin.read()
+        if args.check:
+            checked = check(text, mode)
+            if not checked['success']:
+                sys.stderr.write(errorMessage("<stdin>", checked['error']) + "\n")
+                return 1
+            if checked['changedLineNo'] is not None:
+                sys.stdout.write("<stdin>\n")
+                return 1
+            return 0
+        result = processText(text, None, mode)
+        if not result.success:
+            sys.stderr.write(errorMessage("<stdin>", result.error) + "\n")
+        sys.stdout.write(publicResult(result)['text'])
+        return 0 if result.success else 1
+
+    paths = expandPaths(args.paths)
+    jobs = args.jobs
+    if jobs <= 0:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    if args.cache is not None:
+        results = processCachedFiles(paths, mode, args.in_place, args.encoding, jobs, args.cache)
+    elif jobs == 1:
+        results = (processFile(path, mode, args.in_place, keepText, args.encoding) for path in paths)
+    elif len(paths) == 1:
+        # one big file: cut it into pieces instead
+        results = [processFile(paths[0], mode, args.in_place, keepText, args.encoding, jobs)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            results = executor.map(processFile, paths, repeat(mode), repeat(args.in_place),
+                                   repeat(keepText), repeat(args.encoding),
+                                   chunksize=max(1, len(paths) // (jobs * 4)))
+            return reportResults(results, args.check)
+    return reportResults(results, args.check)
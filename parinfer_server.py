@@ -0,0 +1,326 @@
+## The JSON-RPC server of Parinfer.py, for editors that cannot load Python:
+##   python -m parinfer --serve [--socket PATH] [--coalesce MS]
+## Each open buffer keeps an IncrementalProcessor of parinfer.py.
+
+import asyncio
+import json
+import os
+import sys
+from parinfer import INDENT_MODE, PAREN_MODE, LINE_ENDING_REGEX, IncrementalProcessor, splitLines
+
+# NOTE: python -m parinfer --serve speaks JSON-RPC 2.0 over stdio, or over a
+#       Unix socket with --socket, one JSON message per line. Each connection
+#       has its own buffers. Methods:
+#
+#       open     {buffer, mode, text, options}  mode is "indent" or "paren"
+#       edit     {buffer, startLine, endLine, lines, options, applied}
+#                replaces the lines in [startLine, endLine) with lines
+#       close    {buffer}
+#       shutdown stops the server
+#       $/cancelRequest {id}  (notification)
+#
+#       open and edit answer {success, changedLines} or {success, error}, for
+#       the text after the edit. The server only takes the changedLines of an
+#       answer into its copy of the buffer when the next edit names that
+#       answer's id in applied, since the client may have edited the buffer
+#       again before the answer came in, and then has to drop it.
+#
+#       Edits that queue up behind a running one are processed together, and
+#       all but the last are answered with a RequestCancelled error. So is an
+#       edit that goes stale, because a newer one came in while it was being
+#       processed, and an edit cancelled with $/cancelRequest. An edit that
+#       makes Parinfer itself fail is answered with an InternalError.
+
+RPC_PARSE_ERROR = -32700
+RPC_INVALID_REQUEST = -32600
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INVALID_PARAMS = -32602
+RPC_INTERNAL_ERROR = -32603
+RPC_REQUEST_CANCELLED = -32800
+
+# big enough for the whole text of a buffer
+MAX_MESSAGE_SIZE = 1 << 28
+
+RPC_MODES = {'indent': INDENT_MODE, 'paren': PAREN_MODE}
+
+class RpcError(Exception):
+    pass
+
+def rpcParam(params, name, types, optional=False):
+    value = params.get(name)
+    if value is None and optional:
+        return None
+    if not isinstance(value, types) or isinstance(value, bool):
+        raise RpcError(RPC_INVALID_PARAMS, "Invalid or missing param: %s" % name)
+    return value
+
+class Session(object):
+    """An open buffer: its lines as the client has them, the processor that
+    saw their last processed version, and the edits waiting for an answer.
+
+    span is (start, oldEnd, end) when the lines differ from the ones the
+    processor saw: lines[start:end] replace its origLines[start:oldEnd], and
+    the lines around them are the same. It is None when nothing changed."""
+
+    def __init__(self, mode, text):
+        self.lines, self.lineEnding = splitLines(text)
+        self.restart(mode)
+        self.pending = []
+        self.lastAnswer = None
+        self.task = None
+
+    def restart(self, mode):
+        """Starts over with a new processor, which has seen no lines."""
+        self.processor = IncrementalProcessor(mode)
+        self.processor.lineEnding = self.lineEnding
+        self.span = (0, 0, len(self.lines))
+
+    def replace(self, startLine, endLine, newLines):
+        """Replaces the lines in [startLine, endLine) with newLines, and
+        widens the span to hold them."""
+        self.lines[startLine:endLine] = newLines
+        newEnd = startLine + len(newLines)
+        if self.span is None:
+            self.span = (startLine, endLine, newEnd)
+            return
+        start, oldEnd, end = self.span
+        # the first line past both, and where it was before the edit
+        last = max(end, endLine)
+        self.span = (min(start, startLine), last + oldEnd - end, last + newEnd - endLine)
+
+class RpcConnection(object):
+    """The buffers and requests of one client. write is called with each
+    outgoing message, as a line of JSON."""
+
+    def __init__(self, write, delay):
+        self.write = write
+        self.delay = delay
+        self.sessions = {}
+        self.requests = {}
+        self.isShutdown = False
+        self.shutdownId = None
+
+    def send(self, message):
+        message['jsonrpc'] = "2.0"
+        self.write(json.dumps(message, separators=(',', ':')) + "\n")
+
+    def fail(self, id, code, message):
+        self.send({'id': id, 'error': {'code': code, 'message': message}})
+
+    def receive(self, line):
+        """Handles one incoming message."""
+        try:
+            message = json.loads(line)
+        except ValueError:
+            self.fail(None, RPC_PARSE_ERROR, "Parse error")
+            return
+        if not isinstance(message, dict) or not isinstance(message.get('method'), str):
+            self.fail(None, RPC_INVALID_REQUEST, "Invalid request")
+            return
+
+        id = message.get('id')
+        params = message.get('params', {})
+        try:
+            handler = self.methods.get(message['method'])
+            if handler is None:
+                raise RpcError(RPC_METHOD_NOT_FOUND, "Method not found: %s" % message['method'])
+            if not isinstance(params, dict):
+                raise RpcError(RPC_INVALID_PARAMS, "params must be an object")
+            handler(self, id, params)
+        except RpcError as e:
+            if id is not None:
+                self.fail(id, e.args[0], e.args[1])
+
+    def session(self, params):
+        session = self.sessions.get(rpcParam(params, 'buffer', str))
+        if session is None:
+            raise RpcError(RPC_INVALID_PARAMS, "Unknown buffer")
+        return session
+
+    def onOpen(self, id, params):
+        buffer = rpcParam(params, 'buffer', str)
+        mode = RPC_MODES.get(params.get('mode'))
+        if mode is None:
+            raise RpcError(RPC_INVALID_PARAMS, "mode must be \"indent\" or \"paren\"")
+        session = Session(mode, rpcParam(params, 'text', str))
+        self.sessions[buffer] = session
+        self.enqueue(session, id, rpcParam(params, 'options', dict, True))
+
+    def onEdit(self, id, params):
+        session = self.session(params)
+        startLine = rpcParam(params, 'startLine', int)
+        endLine = rpcParam(params, 'endLine', int)
+        lines = rpcParam(params, 'lines', list)
+        options = rpcParam(params, 'options', dict, True)
+
+        if session.lastAnswer is not None and params.get('applied') == session.lastAnswer[0]:
+            for line in session.lastAnswer[1]:
+                session.replace(line['lineNo'], line['lineNo'] + 1, [line['line']])
+        session.lastAnswer = None
+
+        if not 0 <= startLine <= endLine <= len(session.lines):
+            raise RpcError(RPC_INVALID_PARAMS, "Line range out of the buffer")
+        if not all(isinstance(line, str) for line in lines):
+            raise RpcError(RPC_INVALID_PARAMS, "lines must be strings")
+        newLines = []
+        for line in lines:
+            newLines.extend(LINE_ENDING_REGEX.split(line))
+        session.replace(startLine, endLine, newLines)
+        self.enqueue(session, id, options)
+
+    def onClose(self, id, params):
+        self.session(params)
+        del self.sessions[params['buffer']]
+        if id is not None:
+            self.send({'id': id, 'result': None})
+
+    def onShutdown(self, id, params):
+        self.isShutdown = True
+        self.shutdownId = id
+
+    def onCancel(self, id, params):
+        entry = self.requests.get(params.get('id'))
+        if entry is not None:
+            self.cancel(entry)
+
+    methods = {
+        'open': onOpen,
+        'edit': onEdit,
+        'close': onClose,
+        'shutdown': onShutdown,
+        '$/cancelRequest': onCancel,
+    }
+
+    def enqueue(self, session, id, options):
+        # [id, options, isAnswered]
+        entry = [id, options, id is None]
+        session.pending.append(entry)
+        if id is not None:
+            self.requests[id] = entry
+        if session.task is None:
+            session.task = asyncio.ensure_future(self.process(session))
+
+    def cancel(self, entry):
+        if not entry[2]:
+            entry[2] = True
+            del self.requests[entry[0]]
+            self.fail(entry[0], RPC_REQUEST_CANCELLED, "Request cancelled")
+
+    async def process(self, session):
+        """Processes the pending edits of a session until there are none."""
+        loop = asyncio.get_event_loop()
+        try:
+            while session.pending:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                batch = session.pending
+                session.pending = []
+                # the edits of the batch and the answers taken in since the
+                # last run, as one edit of the lines the processor saw
+                span = session.span
+                if span is None:
+                    span = (0, 0, 0)
+                start, oldEnd, end = span
+                session.span = None
+                try:
+                    # only the changedLines are sent, so the text is not joined
+                    out = await loop.run_in_executor(None, session.processor.edit, start, oldEnd,
+                                                     session.lines[start:end], batch[-1][1], False)
+                except Exception as e:
+                    # start over with a full run on the next edit
+                    session.restart(session.processor.mode)
+                    for entry in batch:
+                        if not entry[2]:
+                            entry[2] = True
+                            del self.requests[entry[0]]
+                            self.fail(entry[0], RPC_INTERNAL_ERROR, "Internal error: %r" % e)
+                    continue
+
+                # the answer is stale once newer edits came in
+                if session.pending:
+                    for entry in batch:
+                        self.cancel(entry)
+                    continue
+                for entry in batch[:-1]:
+                    self.cancel(entry)
+
+                entry = batch[-1]
+                if entry[2]:
+                    continue
+                entry[2] = True
+                del self.requests[entry[0]]
+                if out['success']:
+                    session.lastAnswer = (entry[0], out['changedLines'])
+                    result = {'success': True, 'changedLines': out['changedLines']}
+                else:
+                    result = {'success': False, 'error': out['error']}
+                self.send({'id': entry[0], 'result': result})
+        finally:
+            session.task = None
+
+async def serveConnection(reader, write, delay):
+    """Handles the messages of one client. Returns True if it asked for a
+    shutdown."""
+    connection = RpcConnection(write, delay)
+    while not connection.isShutdown:
+        line = await reader.readline()
+        if not line:
+            break
+        connection.receive(line)
+
+    # answer what was asked before leaving
+    tasks = [session.task for session in connection.sessions.values() if session.task is not None]
+    if tasks:
+        await asyncio.wait(tasks)
+    if connection.shutdownId is not None:
+        connection.send({'id': connection.shutdownId, 'result': None})
+    return connection.isShutdown
+
+async def runServer(socketPath, delay):
+    loop = asyncio.get_event_loop()
+
+    if socketPath is None:
+        reader = asyncio.StreamReader(limit=MAX_MESSAGE_SIZE)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        await serveConnection(reader, write, delay)
+        return
+
+    stopped = asyncio.Event()
+    clients = set()
+    async def onClient(reader, writer):
+        clients.add(asyncio.current_task())
+        try:
+            def write(text):
+                writer.write(text.encode('utf-8'))
+            if await serveConnection(reader, write, delay):
+                stopped.set()
+            await writer.drain()
+        except asyncio.CancelledError:
+            # another client shut the server down
+            pass
+        finally:
+            writer.close()
+            clients.discard(asyncio.current_task())
+
+    if os.path.exists(socketPath):
+        os.unlink(socketPath)
+    server = await asyncio.start_unix_server(onClient, socketPath, limit=MAX_MESSAGE_SIZE)
+    try:
+        await stopped.wait()
+    finally:
+        server.close()
+        os.unlink(socketPath)
+        for task in list(clients):
+            task.cancel()
+        if clients:
+            await asyncio.wait(clients)
+
+def serve(socketPath=None, delay=0.0):
+    """Runs the JSON-RPC server on stdio, or on a Unix socket at socketPath,
+    until a shutdown request or the end of stdin. delay is how long to wait,
+    in seconds, for more keystrokes before processing an edit."""
+    asyncio.run(runServer(socketPath, delay))
+    return 0
@@ -1,25 +1,293 @@
+## This file runs performance stress tests for Parinfer.
+##   python perf.py [file] [scaling] [prescan] [batch] [parallel] [stream] [keystroke] [--profile]
+## Runs all of the sections when none is given. Exits with status 1 when a
+## text of the scaling section takes more than linear time or memory.
+
 import cProfile
+import math
+import multiprocessing
+import random
+import sys
+import tempfile
 import time
-from parinfer import indent_mode, paren_mode
+import tracemalloc
+import parinfer
+from parinfer import (indent_mode, paren_mode, check, process_many, process_parallel, stream_lines,
+                      IncrementalProcessor, FormProcessor, INDENT_MODE, PAREN_MODE)
+
+REPEAT = 5
+PROFILE = "--profile" in sys.argv
+
+def bestTime(fn, string, options, repeat=REPEAT):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        fn(string, options)
+        dt = time.perf_counter() - t
+        if best is None or dt < best:
+            best = dt
+    return best
 
 def timeProcess(string, options):
-  numlines = len(string.splitlines())
-  print "Testing file with", numlines, "lines"
+    numlines = len(string.splitlines())
+    numchars = len(string)
+    print("Testing file with", numlines, "lines and", numchars, "chars")
+
+    dt = bestTime(indent_mode, string, options)
+    print("Indent Mode:", dt, "s", "(%.3f us/char)" % (dt * 1e6 / numchars))
+
+    dt = bestTime(paren_mode, string, options)
+    print("Paren Mode:", dt, "s", "(%.3f us/char)" % (dt * 1e6 / numchars))
+
+    for mode in (INDENT_MODE, PAREN_MODE):
+        dt = bestTime(lambda string, options: check(string, mode), string, options)
+        print("Check", mode + ":", dt, "s", "(%.3f us/char)" % (dt * 1e6 / numchars))
+
+    if PROFILE:
+        cProfile.runctx("indent_mode(string, options)", globals(), locals())
+        cProfile.runctx("paren_mode(string, options)", globals(), locals())
+
+# the largest scaling exponent of time and peak memory that counts as linear,
+# with some room for noise
+MAX_EXPONENT = 1.3
+
+def fitExponent(sizes, values):
+    """Returns the slope of the least-squares line through the points
+    (log size, log value): about 1 when the values grow linearly with the
+    size, and 2 when they grow quadratically."""
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(max(value, 1e-9)) for value in values]
+    meanX = sum(xs) / len(xs)
+    meanY = sum(ys) / len(ys)
+    num = sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys))
+    den = sum((x - meanX) ** 2 for x in xs)
+    return num / den
+
+def timeScaling(name, makeText, sizes, makeOptions=None):
+    """Times both modes on texts of growing size, and measures their peak
+    memory. The time per char should stay flat as the size grows. Returns
+    the number of exponents of time and memory that are above MAX_EXPONENT.
+    They are fitted over all the sizes but the smallest one, where fixed
+    costs and the free lists of the allocator hide the growth."""
+    print(name)
+    measures = {INDENT_MODE: ([], []), PAREN_MODE: ([], [])}
+    for n in sizes:
+        string = makeText(n)
+        options = makeOptions(n) if makeOptions is not None else None
+        row = []
+        for mode, fn in ((INDENT_MODE, indent_mode), (PAREN_MODE, paren_mode)):
+            times, memory = measures[mode]
+            times.append(bestTime(fn, string, options, 3))
+            memory.append(peakMemory(lambda: fn(string, options)))
+            row.append(times[-1] * 1e6 / len(string))
+            row.append(memory[-1] / len(string))
+        print("  %6d: indent %.3f us/char %.1f B/char, paren %.3f us/char %.1f B/char" % (
+            (n,) + tuple(row)))
+
+    failures = 0
+    exponents = []
+    for mode, label in ((INDENT_MODE, "indent"), (PAREN_MODE, "paren")):
+        for values, measure in zip(measures[mode], ("time", "memory")):
+            exponent = fitExponent(sizes[1:], values[1:])
+            flag = ""
+            if exponent > MAX_EXPONENT:
+                failures = failures + 1
+                flag = " SUPER-LINEAR"
+            exponents.append("%s %s n^%.2f%s" % (label, measure, exponent, flag))
+    print("  " + ", ".join(exponents))
+    return failures
+
+def timePrescan(text, sizes):
+    """Times both modes on texts of growing size, searching each line for
+    the chars to dispatch and with the prescan option, and times the
+    pre-scan alone, with NumPy (when installed) and with re.finditer."""
+    lines = text.split("\n")
+    print("Pre-scan,", "with NumPy" if parinfer.importNumpy() is not None else "without NumPy")
+    for n in sizes:
+        string = "\n".join((lines * (n // len(lines) + 1))[:n])
+        numchars = len(string)
+        repeat = max(1, min(REPEAT, 100000 // n))
+        times = []
+        for fn in (indent_mode, paren_mode):
+            times.append(bestTime(fn, string, None, repeat) * 1e6 / numchars)
+            times.append(bestTime(fn, string, {'prescan': True}, repeat) * 1e6 / numchars)
+        print("  %7d lines: indent %.3f / prescan %.3f us/char, paren %.3f / prescan %.3f us/char" % (
+            (n,) + tuple(times)))
+
+        splitLines = string.split("\n")
+        scans = [("re.finditer", parinfer.scanLinesRegex)]
+        if parinfer.importNumpy() is not None:
+            scans.append(("NumPy", parinfer.scanLinesNumpy))
+        print("  %7s  pre-scan alone: %s" % ("", ", ".join(
+            "%s %.3f us/char" % (name, bestTime(lambda string, options: scan(splitLines), string,
+                                                None, repeat) * 1e6 / numchars)
+            for name, scan in scans)))
+
+def makeCorpus(text, numFiles, seed=0):
+    """Cuts numFiles files of 50 to 300 lines out of text."""
+    rng = random.Random(seed)
+    lines = text.split("\n")
+    corpus = []
+    for i in range(numFiles):
+        start = rng.randrange(len(lines))
+        corpus.append("\n".join(lines[start:start + rng.randrange(50, 300)]))
+    return corpus
+
+def timeBatch(corpus):
+    """Times process_many over the corpus with a growing number of workers."""
+    numchars = sum(len(text) for text in corpus)
+    print("Batch of", len(corpus), "files and", numchars, "chars,",
+          multiprocessing.cpu_count(), "CPUs")
+
+    workers = 1
+    while workers <= max(2, multiprocessing.cpu_count()):
+        for mode in (INDENT_MODE, PAREN_MODE):
+            t = time.perf_counter()
+            process_many(corpus, mode, workers=workers)
+            dt = time.perf_counter() - t
+            print("  %2d workers, %s: %.0f files/s, %.2f MB/s" % (
+                workers, mode, len(corpus) / dt, numchars / dt / 1e6))
+        workers = workers * 2
+
+def timeParallel(text):
+    """Times process_parallel on one big text with a growing number of
+    workers, against a serial run."""
+    print("One text of", len(text), "chars,", multiprocessing.cpu_count(), "CPUs")
+    for mode, fn in ((INDENT_MODE, indent_mode), (PAREN_MODE, paren_mode)):
+        t = time.perf_counter()
+        fn(text, None)
+        print("  serial, %s: %.2f MB/s" % (mode, len(text) / (time.perf_counter() - t) / 1e6))
+        workers = 2
+        while workers <= max(2, multiprocessing.cpu_count()):
+            t = time.perf_counter()
+            process_parallel(text, mode, workers=workers)
+            dt = time.perf_counter() - t
+            print("  %2d workers, %s: %.2f MB/s" % (workers, mode, len(text) / dt / 1e6))
+            workers = workers * 2
+
+def peakMemory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def memoryStream(text, copies):
+    """Compares the peak memory of indent_mode and stream_lines on files made
+    of more and more copies of text. stream_lines should stay flat."""
+    print("Peak memory, indent_mode vs. stream_lines")
+    for n in copies:
+        with tempfile.NamedTemporaryFile("w+") as f:
+            f.write(text * n)
+            f.flush()
+
+            def full():
+                f.seek(0)
+                indent_mode(f.read(), None)
+
+            def stream():
+                f.seek(0)
+                for line in stream_lines(f, INDENT_MODE):
+                    pass
+
+            print("  %3d copies (%.1f MB): indent_mode %.2f MB, stream_lines %.2f MB" % (
+                n, len(text) * n / 1e6, peakMemory(full) / 1e6, peakMemory(stream) / 1e6))
+
+def timeKeystrokes(text, numLines, numKeys=50, seed=0):
+    """Types numKeys chars at random places of copies of text, about numLines
+    lines in all, and compares the time per keystroke of a full run,
+    IncrementalProcessor and FormProcessor."""
+    lines = text.split("\n")
+    lines = lines * max(1, round(numLines / len(lines)))
+    numLines = len(lines)
+    rng = random.Random(seed)
+    keys = []
+    for i in range(numKeys):
+        lineNo = rng.randrange(numLines)
+        x = rng.randint(0, len(lines[lineNo]))
+        keys.append((lineNo, x, rng.choice("abc ")))
+
+    print("Keystrokes in a text of", numLines, "lines")
+    for mode, fn in ((INDENT_MODE, indent_mode), (PAREN_MODE, paren_mode)):
+        for name in ("full run", "IncrementalProcessor", "FormProcessor"):
+            processor = None
+            if name == "IncrementalProcessor":
+                processor = IncrementalProcessor(mode)
+            elif name == "FormProcessor":
+                processor = FormProcessor(mode)
+            current = list(lines)
+            if processor is not None:
+                processor.update("\n".join(current))
+
+            total = 0
+            for lineNo, x, ch in keys:
+                line = current[lineNo]
+                current[lineNo] = line[:x] + ch + line[x:]
+                options = {'cursorLine': lineNo, 'cursorX': x + 1}
+                t = time.perf_counter()
+                if processor is None:
+                    fn("\n".join(current), options)
+                else:
+                    processor.edit(lineNo, lineNo + 1, [current[lineNo]], options)
+                total = total + time.perf_counter() - t
+            print("  %s, %-20s %8.3f ms/keystroke" % (mode, name + ":", total * 1e3 / numKeys))
+
+SIZES = [4000, 16000, 64000, 256000]
+
+# (name, makeText, makeOptions) of texts that grow along one line, or in the
+# number of lines, and that take more than linear time or memory when a line
+# or the paren trail is rebuilt for each char
+SCALING_CASES = [
+    ("Line of tabs (columns)", lambda n: "(foo" + "\t" * n + "bar)", None),
+    ("Tab-indented lines (lines)", lambda n: "(defn foo []\n" + "\t\t(bar\t\tbaz)\n" * n + ")", None),
+    ("Line of unmatched close-parens (columns)", lambda n: "(foo " + "]" * n + ")", None),
+    ("Line of blank spaces and close-parens (columns)", lambda n: "(((" + " )" * n, None),
+    ("Paren trail clamped by the cursor (columns)", lambda n: "(" * n + "x" + ")" * n,
+     lambda n: {'cursorLine': 0, 'cursorX': n + 1 + n // 2}),
+    ("Paren trail corrected at once (columns)", lambda n: "(" * n + "x\ny", None),
+    ("Leading close-parens moved to the paren trail (columns)", lambda n: "(" * n + "x\n" + ")" * n, None),
+    ("Comment full of quotes (columns)", lambda n: "(foo ; " + '"' * n + "\n bar)", None),
+    ("Comment lines with quotes (lines)", lambda n: "(foo\n" + ' ; "a" "b" "\n' * n + " bar)", None),
+    ("Line of strings (columns)", lambda n: "(foo " + '"a" ' * n + ")", None),
+]
+
+if __name__ == "__main__":
+    sections = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not sections:
+        sections = ["file", "scaling", "prescan", "batch", "parallel", "stream", "keystroke"]
+
+    with open('tests/really_long_file', 'r') as f:
+        text = f.read()
+
+    if "file" in sections:
+        timeProcess(text, {})
+
+    status = 0
+    if "scaling" in sections:
+        failures = 0
+        for name, makeText, makeOptions in SCALING_CASES:
+            # a case is measured again before it fails, in case of noise
+            if (timeScaling(name, makeText, SIZES, makeOptions) and
+                    timeScaling(name + ", again", makeText, SIZES, makeOptions)):
+                failures = failures + 1
+        if failures:
+            print(failures, "cases scale worse than n^%s" % MAX_EXPONENT)
+            status = 1
+
+    if "prescan" in sections:
+        timePrescan(text, [1000, 10000, 100000, 1000000])
 
-  t = time.clock()
-  indent_mode(string, options)
-  dt = time.clock() - t
-  print "Indent Mode:", dt, "s"
+    if "batch" in sections:
+        timeBatch(makeCorpus(text, 2000))
 
-  t = time.clock()
-  paren_mode(string, options)
-  dt = time.clock() - t
-  print "Paren Mode:", dt, "s"
+    if "parallel" in sections:
+        timeParallel("\n".join([text] * 32))
 
-  cProfile.runctx("indent_mode(string, options)", globals(), locals())
-  cProfile.runctx("paren_mode(string, options)", globals(), locals())
+    if "stream" in sections:
+        memoryStream(text, [1, 4, 16, 64])
 
-with open('tests/really_long_file', 'r') as f:
-    text = f.read()
+    if "keystroke" in sections:
+        timeKeystrokes(text, 20000)
 
-timeProcess(text, {})
+    sys.exit(status)
@@ -2,9 +2,20 @@
 ## NOTE: this file is pretty quick and dirty
 ##       it could use some work to be more robust
 
+import asyncio
+import contextlib
+import io
 import json
-import unittest2
-from parinfer import indent_mode, paren_mode
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from parinfer import indent_mode, paren_mode, normalize, LexedText, check, resume, map_position, process_lines, process_bytes, process_many, process_parallel, stream_lines, IncrementalProcessor, FormProcessor, ResultCache, FormCache, ParinferError, INDENT_MODE, PAREN_MODE
+from parinfer import scanLines, scanLinesRegex, scanLinesNumpy, importNumpy, splitLines
+from parinfer_cli import main
+from parinfer_server import serveConnection
 
 # load test files
 with open('./tests/indent-mode.json') as indent_mode_tests_json:
@@ -17,12 +28,33 @@ modeFn = {
   'paren': paren_mode
 }
 
+modeName = {
+  'indent': INDENT_MODE,
+  'paren': PAREN_MODE
+}
+
 oppositeModeFn = {
   'indent': paren_mode,
   'paren': indent_mode
 }
 
-class TestParinfer(unittest2.TestCase):
+closeParens = {'(': ')', '[': ']', '{': '}'}
+
+def outlineForms(outline):
+    return [outline.form(i) for i in range(len(outline))]
+
+def thaw(result):
+    """Turns a read-only result of the caches back into a plain one."""
+    result = dict(result)
+    if result['success']:
+        result['changedLines'] = [dict(line) for line in result['changedLines']]
+        if 'edits' in result:
+            result['edits'] = [dict(edit) for edit in result['edits']]
+    else:
+        result['error'] = dict(result['error'])
+    return result
+
+class TestParinfer(unittest.TestCase):
 
     def run_test(self, test, mode):
         test_id = test['in']['fileLineNo']
@@ -78,5 +110,709 @@ class TestParinfer(unittest2.TestCase):
         self.check_changed_lines('paren', "(foo]\nbar)", [{'lineNo': 0, 'line': '(foo'},
                                                      {'lineNo': 1, 'line': ' bar)'}])
 
+    def test_line_endings(self):
+        self.assertEqual(indent_mode("(foo\r\nbar", None)['text'], "(foo)\r\nbar")
+        self.assertEqual(paren_mode("(foo\r\nbar)", None)['text'], "(foo\r\n bar)")
+        self.check_changed_lines('indent', "(foo\r\nbar", [{'lineNo': 0, 'line': '(foo)'}])
+
+    def test_cursor_past_removed_parens(self):
+        self.assertEqual(indent_mode("(a b)]", {'cursorLine': 0, 'cursorX': 6})['text'], "(a b)")
+        self.assertEqual(indent_mode("(a\n b))", {'cursorLine': 1, 'cursorX': 4})['text'], "(a\n b)")
+
+    def test_check(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                for text in ('\n'.join(test['in']['lines']), '\n'.join(test['out']['lines'])):
+                    expected = modeFn[mode](text, None)
+                    result = check(text, modeName[mode])
+                    with self.subTest(test['in']['fileLineNo'], text=text):
+                        if not expected['success']:
+                            # a correction can be found before the error
+                            if not result['success']:
+                                self.assertEqual(result['error'], expected['error'])
+                        elif expected['changedLines']:
+                            lineNos = [line['lineNo'] for line in expected['changedLines']]
+                            self.assertIn(result['changedLineNo'], lineNos)
+                        else:
+                            self.assertEqual(result, {'success': True, 'changedLineNo': None})
+
+        self.assertEqual(check("(foo\n  bar)", PAREN_MODE)['changedLineNo'], None)
+        self.assertEqual(check("(foo\n  bar)\n(baz\nqux)", PAREN_MODE)['changedLineNo'], 3)
+        self.assertEqual(check("(foo (bar)\n  )", INDENT_MODE)['changedLineNo'], 1)
+        self.assertEqual(check("(foo\n  bar)", INDENT_MODE)['changedLineNo'], None)
+        self.assertEqual(check("(foo\n  bar", PAREN_MODE)['error']['name'], 'unclosed-paren')
+
+    def test_result_cache(self):
+        for cache in (ResultCache(), FormCache()):
+            for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+                for test in tests:
+                    text = '\n'.join(test['in']['lines'])
+                    options = test['in']['cursor']
+                    with self.subTest(test['in']['fileLineNo'], cache=type(cache).__name__):
+                        expected = modeFn[mode](text, options)
+                        self.assertEqual(thaw(cache.process(text, options, modeName[mode])), expected)
+                        self.assertEqual(thaw(cache.process(text, options, modeName[mode])), expected)
+
+        cache = ResultCache(maxEntries=2)
+        first = cache.indent_mode("(foo\nbar")
+        self.assertIs(cache.indent_mode("(foo\nbar"), first)
+        self.assertIsNot(cache.indent_mode("(foo\nbar", {'cursorLine': 0, 'cursorX': 4}), first)
+        with self.assertRaises(TypeError):
+            first['text'] = ''
+        cache.paren_mode("(foo\nbar")
+        cache.indent_mode("(foo\nbar")
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 4, 'evictions': 2, 'entries': 2,
+                                         'bytes': sys.getsizeof("(foo\nbar") * 2 + sys.getsizeof("(foo)\nbar")})
+
+        # the size is in bytes, which is more than the chars for wide chars
+        cache = ResultCache(maxBytes=1000)
+        cache.paren_mode("(a)" * 200)
+        cache.paren_mode("(\U0001f600)" * 200)
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], 1000)
+
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0,
+                                         'bytes': 0})
+
+        # only the edited form is processed again
+        cache = FormCache()
+        text = "(foo\n  bar)\n\n(baz\n  \"qux\n(quux\")"
+        self.assertEqual(cache.paren_mode(text)['text'], text)
+        self.assertEqual(cache.stats()['misses'], 2)
+        out = cache.paren_mode(text.replace("bar", "bar]"))
+        self.assertEqual(out['text'], text)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_stats(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                text = '\n'.join(test['in']['lines'])
+                options = dict(test['in']['cursor'] or {}, stats=True)
+                result = modeFn[mode](text, options)
+                self.assertIn('stats', result)
+                del result['stats']
+                self.assertEqual(result, modeFn[mode](text, test['in']['cursor']))
+
+        calls = []
+        class Profiler(object):
+            def enable(self):
+                calls.append('enable')
+            def disable(self):
+                calls.append('disable')
+
+        stats = indent_mode("(foo\n  (bar\nbaz)", {'stats': True, 'profiler': Profiler()})['stats']
+        self.assertEqual(calls, ['enable', 'disable'])
+        for key in ('scanTime', 'finalizeTime', 'resultTime'):
+            self.assertGreaterEqual(stats.pop(key), 0)
+        self.assertEqual(stats, {
+            'chars': 17,
+            'dispatch': {'onOpenParen': 2, 'onCloseParen': 1, 'onNewLine': 3},
+            'maxParenDepth': 2,
+            'parenTrailResets': 6,
+            'correctParenTrail': 2,
+            'appendParenTrail': 0,
+            'removeParenTrail': 3,
+            'lineRewrites': 3,
+        })
+        self.assertNotIn('stats', indent_mode("(foo", None))
+
+        # lines rebuilt from their buffer: a dropped close-paren, and tabs
+        self.assertEqual(paren_mode("(a ]b)", {'stats': True})['stats']['lineRewrites'], 1)
+        self.assertEqual(paren_mode("(foo\n\t\tbar)", {'stats': True})['stats']['lineRewrites'], 1)
+
+        # the stats describe the same run as without them
+        text = "(defn foo\r\n\t[x]\r\n  (bar x ) ;c"
+        for options in ({'edits': True}, {'prescan': True}, None):
+            for source in (text, LexedText(text)):
+                out = indent_mode(source, dict(options or {}, stats=True))
+                self.assertGreater(out.pop('stats')['chars'], 0)
+                self.assertEqual(out, indent_mode(source, options))
+        with self.assertRaises(ValueError):
+            indent_mode(text, {'stats': True, 'lineBudget': 1})
+
+    def check_incremental(self, mode, test, processorClass=IncrementalProcessor, extraOptions=None):
+        in_lines = test['in']['lines']
+        options = test['in']['cursor']
+        noCursor = None
+        if extraOptions is not None:
+            options = dict(options or {}, **extraOptions)
+            noCursor = extraOptions
+        processor = processorClass(modeName[mode])
+
+        def check(result, lines, options, withText=True):
+            expected = modeFn[mode]('\n'.join(lines), options)
+            if not withText:
+                expected.pop('text', None)
+            if 'outline' in expected:
+                self.assertEqual(outlineForms(result.pop('outline')),
+                                 outlineForms(expected.pop('outline')))
+            self.assertEqual(result, expected)
+
+        check(processor.update('\n'.join(in_lines), options), in_lines, options)
+        for i in range(len(in_lines)):
+            # remove a line, then put it back
+            lines = in_lines[:i] + in_lines[i+1:]
+            check(processor.edit(i, i + 1, [], noCursor), lines, noCursor)
+            check(processor.edit(i, i, [in_lines[i]], options), in_lines, options)
+
+            # the same edits, without the text
+            check(processor.edit(i, i + 1, [], noCursor, False), lines, noCursor, False)
+            check(processor.edit(i, i, [in_lines[i]], options, False), in_lines, options, False)
+
+            # open a form and a string in the middle of the text
+            lines = in_lines[:i] + ['(x "'] + in_lines[i:]
+            check(processor.update('\n'.join(lines), noCursor), lines, noCursor)
+            check(processor.update('\n'.join(in_lines), options), in_lines, options)
+
+    def test_incremental(self):
+        for test in INDENT_MODE_TESTS:
+            with self.subTest(test['in']['fileLineNo']):
+                self.check_incremental('indent', test)
+        for test in PAREN_MODE_TESTS:
+            with self.subTest(test['in']['fileLineNo']):
+                self.check_incremental('paren', test)
+
+        # an edit splices the stored lists in place
+        processor = IncrementalProcessor(INDENT_MODE)
+        processor.update('(a\n  b)\n(c\n  d)', None)
+        origLines, lines, checkpoints = processor.origLines, processor.lines, processor.checkpoints
+        result = processor.edit(1, 2, ['  b', '  e'], {'cursorLine': 2, 'cursorX': 3})
+        self.assertEqual(result, indent_mode('(a\n  b\n  e\n(c\n  d)', {'cursorLine': 2, 'cursorX': 3}))
+        self.assertIs(processor.origLines, origLines)
+        self.assertIs(processor.lines, lines)
+        self.assertIs(processor.checkpoints, checkpoints)
+        self.assertEqual(len(checkpoints), 6)
+
+    def test_form_processor(self):
+        for test in INDENT_MODE_TESTS:
+            with self.subTest(test['in']['fileLineNo']):
+                self.check_incremental('indent', test, FormProcessor)
+        for test in PAREN_MODE_TESTS:
+            with self.subTest(test['in']['fileLineNo']):
+                self.check_incremental('paren', test, FormProcessor)
+
+        lines = ['(ns foo)', '', '(defn bar [x]', '  (baz x))', '', '(def qux', '  "a', '(b")']
+        processor = FormProcessor(INDENT_MODE)
+        processor.update('\n'.join(lines), None)
+        self.assertEqual(processor.index.formStarts(), [0, 2, 5])
+
+        # a quote that opens a string changes the forms below it
+        lines[3] = '  (baz "x))'
+        result = processor.edit(3, 4, [lines[3]], {'cursorLine': 3, 'cursorX': 8})
+        self.assertEqual(processor.index.formStarts(), [0, 2, 7])
+        self.assertEqual(result, indent_mode('\n'.join(lines), {'cursorLine': 3, 'cursorX': 8}))
+
+        lines[3] = '  (baz x'
+        result = processor.edit(3, 4, [lines[3]], {'cursorLine': 3, 'cursorX': 8})
+        self.assertEqual(processor.index.formStarts(), [0, 2, 5])
+        self.assertEqual(result['changedLines'], [{'lineNo': 3, 'line': '  (baz x))'}])
+
+        result = processor.edit(5, 5, ['(foo'], {'cursorLine': 5, 'cursorX': 4})
+        self.assertEqual(processor.index.formStarts(), [0, 2, 5, 6])
+        self.assertEqual(result['changedLines'], [{'lineNo': 3, 'line': '  (baz x))'},
+                                                  {'lineNo': 5, 'line': '(foo)'}])
+
+        # the forms past an edit move, with their changed lines
+        result = processor.edit(0, 0, ['(a', '  b', ''], None)
+        self.assertEqual(processor.index.formStarts(), [0, 3, 5, 8, 9])
+        self.assertEqual(result['changedLines'], [{'lineNo': 1, 'line': '  b)'},
+                                                  {'lineNo': 6, 'line': '  (baz x))'},
+                                                  {'lineNo': 8, 'line': '(foo)'}])
+        result = processor.edit(1, 2, ['  c)'], None)
+        self.assertEqual(processor.index.formStarts(), [0, 3, 5, 8, 9])
+        self.assertEqual(result['changedLines'], [{'lineNo': 6, 'line': '  (baz x))'},
+                                                  {'lineNo': 8, 'line': '(foo)'}])
+
+    def test_process_many(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            texts = ['\n'.join(test['in']['lines']) for test in tests]
+            expected = [modeFn[mode](text, None) for text in texts]
+
+            results = process_many(texts, modeName[mode], workers=2, chunksize=3)
+            self.assertEqual(results, expected)
+
+            results = process_many(texts, modeName[mode], workers=2, chunksize=3, stream=True)
+            self.assertEqual(sorted(results, key=lambda r: r[0]), list(enumerate(expected)))
+
+            results = process_many(texts, modeName[mode], workers=1, stream=True)
+            self.assertEqual(list(results), list(enumerate(expected)))
+
+    def test_process_parallel(self):
+        with open('tests/really_long_file') as f:
+            long_text = f.read()
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            texts = ['\n'.join(test['in']['lines']) for test in tests]
+            # the second half has errors, and a bad form in the middle of the
+            # text fails every piece from there on
+            for text in (long_text, long_text + '\n'.join(texts),
+                         long_text.replace('\n(defn', '\n(defn "', 1) + long_text):
+                lines = text.split('\n')
+                options = {'cursorLine': len(lines) // 2, 'cursorX': 2}
+                expected = modeFn[mode](text, options)
+                self.assertEqual(process_parallel(text, modeName[mode], options, workers=2, pieces=4), expected)
+                self.assertEqual(process_parallel(text, modeName[mode], options, workers=1, pieces=7), expected)
+                options['edits'] = True
+                self.assertEqual(process_parallel(text, modeName[mode], options, workers=1, pieces=7),
+                                 modeFn[mode](text, options))
+                options = {'cursorLine': len(lines) // 2, 'cursorX': 2, 'outline': True}
+                expected = modeFn[mode](text, options)
+                result = process_parallel(text, modeName[mode], options, workers=2, pieces=7)
+                if 'outline' in expected:
+                    self.assertEqual(outlineForms(result.pop('outline')),
+                                     outlineForms(expected.pop('outline')))
+                self.assertEqual(result, expected)
+
+        for options in ({'stats': True}, {'timeBudget': 1.0}, {'lineBudget': 10}):
+            with self.assertRaises(ValueError):
+                process_parallel(long_text, PAREN_MODE, options, workers=1, pieces=4)
+
+    def test_prescan(self):
+        with open('tests/really_long_file') as f:
+            long_text = f.read()
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            cases = [('\n'.join(test['in']['lines']), test['in']['cursor']) for test in tests]
+            cases.append((long_text, None))
+            cases.append(('(é "\\"(" ;é [\n  \\\tfoo\r\n"bar', None))
+            for text, options in cases:
+                prescan = dict(options or {})
+                prescan['prescan'] = True
+                self.assertEqual(modeFn[mode](text, prescan), modeFn[mode](text, options))
+                lines = text.split('\n')
+                self.assertEqual(scanLines(lines), scanLinesRegex(lines))
+        self.assertEqual(scanLines([]), scanLinesRegex([]))
+
+    @unittest.skipIf(importNumpy() is None, "NumPy is not installed")
+    def test_prescan_numpy(self):
+        with open('tests/really_long_file') as f:
+            long_text = f.read()
+        texts = ['\n'.join(test['in']['lines']) for test in INDENT_MODE_TESTS + PAREN_MODE_TESTS]
+        texts += [long_text, '', '\n\n', '(é "\\"(" ;é [\n  \\\tfoo\r\n"bar']
+        # a lone surrogate, as decoded with surrogateescape
+        texts.append(b'(foo "\xff" [bar]\n(baz))'.decode('utf-8', 'surrogateescape'))
+        for text in texts:
+            lines = text.split('\n')
+            self.assertEqual(scanLinesNumpy(lines), scanLinesRegex(lines))
+        self.assertEqual(scanLinesNumpy([]), scanLinesRegex([]))
+        text = texts[-1]
+        self.assertEqual(indent_mode(text, {'prescan': True}), indent_mode(text, None))
+        self.assertEqual(normalize(text)['text'],
+                         indent_mode(paren_mode(text, None)['text'], None)['text'])
+
+    def test_process_lines_and_bytes(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                text = '\n'.join(test['in']['lines'])
+                options = test['in']['cursor']
+                expected = modeFn[mode](text, options)
+
+                out = process_lines(test['in']['lines'], modeName[mode], options)
+                if expected['success']:
+                    self.assertEqual('\n'.join(out['lines']), expected['text'])
+                    self.assertEqual(out['changedLines'], expected['changedLines'])
+                else:
+                    self.assertEqual(out['lines'], test['in']['lines'])
+                    self.assertEqual(out['error'], expected['error'])
+
+                out = process_bytes(text.encode('utf-8'), modeName[mode], options)
+                self.assertEqual(out['text'], expected['text'].encode('utf-8'))
+                self.assertEqual(out['success'], expected['success'])
+
+        # columns in bytes and in chars
+        out = process_bytes('(é "x\r\n  é'.encode('utf-8'), INDENT_MODE)
+        self.assertEqual(out['error']['x'], 3)
+        self.assertEqual(out['error']['byteX'], 4)
+        # byte 7 is char 6, between the close-parens
+        out = process_bytes('(é (é))\r\n  é'.encode('utf-8'), INDENT_MODE,
+                            {'cursorLine': 0, 'cursorByteX': 7})
+        self.assertEqual(out['text'], '(é (é)\r\n  é)'.encode('utf-8'))
+        self.assertEqual(out['changedLines'], [{'lineNo': 0, 'line': '(é (é)'.encode('utf-8')},
+                                               {'lineNo': 1, 'line': '  é)'.encode('utf-8')}])
+
+        # the edits and outline options, as in indent_mode
+        text = '(é (é))\r\n\t é'
+        options = {'cursorLine': 0, 'cursorX': 6, 'edits': True, 'outline': True}
+        expected = indent_mode(text, options)
+        out = process_lines(text.split('\r\n'), INDENT_MODE, options)
+        self.assertEqual(outlineForms(out.pop('outline')), outlineForms(expected['outline']))
+        del expected['outline']
+        self.assertEqual(out, expected)
+        out = process_bytes(text.encode('utf-8'), INDENT_MODE, options)
+        self.assertEqual(outlineForms(out.pop('outline')),
+                         outlineForms(indent_mode(text, options)['outline']))
+        self.assertEqual(out['edits'], [
+            {'lineNo': 0, 'start': 6, 'end': 7, 'replacement': b'', 'byteStart': 8, 'byteEnd': 9},
+            {'lineNo': 1, 'start': 0, 'end': 1, 'replacement': b'  ', 'byteStart': 0, 'byteEnd': 1},
+            {'lineNo': 1, 'start': 3, 'end': 3, 'replacement': b')', 'byteStart': 4, 'byteEnd': 4},
+        ])
+
+    def test_normalize(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                text = '\n'.join(test['in']['lines'])
+                lexed = LexedText(text)
+                self.assertEqual(modeFn[mode](lexed, test['in']['cursor']),
+                                 modeFn[mode](text, test['in']['cursor']))
+
+                paren = paren_mode(text, None)
+                out = normalize(lexed)
+                if not paren['success']:
+                    self.assertEqual(out, paren)
+                    continue
+                self.assertEqual(out['text'], indent_mode(paren['text'], None)['text'])
+                self.assertEqual(out['stable'], out['text'] == paren['text'])
+                lines = out['text'].split('\n')
+                self.assertEqual(out['changedLines'],
+                                 [{'lineNo': i, 'line': lines[i]}
+                                  for i in range(len(lines)) if lines[i] != test['in']['lines'][i]])
+
+        self.assertEqual(normalize("(foo\r\nbar)"), {
+            'text': "(foo\r\n bar)",
+            'success': True,
+            'changedLines': [{'lineNo': 1, 'line': ' bar)'}],
+            'stable': True,
+        })
+
+        # the line ending is found in the same pass as the chars to dispatch
+        for text in ('(a\r\n b)', '(a\r\n b)\r', '(a\n b\r)', '(a\r b)\n', '\r\n', '\r', ''):
+            lexed = LexedText(text)
+            self.assertEqual((lexed.lines, lexed.lineEnding), splitLines(text))
+            self.assertEqual(lexed.scan, scanLinesRegex(lexed.lines))
+            self.assertEqual(indent_mode(lexed, None), indent_mode(text, None))
+
+    def resume_to_end(self, out, budget):
+        while out.get('incomplete'):
+            out = resume(out, budget)
+        return out
+
+    def test_budget(self):
+        with open('tests/really_long_file') as f:
+            long_text = f.read()
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            cases = [('\n'.join(test['in']['lines']), test['in']['cursor']) for test in tests]
+            cases.append((long_text, None))
+            for text, options in cases:
+                expected = modeFn[mode](text, options)
+                budget = dict(options or {})
+                budget['lineBudget'] = 2
+                out = modeFn[mode](text, budget)
+                self.assertEqual(self.resume_to_end(out, {'lineBudget': 3}), expected)
+
+                # a budget of no time still processes a line per call
+                budget = dict(options or {})
+                budget['timeBudget'] = 0
+                out = modeFn[mode](LexedText(text), budget)
+                self.assertEqual(self.resume_to_end(out, {'timeBudget': 0}), expected)
+
+                out = process_lines(text.split('\n'), modeName[mode], budget)
+                self.assertEqual(self.resume_to_end(out, None), process_lines(text.split('\n'), modeName[mode], options))
+                out = process_bytes(text.encode('utf-8'), modeName[mode], budget)
+                self.assertEqual(self.resume_to_end(out, None), process_bytes(text.encode('utf-8'), modeName[mode], options))
+
+        out = indent_mode('(foo\n"bar\nbaz', {'lineBudget': 1})
+        self.assertEqual((out['text'], out['success'], out['incomplete'], out['lineNo']),
+                         ('(foo\n"bar\nbaz', False, True, 1))
+        partial = resume(out['resume'], {'lineBudget': 1})
+        self.assertEqual(partial['lineNo'], 2)
+        out = resume(partial)
+        self.assertEqual(out['error']['name'], 'unclosed-quote')
+        self.assertRaises(ValueError, resume, partial)
+
+    def test_edits(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                text = '\n'.join(test['in']['lines'])
+                options = test['in']['cursor']
+                expected = modeFn[mode](text, options)
+                out = modeFn[mode](text, dict(options or {}, edits=True))
+                if not expected['success']:
+                    self.assertEqual(out, expected)
+                    continue
+                self.assertEqual(out['changedLines'], expected['changedLines'])
+                lines = list(test['in']['lines'])
+                for edit in reversed(out['edits']):
+                    line = lines[edit['lineNo']]
+                    lines[edit['lineNo']] = line[:edit['start']] + edit['replacement'] + line[edit['end']:]
+                self.assertEqual('\n'.join(lines), expected['text'])
+                with self.subTest(test['in']['fileLineNo']):
+                    self.check_incremental(mode, test, extraOptions={'edits': True})
+                    self.check_incremental(mode, test, FormProcessor, {'edits': True})
+                    for cache in (ResultCache(), FormCache()):
+                        cached = cache.process(text, dict(options or {}, edits=True), modeName[mode])
+                        self.assertEqual(thaw(cached), out)
+                        self.assertEqual(thaw(cache.process(text, options, modeName[mode])), expected)
+
+        # the batch paths give the same edits as a full run, and the
+        # positions they map still point at the same chars
+        with open('tests/really_long_file') as f:
+            long_text = f.read()
+        long_text = long_text.replace('\n  ', '\n \t', 50)
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            texts = ['\n'.join(test['in']['lines']) for test in tests] + [long_text]
+            expected = [modeFn[mode](text, {'edits': True}) for text in texts]
+            self.assertEqual(process_many(texts, modeName[mode], {'edits': True}, workers=2, chunksize=5),
+                             expected)
+            options = {'cursorLine': 1000, 'cursorX': 2, 'edits': True}
+            out = process_parallel(long_text, modeName[mode], options, workers=2, pieces=4)
+            full = modeFn[mode](long_text, options)
+            self.assertEqual(out, full)
+            self.assertTrue(out['edits'])
+            inLines = long_text.split('\n')
+            outLines = modeFn[mode](long_text, dict(options, edits=False))['text'].split('\n')
+            for change in out['changedLines']:
+                lineNo = change['lineNo']
+                for x, ch in enumerate(inLines[lineNo]):
+                    newLineNo, newX = map_position(out['edits'], lineNo, x)
+                    self.assertEqual((newLineNo, newX), map_position(full['edits'], lineNo, x))
+                    if ch not in ' \t)]}':
+                        # a position stays in front of an insertion, so
+                        # the char is found just before the position after it
+                        newX = map_position(out['edits'], lineNo, x + 1)[1] - 1
+                        self.assertEqual(outLines[newLineNo][newX], ch)
+
+        out = indent_mode("(defn foo\n\t[x]\n  (bar x ) ;c", {'edits': True})
+        self.assertEqual(out['edits'], [
+            {'lineNo': 1, 'start': 0, 'end': 1, 'replacement': '  '},
+            {'lineNo': 2, 'start': 8, 'end': 9, 'replacement': ')'},
+        ])
+        self.assertNotIn('text', out)
+        self.assertEqual(map_position(out['edits'], 1, 0), (1, 0))
+        self.assertEqual(map_position(out['edits'], 1, 2), (1, 3))
+        self.assertEqual(map_position(out['edits'], 2, 9), (2, 9))
+        self.assertEqual(map_position(out['edits'], 2, 11), (2, 11))
+        self.assertEqual(map_position(out['edits'], 0, 4), (0, 4))
+
+    def test_outline(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                text = '\n'.join(test['in']['lines'])
+                options = dict(test['in']['cursor'] or {}, outline=True)
+                out = modeFn[mode](text, options)
+                if not out['success']:
+                    self.assertNotIn('outline', out)
+                    continue
+                lines = out['text'].split('\n')
+                for (openLine, openX), (closeLine, closeX) in outlineForms(out['outline']):
+                    self.assertEqual(closeParens[lines[openLine][openX]], lines[closeLine][closeX])
+                with self.subTest(test['in']['fileLineNo']):
+                    self.check_incremental(mode, test, extraOptions={'outline': True})
+                    self.check_incremental(mode, test, FormProcessor, {'outline': True})
+
+        text = "(defn foo [x]\n  {:a (bar x\n\n(baz)"
+        out = indent_mode(text, {'outline': True})
+        self.assertEqual(out['text'], "(defn foo [x]\n  {:a (bar x)})\n\n(baz)")
+        outline = out['outline']
+        self.assertEqual(outlineForms(outline), [((0, 0), (1, 14)), ((0, 10), (0, 12)),
+                                                 ((1, 2), (1, 13)), ((1, 6), (1, 12)),
+                                                 ((3, 0), (3, 4))])
+        self.assertEqual(outline.innermost(1, 8), 3)
+        self.assertEqual(outline.innermost(1, 12), 3)
+        self.assertEqual(outline.innermost(1, 13), 2)
+        self.assertEqual(outline.innermost(0, 9), 0)
+        self.assertEqual(outline.innermost(2, 0), None)
+        self.assertEqual(outline.parent(3), 2)
+        self.assertEqual(outline.parent(4), None)
+        self.assertEqual(outline.matching(1, 14), (0, 0))
+        self.assertEqual(outline.matching(0, 10), (0, 12))
+        self.assertEqual(outline.matching(0, 1), None)
+
+        cached = FormCache().indent_mode(text, {'outline': True})
+        self.assertEqual(outlineForms(cached['outline']), outlineForms(outline))
+        self.assertNotIn('outline', ResultCache().indent_mode(text, None))
+
+    def test_stream_lines(self):
+        for mode, tests in (('indent', INDENT_MODE_TESTS), ('paren', PAREN_MODE_TESTS)):
+            for test in tests:
+                lines = [line + '\n' for line in test['in']['lines']]
+                expected = modeFn[mode](''.join(lines), test['in']['cursor'])
+                out = stream_lines(lines, modeName[mode], test['in']['cursor'])
+                if expected['success']:
+                    self.assertEqual(''.join(out), expected['text'])
+                else:
+                    with self.assertRaises(ParinferError) as cm:
+                        list(out)
+                    self.assertEqual(cm.exception.args[0], expected['error'])
+
+        # line endings are kept
+        out = list(stream_lines(['(foo\r\n', '  bar\n', 'baz'], INDENT_MODE))
+        self.assertEqual(out, ['(foo\r\n', '  bar)\n', 'baz'])
+
+        # final lines come out before the rest of the input is read
+        consumed = []
+        def lines():
+            for line in ['(foo)\n', '(bar\n', '  baz\n', 'qux']:
+                consumed.append(line)
+                yield line
+        out = stream_lines(lines(), INDENT_MODE)
+        self.assertEqual(next(out), '(foo)\n')
+        self.assertEqual(len(consumed), 2)
+        self.assertEqual(list(out), ['(bar\n', '  baz)\n', 'qux'])
+
+        with self.assertRaises(ParinferError) as cm:
+            list(stream_lines(['(foo\n', '"bar'], PAREN_MODE))
+        self.assertEqual(cm.exception.args[0]['name'], 'unclosed-quote')
+        self.assertEqual(cm.exception.args[0]['lineNo'], 1)
+
+        # the outline would grow with the stream
+        with self.assertRaises(ValueError):
+            stream_lines(['(foo)\n'], INDENT_MODE, {'outline': True})
+
+    def test_server(self):
+        async def session():
+            reader = asyncio.StreamReader()
+            answers = asyncio.Queue()
+            def write(line):
+                answers.put_nowait(json.loads(line))
+            def send(*messages):
+                for message in messages:
+                    reader.feed_data((json.dumps(dict(message, jsonrpc='2.0')) + '\n').encode('utf-8'))
+            async def receive(count):
+                return [await answers.get() for i in range(count)]
+            server = asyncio.ensure_future(serveConnection(reader, write, 0.0))
+
+            send({'id': 1, 'method': 'open', 'params': {'buffer': 'a', 'mode': 'indent', 'text': '(foo\r\nbar'}})
+            self.assertEqual(await receive(1), [{'jsonrpc': '2.0', 'id': 1, 'result': {
+                'success': True, 'changedLines': [{'lineNo': 0, 'line': '(foo)'}]}}])
+
+            # the answer to 1 is applied; the first edit is coalesced into the second
+            send({'id': 2, 'method': 'edit', 'params': {'buffer': 'a', 'startLine': 1, 'endLine': 1,
+                                                        'lines': [' (bar'], 'applied': 1}},
+                 {'id': 3, 'method': 'edit', 'params': {'buffer': 'a', 'startLine': 1, 'endLine': 1,
+                                                        'lines': [' '],
+                                                        'options': {'cursorLine': 1, 'cursorX': 1}}},
+                 {'id': 4, 'method': 'format'},
+                 {'id': 5, 'method': 'edit', 'params': {'buffer': 'b', 'startLine': 0, 'endLine': 0, 'lines': []}},
+                 {'id': 6, 'method': 'shutdown'})
+            reader.feed_eof()
+            self.assertTrue(await server)
+            return await receive(answers.qsize())
+
+        answers = asyncio.run(session())
+        self.assertEqual([(answer['id'], answer.get('error', {}).get('code')) for answer in answers],
+                         [(4, -32601), (5, -32602), (2, -32800), (3, None), (6, None)])
+        self.assertEqual(answers[3]['result'], {'success': True, 'changedLines': [
+            {'lineNo': 0, 'line': '(foo'}, {'lineNo': 2, 'line': ' (bar))'}]})
+
+    def run_main(self, *args):
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            status = main(list(args))
+        return status, out.getvalue(), err.getvalue()
+
+    def test_main(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        files = {
+            'clean.clj': '(foo\n  bar)\n',
+            'dirty.clj': '(foo\nbar)\r\n',
+            os.path.join('sub', 'broken.clj'): '(foo "\n',
+        }
+        os.mkdir(os.path.join(tmp, 'sub'))
+        for name, text in files.items():
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(text.encode('utf-8'))
+
+        def path(name):
+            return os.path.join(tmp, name)
+        def read(name):
+            with open(path(name), 'rb') as f:
+                return f.read().decode('utf-8')
+
+        status, out, err = self.run_main('--check', path('*.clj'))
+        self.assertEqual((status, out, err), (1, path('dirty.clj') + '\n', ''))
+
+        status, out, err = self.run_main('--check', path('**/broken.clj'))
+        self.assertEqual(status, 1)
+        self.assertEqual(err, path('sub/broken.clj') + ':1:6: String is missing a closing quote.\n')
+
+        status, out, err = self.run_main('-m', 'indent', path('dirty.clj'))
+        self.assertEqual((status, out), (0, '(foo)\r\nbar\r\n'))
+
+        mtime = os.stat(path('clean.clj')).st_mtime_ns
+        for jobs in ('1', '2'):
+            status, out, err = self.run_main('-i', '-j', jobs, path('clean.clj'), path('dirty.clj'))
+            self.assertEqual(status, 0)
+            self.assertEqual(read('dirty.clj'), '(foo\r\n bar)\r\n')
+            self.assertEqual(read('clean.clj'), files['clean.clj'])
+        self.assertEqual(os.stat(path('clean.clj')).st_mtime_ns, mtime)
+        self.assertEqual(sorted(os.listdir(tmp)), ['clean.clj', 'dirty.clj', 'sub'])
+
+    def test_main_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        def path(name):
+            return os.path.join(tmp, name)
+        def write(name, text, mtime=None):
+            with open(path(name), 'wb') as f:
+                f.write(text.encode('utf-8'))
+            if mtime is None:
+                # well before the runs, so that the size and mtime are trusted
+                mtime = os.stat(path(name)).st_mtime_ns - 60 * 10 ** 9
+            os.utime(path(name), ns=(mtime, mtime))
+        write('clean.clj', '(foo\n  bar)\n')
+        write('dirty.clj', '(foo\nbar)\n')
+        write('broken.clj', '(foo "\n')
+        cache = path('index.json')
+        pattern = path('*.clj')
+        broken = path('broken.clj') + ':1:6: String is missing a closing quote.\n'
+
+        for i in range(2):
+            status, out, err = self.run_main('--check', '--cache', cache, pattern)
+            self.assertEqual((status, out, err), (1, path('dirty.clj') + '\n', broken))
+
+        # a file with the same size and mtime is not read again
+        stat = os.stat(path('clean.clj'))
+        write('clean.clj', '(foo\nbar)  \n', stat.st_mtime_ns)
+        status, out, err = self.run_main('--check', '--cache', cache, pattern)
+        self.assertEqual(out, path('dirty.clj') + '\n')
+
+        # but it is once its mtime changes
+        os.utime(path('clean.clj'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        status, out, err = self.run_main('--check', '--cache', cache, pattern)
+        self.assertEqual(out, path('clean.clj') + '\n' + path('dirty.clj') + '\n')
+
+        # a file modified just before a run can change again within the same
+        # mtime tick, so its size and mtime are not trusted
+        mtime = time.time_ns()
+        write('racy.clj', '(foo\n  bar)\n', mtime)
+        status, out, err = self.run_main('--check', '--cache', cache, path('racy.clj'))
+        self.assertEqual(out, '')
+        write('racy.clj', '(foo\nbar)  \n', mtime)
+        status, out, err = self.run_main('--check', '--cache', cache, path('racy.clj'))
+        self.assertEqual(out, path('racy.clj') + '\n')
+        os.remove(path('racy.clj'))
+
+        # files that would change are still rewritten in place
+        status, out, err = self.run_main('-i', '--cache', cache, pattern)
+        self.assertEqual((status, err), (1, broken))
+        status, out, err = self.run_main('--check', '--cache', cache, pattern)
+        self.assertEqual((status, out, err), (1, '', broken))
+
+        # a damaged entry is processed again rather than crashing the run
+        with open(cache) as f:
+            index = json.load(f)
+        files = index['files']
+        del files[os.path.abspath(path('clean.clj'))]['size']
+        files[os.path.abspath(path('dirty.clj'))]['results'] = {'PAREN_MODE': ['error', 'x']}
+        with open(cache, 'w') as f:
+            json.dump(index, f)
+        status, out, err = self.run_main('--check', '--cache', cache, pattern)
+        self.assertEqual((status, out, err), (1, '', broken))
+        with open(cache) as f:
+            files = json.load(f)['files']
+        for name in ('clean.clj', 'dirty.clj', 'broken.clj'):
+            self.assertIn('PAREN_MODE', files[os.path.abspath(path(name))]['results'])
+
+        # an index from another version is dropped
+        with open(cache) as f:
+            index = json.load(f)
+        index['version'] = 'other'
+        index['files'][os.path.abspath(path('broken.clj'))]['results']['PAREN_MODE'] = ['clean']
+        with open(cache, 'w') as f:
+            json.dump(index, f)
+        status, out, err = self.run_main('--check', '--cache', cache, pattern)
+        self.assertEqual((status, out, err), (1, '', broken))
+
 if __name__ == "__main__":
-    unittest2.main()
+    unittest.main()